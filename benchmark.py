@@ -0,0 +1,103 @@
+#!/usr/bin/python
+"""
+Micro benchmarks for the Testopia XML-RPC driver.
+
+None of these talk to a real Testopia instance; run them with
+
+  python benchmark.py
+
+and compare the numbers between two checkouts of testopia.py.
+"""
+
+import multiprocessing
+import timeit
+import xmlrpclib
+from datetime import datetime
+
+import testopia
+
+
+class NullTransport(xmlrpclib.Transport):
+    '''A transport that drops the request body and answers with an empty struct.'''
+    def request(self, host, handler, request_body, verbose=0):
+        return ({},)
+
+
+def serve(connection):
+    """Runs the tests' StandInServer, answering Build.get too, until the
+    other end of 'connection' is closed."""
+    server = testopia.StandInServer()
+    server.handlers['Build.get'] = lambda build_id: {'build_id': build_id, 'name': 'nightly'}
+    connection.send(server.url)
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    server.close()
+
+
+def stand_in_server():
+    """Starts a local XML-RPC server answering User.login and Build.get.
+
+    The server runs in a process of its own, so that it does not compete
+    for the interpreter lock with the client being measured.
+
+    Result: A (url, process) pair
+    """
+    connection, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(child,))
+    process.daemon = True
+    process.start()
+    return connection.recv(), process
+
+
+def offline_testopia():
+    """Returns a Testopia instance that never logged in and never hits the wire."""
+    t = testopia.Testopia.__new__(testopia.Testopia)
+    t.server = xmlrpclib.ServerProxy('http://localhost/tr_xmlrpc.cgi',
+                                     transport=NullTransport())
+    return t
+
+
+def bench_dispatch(number=20000):
+    """Per-call CPU spent building arguments and dispatching a verb."""
+    t = offline_testopia()
+    notes = 'Failed on the nightly build, see the attached log for details. ' * 4
+
+    def update():
+        t.testcaserun_update(10, 20, 30, 40, new_build_id=31,
+                             new_environment_id=41, case_run_status_id=3,
+                             update_bugs=True, assignee=5, notes=notes)
+
+    def case_list():
+        t.testcase_list(case_id=20, case_id_type='lessthan',
+                        alias='login', alias_type='regexp',
+                        author_id=3, author_id_type='equals',
+                        case_status_id=2, case_status_id_type='equals',
+                        category_id=7, category_id_type='equals',
+                        creation_date=datetime(2008, 6, 23, 12, 0, 0),
+                        creation_date_type='greaterthan',
+                        isautomated=True, priority_id=1,
+                        requirement='REQ-1', script='run.sh',
+                        summary='login page', summary_type='anywords',
+                        sortkey=100, run_id=12, run_id_type='equals')
+
+    for name, func in [('testcaserun_update', update), ('testcase_list', case_list)]:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print "%-24s %8.2f us/call" % (name, seconds / number * 1e6)
+
+
+def bench_transport(number=5000):
+    """Per-request time of a round trip to a local stand-in server."""
+    url, process = stand_in_server()
+    try:
+        t = testopia.Testopia('jdoe@mycompany.com', 'jdoepassword', url)
+        seconds = min(timeit.repeat(lambda: t.build_get(1), number=number, repeat=5))
+        print "%-24s %8.2f us/call" % ('build_get round trip', seconds / number * 1e6)
+    finally:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    bench_dispatch()
+    bench_transport()
@@ -93,21 +93,288 @@ __version__="0.2.0.0"
 
 
 
-import xmlrpclib, urllib2
+import xmlrpclib, urllib, urllib2, httplib
+import threading, zlib, gzip, os, sys, socket, errno, inspect, re, operator
+from collections import OrderedDict, deque
+from array import array
+from itertools import izip, compress, repeat, islice
+from functools import partial
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from types import *
-from datetime import datetime, time
-
-from cookielib import CookieJar
+from datetime import datetime, time, timedelta
+from time import time as _now
+
+from cookielib import CookieJar, LWPCookieJar
+try:
+    import numpy
+except ImportError:
+    numpy = None # ResultFrame falls back on the array module
+
+class _CookieResponse:
+    '''Fakes the response object CookieJar.extract_cookies expects, around the headers.'''
+    def __init__(self,headers): self.headers = headers
+    def info(self): return self.headers
+
+def _gzip_encode(data):
+    """Returns data compressed in the gzip content encoding."""
+    f = StringIO()
+    gzf = gzip.GzipFile(mode="wb", fileobj=f, compresslevel=1)
+    gzf.write(data)
+    gzf.close()
+    return f.getvalue()
 
 class CookieTransport(xmlrpclib.Transport):
-    '''A subclass of xmlrpclib.Transport that supports cookies.'''
+    '''A subclass of xmlrpclib.Transport that supports cookies.
+
+    Connections are kept alive in a pool of up to 'pool_size' idle
+    connections, so several threads can share one transport, and the
+    cookie session in it. A thread checks a connection out of the pool for
+    the length of a request and checks it back in afterwards; a connection
+    that fails is closed and left out of the pool. CookieJar does its own
+    locking, so all the connections share the one cookiejar.
+
+    The Cookie headers are worked out once and reused for as long as no
+    response sets a cookie and none of the cookies expires. A cookiejar
+    with a file is saved at most every 'cookie_save_interval' seconds, and
+    when the transport is closed.
+
+    Responses are requested gzip-compressed, and decompressed as they are
+    read. Request bodies longer than 'encode_threshold' bytes are sent
+    gzip-compressed too; it is None, so never, by default. The bytes_sent,
+    bytes_received and bytes_decoded counters add up the request bodies as
+    sent, and the response bodies as received and after decompression.
+    '''
     cookiejar = None
     scheme = 'http'
+    accept_gzip_encoding = True
+    encode_threshold = None
+    response_chunk_size = 65536
+    cookie_save_interval = 5.0
+
+    def __init__(self, use_datetime=0, pool_size=1):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self._init_pool(pool_size)
+        self._init_counters()
+        self._init_cookies()
+
+    def _init_cookies(self):
+        self.cookiejar = CookieJar()
+        self._cookie_generation = 0 # Bumped whenever a response sets cookies
+        self._cookie_cache = None
+        self._cookies_dirty = False
+        self._cookies_saved = 0
+        self._cookies_lock = threading.Lock() # Held while the cookiejar is saved
+
+    def _init_counters(self):
+        self._counters_lock = threading.Lock()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def _count(self, sent=0, received=0, decoded=0):
+        self._counters_lock.acquire()
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.bytes_decoded += decoded
+        self._counters_lock.release()
+
+    # Same as python 2.7's xmlrpclib.Transport.send_request, but always
+    # asks for a gzip-compressed response
+    def send_request(self, connection, handler, request_body):
+        if self.accept_gzip_encoding:
+            connection.putrequest("POST", handler, skip_accept_encoding=True)
+            connection.putheader("Accept-Encoding", "gzip")
+        else:
+            connection.putrequest("POST", handler)
+
+    # Same as python 2.7's xmlrpclib.Transport.send_content, but counts
+    # the bytes sent
+    def send_content(self, connection, request_body):
+        connection.putheader("Content-Type", "text/xml")
+
+        #optionally encode the request
+        if (self.encode_threshold is not None and
+            self.encode_threshold < len(request_body)):
+            connection.putheader("Content-Encoding", "gzip")
+            request_body = _gzip_encode(request_body)
+        self._count(sent=len(request_body))
+
+        connection.putheader("Content-Length", str(len(request_body)))
+        if hasattr(xmlrpclib.Transport, 'single_request'):
+            connection.endheaders(request_body) # python 2.7+
+        else:
+            connection.endheaders() # python 2.6 and earlier
+            connection.send(request_body)
+
+    def _read_body(self, response):
+        """Yields the body of a response in chunks as it arrives, decompressed
+        if need be."""
+        decoder = None
+        if response.getheader("Content-Encoding", "") == "gzip":
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) # gzip header
+        while 1:
+            data = response.read(self.response_chunk_size)
+            if not data:
+                break
+            received = len(data)
+            if decoder is not None:
+                data = decoder.decompress(data)
+            self._count(received=received, decoded=len(data))
+            if data:
+                yield data
+        if decoder is not None:
+            data = decoder.flush()
+            if data:
+                self._count(decoded=len(data))
+                yield data
+
+    # Same as python 2.7's xmlrpclib.Transport.parse_response, but feeds
+    # the parser while the response is decompressed, rather than after
+    # the whole of it has been read into memory
+    def parse_response(self, response):
+        p, u = self.getparser()
+
+        for data in self._read_body(response):
+            if self.verbose:
+                print "body:", repr(data)
+            p.feed(data)
+
+        p.close()
+
+        return u.close()
+
+    def _init_pool(self, pool_size):
+        if pool_size < 1:
+            raise ValueError("The connection pool size must be at least 1.")
+        self.pool_size = pool_size
+        self._pool_lock = threading.Lock()
+        self._idle = [] # (host, connection) pairs ready for another request
+        self._reserved = [] # The sizes the pool is grown to for a while
+
+    def _checkout(self, host):
+        """Returns an idle connection to host, or a new one if there is none."""
+        self._pool_lock.acquire()
+        try:
+            while self._idle:
+                idle_host, connection = self._idle.pop()
+                if idle_host == host:
+                    return connection
+                connection.close()
+            # make_connection() caches the connection it makes; drop that
+            # before and after, so it really makes a new one and nothing
+            # else holds on to it.
+            self._connection = (None, None)
+            connection = self.make_connection(host)
+            self._connection = (None, None)
+            return connection
+        finally:
+            self._pool_lock.release()
+
+    def _checkin(self, host, connection):
+        """Puts a connection back in the pool, or closes it if the pool is full."""
+        self._pool_lock.acquire()
+        try:
+            if len(self._idle) < max([self.pool_size] + self._reserved):
+                self._idle.append((host, connection))
+                return
+        finally:
+            self._pool_lock.release()
+        connection.close()
+
+    def reserve(self, size):
+        """Grows the pool to keep up to 'size' idle connections, until release(size)."""
+        self._pool_lock.acquire()
+        try:
+            self._reserved.append(size)
+        finally:
+            self._pool_lock.release()
+
+    def release(self, size):
+        """Undoes a reserve(size), closing the idle connections the pool no longer keeps."""
+        self._pool_lock.acquire()
+        try:
+            self._reserved.remove(size)
+            keep = max([self.pool_size] + self._reserved)
+            excess, self._idle = self._idle[keep:], self._idle[:keep]
+        finally:
+            self._pool_lock.release()
+        for host, connection in excess:
+            connection.close()
+
+    def close(self):
+        """Closes all the idle connections in the pool."""
+        self._pool_lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._pool_lock.release()
+        for host, connection in idle:
+            connection.close()
+        self._save_cookies(force=True)
+
+    def _save_cookies(self, force=False):
+        """Writes changed cookies back to the cookiejar's file, if it has one, unless
+        they were written less than cookie_save_interval seconds ago and not 'force'."""
+        if not self._cookies_dirty or not hasattr(self.cookiejar,'save'):
+            return
+        # Several threads may get responses at once; only one saves at a time.
+        # This is a lock of its own, so that the file is written without
+        # holding up the threads checking connections in and out.
+        self._cookies_lock.acquire()
+        try:
+            if self._cookies_dirty and \
+               (force or _now() - self._cookies_saved >= self.cookie_save_interval):
+                self._cookies_dirty = False
+                self._cookies_saved = _now()
+                try:
+                    self.cookiejar.save(self.cookiejar.filename)
+                except Exception, e:
+                    pass
+        finally:
+            self._cookies_lock.release()
+
+    def flush_cookies(self):
+        """Writes the cookiejar back to its file now."""
+        self._cookies_dirty = True
+        self._save_cookies(force=True)
+
+    def _cookie_headers(self, request_url):
+        """Returns the Cookie headers for a request to request_url."""
+        jar = self.cookiejar
+        cache = self._cookie_cache
+        if cache is not None:
+            cached_jar, cached_url, generation, expires, headers = cache
+            if cached_jar is jar and cached_url == request_url and \
+               generation == self._cookie_generation and \
+               (expires is None or _now() < expires):
+                return headers
+        generation = self._cookie_generation
+        # Let the cookiejar figure out what cookies are appropriate
+        cookie_request = urllib2.Request(request_url)
+        jar.add_cookie_header(cookie_request)
+        headers = [(h, v) for h, v in cookie_request.header_items()
+                   if h.startswith('Cookie')]
+        expiries = [cookie.expires for cookie in jar if cookie.expires]
+        expires = expiries and min(expiries) or None
+        self._cookie_cache = (jar, request_url, generation, expires, headers)
+        return headers
+
+    def _extract_cookies(self, request_url, response):
+        """Stores the cookies a response sets, if any."""
+        if response.msg.getheader('set-cookie') is None and \
+           response.msg.getheader('set-cookie2') is None:
+            return
+        self.cookiejar.extract_cookies(_CookieResponse(response.msg),
+                                       urllib2.Request(request_url))
+        self._cookie_generation += 1
+        self._cookies_dirty = True
+        self._save_cookies()
 
     # Cribbed from xmlrpclib.Transport.send_user_agent
     def send_cookies(self, connection, cookie_request):
         if self.cookiejar is None:
-            self.cookiejar = cookielib.CookieJar()
+            self.cookiejar = CookieJar()
         elif self.cookiejar:
             # Let the cookiejar figure out what cookies are appropriate
             self.cookiejar.add_cookie_header(cookie_request)
@@ -150,11 +417,8 @@ class CookieTransport(xmlrpclib.Transport):
         # Okay, extract the cookies from the headers
         self.cookiejar.extract_cookies(cookie_response,cookie_request)
         # And write back any changes
-        if hasattr(self.cookiejar,'save'):
-            try:
-                self.cookiejar.save(self.cookiejar.filename)
-            except Exception, e:
-                pass
+        self._cookies_dirty = True
+        self._save_cookies()
 
         if errcode != 200:
             raise xmlrpclib.ProtocolError(
@@ -175,79 +439,260 @@ class CookieTransport(xmlrpclib.Transport):
     # This is just python 2.7's xmlrpclib.Transport.single_request, with
     # send additions noted below to send cookies along with the request
     def single_request_with_cookies(self, host, handler, request_body, verbose=0):
-        h = self.make_connection(host)
+        h = self._checkout(host) # CHANGED: from the pool, not make_connection()
         if verbose:
             h.set_debuglevel(1)
 
-        # ADDED: construct the URL and Request object for proper cookie handling
-        request_url = "%s://%s%s" % (self.scheme,host,handler)
-        cookie_request  = urllib2.Request(request_url)
-
         try:
-            self.send_request(h,handler,request_body)
-            self.send_host(h,host)
-            self.send_cookies(h,cookie_request) # ADDED. creates cookiejar if None.
-            self.send_user_agent(h)
-            self.send_content(h,request_body)
-
-            response = h.getresponse(buffering=True)
-
-            # ADDED: parse headers and get cookies here
-            # fake a response object that we can fill with the headers above
-            class CookieResponse:
-                def __init__(self,headers): self.headers = headers
-                def info(self): return self.headers
-
-            cookie_response = CookieResponse(response.msg)
-            # Okay, extract the cookies from the headers
-            self.cookiejar.extract_cookies(cookie_response,cookie_request)
-            # And write back any changes
-            if hasattr(self.cookiejar,'save'):
-                try:
-                    self.cookiejar.save(self.cookiejar.filename)
-                except Exception, e:
-                    pass
+            # ADDED: send the request along with its cookies
+            response = self._send_with_cookies(h, host, handler, request_body)
 
             if response.status == 200:
                 self.verbose = verbose
-                return self.parse_response(response)
+                result = self.parse_response(response)
+                self._checkin(host, h) # ADDED
+                return result
         except xmlrpclib.Fault:
+            # The whole fault response was read, so the connection is reusable
+            self._checkin(host, h) # ADDED
             raise
         except Exception:
             # All unexpected errors leave connection in
-            # a strange state, so we clear it.
+            # a strange state, so we evict it from the pool. The idle ones
+            # have likely been dropped by the server as well, so they go too.
+            h.close()
             self.close()
             raise
 
         #discard any response data and raise exception
-        if (response.getheader("content-length", 0)):
-            response.read()
+        h.close()
         raise xmlrpclib.ProtocolError(
             host + handler,
             response.status, response.reason,
             response.msg,
             )
 
+    # The sending half of single_request_with_cookies, returning the response
+    # once its headers are in and their cookies are extracted
+    def _send_with_cookies(self, h, host, handler, request_body):
+        # ADDED: construct the URL the cookies are matched against
+        request_url = "%s://%s%s" % (self.scheme,host,handler)
+
+        self.send_request(h,handler,request_body)
+        self.send_host(h,host)
+        for header, value in self._cookie_headers(request_url): # ADDED
+            h.putheader(header, value)
+        self.send_user_agent(h)
+        self.send_content(h,request_body)
+
+        response = h.getresponse(buffering=True)
+
+        # ADDED: get cookies from the headers, if the server set any
+        self._extract_cookies(request_url, response)
+        return response
+
+    def iter_request(self, host, handler, request_body, verbose=0):
+        """Sends a request like request(), but parses the response as it arrives.
+
+        If the result is an array, each of its items is yielded as soon as it
+        is complete; any other result is yielded whole. Needs python 2.7.
+        """
+        for attempt in (0, 1):
+            h = self._checkout(host)
+            if verbose:
+                h.set_debuglevel(1)
+            try:
+                response = self._send_with_cookies(h, host, handler, request_body)
+                break
+            except Exception, e:
+                h.close()
+                self.close()
+                # Like xmlrpclib.Transport.request, retry once on a
+                # connection the server had already dropped
+                if attempt or not (isinstance(e, httplib.BadStatusLine) or
+                                   (isinstance(e, socket.error) and e.errno in
+                                    (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE))):
+                    raise
+
+        if response.status != 200:
+            h.close()
+            raise xmlrpclib.ProtocolError(
+                host + handler,
+                response.status, response.reason,
+                response.msg,
+                )
+
+        u = _StreamingUnmarshaller(self._use_datetime)
+        p = xmlrpclib.ExpatParser(u)
+        complete = False
+        try:
+            for data in self._read_body(response):
+                p.feed(data)
+                for item in u.completed_items():
+                    yield item
+            p.close()
+            complete = True
+            result = u.close()[0]
+        finally:
+            # A response left half read would garble the next one
+            if complete:
+                self._checkin(host, h)
+            else:
+                h.close()
+        if u.container == 'array':
+            for item in result:
+                yield item
+        else:
+            yield result
+
     # Override the appropriate request method
     if hasattr(xmlrpclib.Transport, 'single_request'):
         single_request = single_request_with_cookies # python 2.7+
     else:
         request = request_with_cookies # python 2.6 and earlier
 
+class _StreamingUnmarshaller(xmlrpclib.Unmarshaller):
+    '''An Unmarshaller that hands out the items of an array result while it is parsed.'''
+    container = None # The outermost array or struct tag, once it has started
+
+    def start(self, tag, attrs):
+        if self.container is None and tag in ('array', 'struct'):
+            self.container = tag
+        xmlrpclib.Unmarshaller.start(self, tag, attrs)
+
+    def completed_items(self):
+        """Returns the items of the outermost array parsed so far, and forgets them."""
+        if self.container != 'array' or not self._marks:
+            return []
+        # Everything above the array's mark is complete, up to the mark of
+        # the item still being parsed, if any
+        mark = self._marks[0]
+        if len(self._marks) > 1:
+            end = self._marks[1]
+        else:
+            end = len(self._stack)
+        items = self._stack[mark:end]
+        del self._stack[mark:end]
+        for i in range(1, len(self._marks)):
+            self._marks[i] -= len(items)
+        return items
+
 class SafeCookieTransport(xmlrpclib.SafeTransport,CookieTransport):
     '''SafeTransport subclass that supports cookies.'''
     scheme = 'https'
+
+    def __init__(self, use_datetime=0, pool_size=1):
+        xmlrpclib.SafeTransport.__init__(self, use_datetime)
+        self._init_pool(pool_size)
+        self._init_counters()
+        self._init_cookies()
+
+    # xmlrpclib.Transport comes first in the lookup, so pick these explicitly
+    close = CookieTransport.close
+    reserve = CookieTransport.reserve
+    release = CookieTransport.release
+    iter_request = CookieTransport.iter_request
+    send_request = CookieTransport.send_request
+    send_content = CookieTransport.send_content
+    parse_response = CookieTransport.parse_response
     # Override the appropriate request method
     if hasattr(xmlrpclib.Transport, 'single_request'):
         single_request = CookieTransport.single_request_with_cookies # python 2.7+
     else:
         request = CookieTransport.request_with_cookies # python 2.6 and earlier
 
+class SessionCookieJar(LWPCookieJar):
+    '''An LWPCookieJar that also stores the user ID of the session.
+
+    The file is only ever readable by its owner, and keeps session cookies,
+    which is what Bugzilla logs in with.
+    '''
+    user_id = None
+
+    def save(self, filename=None, ignore_discard=True, ignore_expires=False):
+        if filename is None:
+            filename = self.filename
+        # Write to a private temporary file, then move it in place, so other
+        # processes sharing the session never read half a file
+        temp = "%s.%d.tmp" % (filename, os.getpid())
+        f = os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "w")
+        try:
+            f.write("#LWP-Cookies-2.0\n")
+            if self.user_id is not None:
+                f.write("#user_id: %d\n" % self.user_id)
+            f.write(self.as_lwp_str(ignore_discard, ignore_expires))
+        finally:
+            f.close()
+        os.chmod(temp, 0600)
+        os.rename(temp, filename)
+
+    def load(self, filename=None, ignore_discard=True, ignore_expires=False):
+        if filename is None:
+            filename = self.filename
+        LWPCookieJar.load(self, filename, ignore_discard, ignore_expires)
+        self.user_id = None
+        for line in open(filename):
+            if line.startswith("#user_id:"):
+                self.user_id = int(line.split(":", 1)[1])
+
+
+def _session_filename(session_cache, url, username):
+    """Returns the path of the session file for a login, making its directory if need be.
+
+    'session_cache' -- string, the directory of the session files, or True for
+                       ~/.testopia/sessions
+    """
+    from hashlib import sha1
+    if session_cache is True:
+        session_cache = os.path.join(os.path.expanduser('~'), '.testopia', 'sessions')
+    if not os.path.isdir(session_cache):
+        os.makedirs(session_cache, 0700)
+    return os.path.join(session_cache, sha1("%s\n%s" % (url, username)).hexdigest())
+
 VERBOSE=0
 DEBUG=0
+LOGIN_REQUIRED_FAULT=410 # Bugzilla's fault code for a missing or expired login
+_SEARCH_OPERATIONS = ['equals', 'notequals', 'isnull',
+        'isnotnull', 'lessthan', 'greaterthan', 'regexp',
+        'notregexp', 'anywords', 'allwords', 'nowords',]
+
+METHOD_NOT_FOUND_FAULT=-32601 # The XML-RPC interoperability fault code for an unknown method
+_UNKNOWN_METHOD = re.compile(r'not supported|not found|no such method|unknown method|'
+                             r'failed to locate method', re.IGNORECASE)
 
 class TestopiaError(Exception): pass
 
+def _unknown_method_fault(fault):
+    """Returns whether an xmlrpclib.Fault says the method called does not exist."""
+    return fault.faultCode == METHOD_NOT_FOUND_FAULT or \
+           bool(_UNKNOWN_METHOD.search(str(fault.faultString)))
+
+def _read_config(filename):
+    """Returns the keyword arguments for Testopia() held in the
+    [testopia] stanza of a config file.
+    """
+    from ConfigParser import SafeConfigParser
+    cp = SafeConfigParser()
+    cp.read([filename])
+    kwargs = dict([(key, cp.get('testopia', key)) \
+                   for key in ['username', 'password', 'url']])
+    if cp.has_option('testopia', 'pool_size'):
+        kwargs['pool_size'] = cp.getint('testopia', 'pool_size')
+    if cp.has_option('testopia', 'compress_threshold'):
+        kwargs['compress_threshold'] = cp.getint('testopia', 'compress_threshold')
+    if cp.has_option('testopia', 'session_cache'):
+        kwargs['session_cache'] = cp.get('testopia', 'session_cache')
+    for key in ['disk_cache', 'text_hashes']:
+        if cp.has_option('testopia', key):
+            kwargs[key] = cp.get('testopia', key)
+    for key in ['cache_ttl', 'cache_size', 'disk_cache_ttl', 'disk_cache_size']:
+        if cp.has_option('testopia', key):
+            kwargs[key] = cp.getint('testopia', key)
+    for key in ['identity_map', 'compact_results']:
+        if cp.has_option('testopia', key):
+            kwargs[key] = cp.getboolean('testopia', key)
+    return kwargs
+
 class TestopiaXmlrpcError(Exception):
     def __init__(self, verb, params, wrappedError):
         self.verb = verb
@@ -255,12 +700,1127 @@ class TestopiaXmlrpcError(Exception):
         self.wrappedError = wrappedError
 
     def __str__(self):
+        params = ', '.join([repr(param) for param in self.params])
         return "Error while executing cmd '%s' --> %s" \
-               % ( self.verb + "(" + self.params + ")", self.wrappedError)
+               % ( self.verb + "(" + params + ")", self.wrappedError)
     
+_MISSING = object() # Tells a cache miss from a cached None
+
+class LookupCache(object):
+    '''A thread-safe, size-bounded cache whose entries expire.
+
+    Entries live for 'ttl' seconds (None for ever); once there are
+    'max_size' of them, the least recently used one makes room for the
+    next. The hits, misses and evictions counters add up since the last
+    clear().
+    '''
+    def __init__(self, ttl=300, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drops every entry and resets the counters."""
+        self._lock.acquire()
+        try:
+            self._entries = OrderedDict() # key -> (expiry time or None, value)
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default if there is none."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] <= _now()):
+                self.misses += 1
+                return default
+            self._entries[key] = entry # Now the most recently used
+            self.hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, ttl=_MISSING):
+        """Caches value for key, for 'ttl' seconds if given, else for the cache's ttl."""
+        if ttl is _MISSING:
+            ttl = self.ttl
+        if ttl is None:
+            expiry = None
+        else:
+            expiry = _now() + ttl
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            if self.max_size < 1:
+                return
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (expiry, value)
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        """Drops the entry for key, if there is one."""
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns the hits, misses, evictions and size of the cache."""
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self._entries))
+
+
+def _command_key(verb, args):
+    """Returns a hashable key for a command, whatever the order of its dictionaries' items."""
+    def canonical(value):
+        if type(value) is DictType:
+            return tuple(sorted([(key, canonical(item)) for key, item in value.items()]))
+        if type(value) in (ListType, TupleType):
+            return tuple([canonical(item) for item in value])
+        return value
+    return (verb, canonical(args))
+
+# The verbs that only read, whose results may be kept or shared
+_READ_ONLY_VERB = re.compile(r'\.(get|get_text|get_tags|get_components|get_category'
+                             r'|lookup_\w+|check_\w+)$')
+
+def _shallow_copy(value):
+    """Returns a copy of a dictionary or list result, or else value itself."""
+    if type(value) is DictType:
+        return dict(value)
+    if type(value) is ListType:
+        return list(value)
+    return value
+
+class _InFlightCall(object):
+    '''A command being sent, which other threads wait for instead of sending it again.'''
+    def __init__(self):
+        # A bare lock, held until the call is done, is much cheaper than an Event
+        self._running = threading.Lock()
+        self._running.acquire()
+        self.value = None
+        self.exc_info = None
+
+    def done(self):
+        self._running.release()
+
+    def wait(self):
+        self._running.acquire()
+        self._running.release()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class DiskCache(object):
+    '''A cache of command results in an SQLite file, shared between processes.
+
+    Results of the read-only verbs (*.get, *.get_text, *.get_tags,
+    *.get_components and the lookups) live for 'ttl' seconds, or for
+    ttls[verb] seconds if the verb is in the 'ttls' dictionary (0 does not
+    keep that verb at all); TestCaseRun.get is not kept unless 'ttls' says
+    so, as TestCaseRun.update does not name the case run by its ID. Once
+    there are more than 'max_entries' results, those closest to expiring
+    make room.
+
+    Every other verb is taken to change the object whose ID is its first
+    argument, or the ID field of its class in a first argument that is a
+    dictionary (such as 'case_id' for TestCase.update), and drops the
+    results of the same class for that ID, such as TestCase.get_tags(10)
+    after TestCase.add_tag(10, ...). A verb whose ID cannot be told drops
+    all the results of its class. Changes made by other clients show up
+    only once the results expire.
+
+    Results are kept apart by 'namespace', which Testopia sets to its URL
+    and username, so that instances sharing a file for different servers or
+    users never see each other's results.
+
+    Each thread and process opens its own connection. The file is in
+    write-ahead log mode, so readers do not wait for a writer; a write that
+    still finds the file locked is dropped, as the cache is only a shortcut.
+    '''
+    _EVICT_EVERY = 100 # puts between two checks of the size
+    # The field holding the object's ID, by verb prefix, when a verb takes
+    # a dictionary
+    ID_FIELDS = {'Build': 'build_id', 'Environment': 'environment_id',
+                 'TestopiaProduct': 'id', 'TestPlan': 'plan_id', 'TestCase': 'case_id',
+                 'TestRun': 'run_id', 'TestCaseRun': 'case_run_id'}
+
+    def __init__(self, filename, ttl=3600, ttls=None, max_entries=100000, namespace=''):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.filename = filename
+        self.namespace = namespace
+        self.ttl = ttl
+        self.ttls = {'TestCaseRun.get': 0}
+        self.ttls.update(ttls or {})
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._connection() # Fails early on a bad file name
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid(): # New thread, or a forked child
+            connection = self._sqlite3.connect(self.filename, timeout=10,
+                                               isolation_level=None)
+            connection.text_factory = str
+            try:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            except self._sqlite3.OperationalError:
+                pass # Left in the default journal mode, which still works
+            connection.execute("CREATE TABLE IF NOT EXISTS result ("
+                               "key TEXT PRIMARY KEY, class TEXT, obj_id INTEGER, "
+                               "expires REAL, value BLOB)")
+            connection.execute("CREATE INDEX IF NOT EXISTS result_obj "
+                               "ON result (class, obj_id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS result_expires "
+                               "ON result (expires)")
+            local.connection, local.pid, local.puts = connection, os.getpid(), 0
+        return local.connection
+
+    def caches(self, verb):
+        """Returns whether the results of verb are kept."""
+        return bool(_READ_ONLY_VERB.search(verb)) and self.ttls.get(verb, self.ttl) != 0
+
+    def _key(self, verb, args):
+        from hashlib import sha1
+        return sha1("%s\n%r" % (self.namespace, _command_key(verb, args))).hexdigest()
+
+    def get(self, verb, args, default=None):
+        """Returns the result kept for the command, or default if there is none."""
+        try:
+            row = self._connection().execute(
+                "SELECT value FROM result WHERE key = ? AND expires > ?",
+                (self._key(verb, args), _now())).fetchone()
+        except self._sqlite3.Error:
+            return default
+        if row is None:
+            return default
+        return xmlrpclib.loads(str(row[0]))[0][0]
+
+    def put(self, verb, args, value):
+        """Keeps the result of the command."""
+        ttl = self.ttls.get(verb, self.ttl)
+        if args and type(args[0]) is IntType:
+            obj_id = args[0]
+        else:
+            obj_id = None
+        blob = xmlrpclib.dumps((value,), methodresponse=True, allow_none=True)
+        try:
+            connection = self._connection()
+            connection.execute("INSERT OR REPLACE INTO result VALUES (?, ?, ?, ?, ?)",
+                               (self._key(verb, args), verb.split('.')[0], obj_id,
+                                _now() + ttl, self._sqlite3.Binary(blob)))
+            self._local.puts += 1
+            if self._local.puts % self._EVICT_EVERY == 0:
+                self._evict(connection)
+        except self._sqlite3.OperationalError:
+            pass # Locked for longer than the timeout
+
+    def _evict(self, connection):
+        connection.execute("DELETE FROM result WHERE expires <= ?", (_now(),))
+        excess = connection.execute("SELECT COUNT(*) FROM result").fetchone()[0] \
+                 - self.max_entries
+        if excess > 0:
+            connection.execute("DELETE FROM result WHERE key IN (SELECT key FROM result "
+                               "ORDER BY expires LIMIT ?)", (excess,))
+
+    def invalidate(self, verb, args):
+        """Drops the results that a command may have changed."""
+        cls = verb.split('.')[0]
+        obj_id = None
+        if args and type(args[0]) is IntType:
+            obj_id = args[0]
+        elif args and type(args[0]) is DictType:
+            obj_id = args[0].get(self.ID_FIELDS.get(cls))
+        try:
+            if type(obj_id) is IntType:
+                self._connection().execute(
+                    "DELETE FROM result WHERE class = ? AND obj_id = ?", (cls, obj_id))
+            else:
+                self._connection().execute("DELETE FROM result WHERE class = ?", (cls,))
+        except self._sqlite3.OperationalError:
+            pass
+
+    def clear(self):
+        """Drops every result."""
+        self._connection().execute("DELETE FROM result")
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM result").fetchone()[0]
+
+
+class TextHashes(object):
+    '''The content hash of each test case's text, by the version it is for.
+
+    testcase_store_texts() compares these hashes to skip the texts that did
+    not change. With a filename, the hashes are also appended to that file,
+    and read back from it by later instances.
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._hashes = {} # case_id -> (version, digest)
+        if filename is not None and os.path.exists(filename):
+            lines = 0
+            for line in open(filename):
+                fields = line.split()
+                lines += 1
+                if len(fields) == 3: # Else cut short when the last run stopped
+                    self._hashes[int(fields[0])] = (int(fields[1]), fields[2])
+            if lines > 2 * len(self._hashes) + 1000:
+                self._rewrite()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @staticmethod
+    def digest(setup=None, breakdown=None, action=None, expected_results=None):
+        """Returns the content hash of the four fields of a test case's text."""
+        from hashlib import sha1
+        return sha1('\0'.join([_utf8(field or '') for field in
+                                (setup, breakdown, action, expected_results)])).hexdigest()
+
+    def get(self, case_id, version):
+        """Returns the hash of that version of a test case's text, or None if it is not known."""
+        known = self._hashes.get(case_id)
+        if known is not None and known[0] == version:
+            return known[1]
+        return None
+
+    def put(self, case_id, version, digest):
+        """Holds the hash of that version of a test case's text."""
+        self._lock.acquire()
+        try:
+            if self._hashes.get(case_id) == (version, digest):
+                return
+            self._hashes[case_id] = (version, digest)
+            if self.filename is not None:
+                log = open(self.filename, 'a')
+                try:
+                    log.write("%d\t%d\t%s\n" % (case_id, version, digest))
+                finally:
+                    log.close()
+        finally:
+            self._lock.release()
+
+    def _rewrite(self):
+        log = open(self.filename + '.new', 'w')
+        try:
+            for case_id, (version, digest) in sorted(self._hashes.items()):
+                log.write("%d\t%d\t%s\n" % (case_id, version, digest))
+        finally:
+            log.close()
+        os.rename(self.filename + '.new', self.filename)
+
+    def clear(self):
+        """Drops every hash."""
+        self._lock.acquire()
+        try:
+            self._hashes = {}
+            if self.filename is not None and os.path.exists(self.filename):
+                os.remove(self.filename)
+        finally:
+            self._lock.release()
+
+
+def _cached_lookup(reverse=None):
+    """Makes a lookup method keep its results in the instance's cache.
+
+    'reverse' -- string, the name of the lookup method going the other way,
+                 such as 'build_lookup_name_by_id' for build_lookup_id_by_name;
+                 every result also fills in the entry for that method
+
+    Faults are not cached, and calls queued in a batch bypass the cache.
+    """
+    def decorate(method):
+        name = method.__name__
+        argnames = inspect.getargspec(method)[0][1:]
+        def lookup(self, *args, **kwargs):
+            if self._recording or self.cache is None:
+                return method(self, *args, **kwargs)
+            if kwargs:
+                args = args + tuple([kwargs.pop(n) for n in argnames[len(args):] if n in kwargs])
+            key = (name,) + args
+            value = self.cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = method(self, *args, **kwargs)
+                self.cache.put(key, value)
+                if reverse is not None and type(value) in (IntType, StringType, UnicodeType):
+                    self.cache.put((reverse, value), args[0])
+            if type(value) is DictType:
+                value = dict(value) # Callers may change it; the cache's copy stays put
+            return value
+        lookup.__name__ = name
+        lookup.__doc__ = method.__doc__
+        return lookup
+    return decorate
+
+
+class IdentityMap(object):
+    '''Holds one dictionary per Testopia entity, keyed by its kind and ID.
+
+    The kinds are the prefixes of the *_get methods: 'build', 'environment',
+    'product', 'testplan', 'testcase', 'testrun' and 'testcaserun'.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return sum([len(entities) for entities in self._entities.values()])
+
+    def clear(self):
+        """Drops every entity."""
+        self._entities = {} # kind -> {id: entity}
+
+    def get(self, kind, id, default=None):
+        """Returns the entity of that kind and ID, or default if there is none."""
+        return self._entities.get(kind, {}).get(id, default)
+
+    def put(self, kind, id, entity):
+        """Holds the entity of that kind and ID."""
+        self._lock.acquire()
+        try:
+            self._entities.setdefault(kind, {})[id] = entity
+        finally:
+            self._lock.release()
+
+    def discard(self, kind, id=None, **fields):
+        """Drops the entity of that kind and ID, or without an ID, the entities
+        whose items equal all the keyword arguments (all of that kind if none).
+        """
+        self._lock.acquire()
+        try:
+            entities = self._entities.get(kind, {})
+            if id is not None:
+                entities.pop(id, None)
+                return
+            for key, entity in entities.items():
+                for name, value in fields.items():
+                    if entity.get(name) != value:
+                        break
+                else:
+                    del entities[key]
+        finally:
+            self._lock.release()
+
+
+def _identity_get(kind):
+    """Makes a *_get method hand out the entity in the instance's identity map."""
+    def decorate(method):
+        def get(self, *args, **kwargs):
+            if self._recording or self.identities is None:
+                return method(self, *args, **kwargs)
+            id = (args + tuple(kwargs.values()))[0]
+            entity = self.identities.get(kind, id)
+            if entity is None:
+                entity = method(self, *args, **kwargs)
+                self.identities.put(kind, id, entity)
+            return entity
+        get.__name__ = method.__name__
+        get.__doc__ = method.__doc__
+        return get
+    return decorate
+
+def _invalidates(*targets):
+    """Makes a method that changes entities drop them from the identity map.
+
+    'targets' -- (kind, argument name) pairs, such as ('testcase', 'case_id');
+                 instead of a name, a tuple of names drops the entities whose
+                 items of those names equal the arguments
+
+    The entities are dropped even if the call fails, since the server may
+    have made some of the changes. In a batch, they are dropped once the
+    call has been sent, so that a read in between cannot bring them back.
+    """
+    def decorate(method):
+        argnames = inspect.getargspec(method)[0][1:]
+        def change(self, *args, **kwargs):
+            values = dict(zip(argnames, args))
+            values.update(kwargs)
+            def evict(identities):
+                for kind, names in targets:
+                    if type(names) is TupleType:
+                        identities.discard(kind, **dict(
+                            [(name, values[name]) for name in names]))
+                    elif values.get(names) is not None:
+                        identities.discard(kind, values[names])
+            if self._recording:
+                queued = len(self._queue)
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    for r in self._queue[queued:]:
+                        r._evictions.append(evict)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                if self.identities is not None:
+                    evict(self.identities)
+        change.__name__ = method.__name__
+        change.__doc__ = method.__doc__
+        return change
+    return decorate
+
+
+class BatchResult(object):
+    '''The result slot of a call queued in a TestopiaBatch.
+
+    The slot is filled when the batch is sent; result() then returns the
+    value of the call, or raises its own TestopiaXmlrpcError.
+    '''
+    def __init__(self, verb=None, args=None):
+        self.verb = verb
+        self.args = args
+        self.error = None
+        self._value = None
+        self._done = False
+        self._children = []
+        self._evictions = [] # Drop entities from the identity map once sent
+
+    def __getitem__(self, key):
+        # Methods such as build_lookup_id_by_name() index into the result of
+        # do_command(), so a slot hands out another slot for the item.
+        child = BatchResult(self.verb, self.args)
+        self._children.append((key, child))
+        if self._done:
+            self._fill_child(key, child)
+        return child
+
+    def _fill_child(self, key, child):
+        if self.error is not None:
+            child._set(None, self.error)
+        else:
+            try:
+                child._set(self._value[key], None)
+            except (KeyError, IndexError, TypeError), e:
+                child._set(None, TestopiaError("No item %r in the result of %s: %s"
+                                               % (key, self.verb, e)))
+
+    def _set(self, value, error):
+        self._value = value
+        self.error = error
+        self._done = True
+        for key, child in self._children:
+            self._fill_child(key, child)
+
+    def done(self):
+        """Returns True once the batch holding this call has been sent."""
+        return self._done
+
+    def result(self):
+        """Returns the value of the call, or raises the error it failed with."""
+        if not self._done:
+            raise TestopiaError("The batch holding %s has not been sent yet." % self.verb)
+        if self.error is not None:
+            raise self.error
+        return self._value
+
+
+class _CommandRecorder(object):
+    '''Stands in for a Testopia instance, queueing its commands instead of sending them.
+
+    Any Testopia method called through the recorder runs with the recorder
+    as 'self', so do_command() queues a BatchResult and everything else is
+    looked up on the real instance.
+    '''
+    _recording = True
+
+    def __init__(self, testopia):
+        self._testopia = testopia
+        self._queue = []
+
+    def __getattr__(self, name):
+        func = getattr(type(self._testopia), name, None)
+        if isinstance(func, MethodType) and func.im_self is None:
+            return MethodType(func.im_func, self, type(self))
+        return getattr(self._testopia, name)
+
+    def do_command(self, verb, args):
+        result = BatchResult(verb, args)
+        self._queue.append(result)
+        return result
+
+
+class TestopiaBatch(_CommandRecorder):
+    '''Queues calls to Testopia methods and sends them with system.multicall.
+
+    Use it through Testopia.batch():
+
+      with t.batch() as b:
+          r = b.testcaserun_update(1, 2, 3, 4, case_run_status_id=2)
+      print r.result()
+
+    The queued calls are sent when the 'with' block exits, in requests of at
+    most 'chunk_size' calls each. Each call gets its own BatchResult, so a
+    fault in one call does not affect the others. If the server has no
+    system.multicall, the calls are sent one at a time instead, from then
+    on; if system.multicall faults for another reason, only the calls of
+    that request are.
+    '''
+    def __init__(self, testopia, chunk_size=100):
+        _CommandRecorder.__init__(self, testopia)
+        if chunk_size < 1:
+            raise TestopiaError("The chunk size of a batch must be at least 1.")
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+        return False
+
+    def send(self):
+        """Sends all the queued calls and fills in their results."""
+        queue, self._queue = self._queue, []
+        for start in range(0, len(queue), self.chunk_size):
+            chunk = queue[start:start + self.chunk_size]
+            try:
+                self._send_chunk(chunk)
+            finally:
+                self._forget(chunk)
+
+    def _forget(self, chunk):
+        # Drops what the calls sent may have changed from the disk cache and
+        # the identity map, as do_command() and the *_update methods do for
+        # a single call; this runs even when sending failed, since the server
+        # may have made some of the changes
+        disk_cache = self._testopia.disk_cache
+        identities = self._testopia.identities
+        for r in chunk:
+            if disk_cache is not None and not _READ_ONLY_VERB.search(r.verb):
+                disk_cache.invalidate(r.verb, r.args)
+            if identities is not None:
+                for evict in r._evictions:
+                    evict(identities)
+
+    def _send_chunk(self, chunk, relogin=True):
+        testopia = self._testopia
+        if testopia._multicall_supported:
+            calls = [dict(methodName=r.verb, params=list(r.args)) for r in chunk]
+            generation = testopia._session_generation
+            try:
+                replies = testopia.server.system.multicall(calls)
+            except xmlrpclib.Fault, e:
+                if e.faultCode == LOGIN_REQUIRED_FAULT and relogin:
+                    testopia._relogin(generation)
+                    return self._send_chunk(chunk, relogin=False)
+                if _unknown_method_fault(e):
+                    testopia._multicall_supported = False
+            except xmlrpclib.Error, e:
+                raise TestopiaXmlrpcError('system.multicall', [calls], e)
+            else:
+                if len(replies) != len(chunk):
+                    # The replies cannot be matched up with the calls
+                    error = xmlrpclib.ResponseError(
+                        "system.multicall returned %d replies to %d calls"
+                        % (len(replies), len(chunk)))
+                    for r in chunk:
+                        r._set(None, TestopiaXmlrpcError(r.verb, r.args, error))
+                    return
+                expired = [] # The calls turned down for want of a login
+                for r, reply in zip(chunk, replies):
+                    if type(reply) is DictType:
+                        if reply['faultCode'] == LOGIN_REQUIRED_FAULT and relogin and \
+                           r.verb != "User.login":
+                            expired.append(r)
+                            continue
+                        fault = xmlrpclib.Fault(reply['faultCode'], reply['faultString'])
+                        r._set(None, TestopiaXmlrpcError(r.verb, r.args, fault))
+                    else:
+                        r._set(reply[0], None)
+                if expired:
+                    # The session expired, or came from a stale session
+                    # cache: log in again and send those calls once more
+                    testopia._relogin(generation)
+                    self._send_chunk(expired, relogin=False)
+                return
+        for r in chunk:
+            try:
+                r._set(testopia.do_command(r.verb, r.args), None)
+            except TestopiaXmlrpcError, e:
+                r._set(None, e)
+
+
+_INTERN_MAX = 32 # Strings up to this long are interned in records
+_INTERN_UNICODE_MAX = 4096 # The most unicode strings held for interning at once
+_interned_unicode = {}
+
+def _intern(value):
+    """Returns the one shared copy of a short string, or value itself."""
+    if type(value) is StringType:
+        if len(value) <= _INTERN_MAX:
+            return intern(value) # Freed by python once nothing else holds it
+    elif type(value) is UnicodeType:
+        if len(value) <= _INTERN_MAX:
+            interned = _interned_unicode.get(value)
+            if interned is None:
+                # Unicode strings cannot be weakly referenced, so rather than
+                # hold every one seen for ever, start over once there are many
+                if len(_interned_unicode) >= _INTERN_UNICODE_MAX:
+                    _interned_unicode.clear()
+                interned = _interned_unicode[value] = value
+            return interned
+    return value
+
+class Record(object):
+    '''A compact stand-in for a result dictionary of one entity type.
+
+    The fields the type usually has are kept in slots, so the keys are not
+    stored per row, and short strings such as status names and dates are
+    interned. Any other keys go in a dictionary of their own. Records can
+    be read and changed like dictionaries: r['case_id'], r.get('notes'),
+    r.keys(), r.items() and dict(r.items()) all work.
+    '''
+    __slots__ = ('_extra',)
+    _fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, values):
+        extra = None
+        fields = self._field_set
+        for key, value in values.iteritems():
+            value = _intern(value)
+            if key in fields:
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._extra = extra
+
+    @classmethod
+    def from_dicts(cls, rows):
+        """Returns the records of a list of dictionaries, or rows itself if it is not a list."""
+        if type(rows) is not ListType:
+            return rows
+        return [cls(row) for row in rows]
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self):
+        keys = [key for key in self._fields if hasattr(self, key)]
+        if self._extra is not None:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, DictType)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(self.items()))
+
+def _record_type(name, fields):
+    """Makes a Record subclass with a slot for each of the fields."""
+    return type(name, (Record,), dict(__slots__=fields, _fields=fields,
+                                      _field_set=frozenset(fields)))
+
+TestCaseRunRecord = _record_type('TestCaseRunRecord', (
+    'case_run_id', 'run_id', 'case_id', 'build_id', 'environment_id',
+    'case_run_status_id', 'case_text_version', 'assignee', 'testedby',
+    'running_date', 'close_date', 'notes', 'iscurrent', 'sortkey', 'priority_id'))
+TestCaseRecord = _record_type('TestCaseRecord', (
+    'case_id', 'summary', 'alias', 'case_status_id', 'category_id', 'priority_id',
+    'author_id', 'default_tester_id', 'creation_date', 'estimated_time',
+    'isautomated', 'sortkey', 'script', 'arguments', 'requirement'))
+TestRunRecord = _record_type('TestRunRecord', (
+    'run_id', 'plan_id', 'build_id', 'environment_id', 'product_version',
+    'plan_text_version', 'manager_id', 'summary', 'notes', 'start_date',
+    'stop_date', 'target_pass', 'target_completion'))
+TestPlanRecord = _record_type('TestPlanRecord', (
+    'plan_id', 'product_id', 'author_id', 'type_id', 'default_product_version',
+    'name', 'creation_date', 'isactive'))
+BuildRecord = _record_type('BuildRecord', (
+    'build_id', 'product_id', 'name', 'description', 'milestone', 'isactive'))
+EnvironmentRecord = _record_type('EnvironmentRecord', (
+    'environment_id', 'product_id', 'name', 'isactive'))
+
+# The record type of the rows each list verb returns, for compact_results
+_RECORD_TYPES = {
+    'TestCaseRun.list': TestCaseRunRecord,
+    'TestRun.get_test_case_runs': TestCaseRunRecord,
+    'TestCase.list': TestCaseRecord,
+    'TestPlan.get_test_cases': TestCaseRecord,
+    'TestRun.get_test_cases': TestCaseRecord,
+    'TestRun.list': TestRunRecord,
+    'TestPlan.get_test_runs': TestRunRecord,
+    'Environment.get_runs': TestRunRecord,
+    'TestPlan.list': TestPlanRecord,
+    'TestCase.get_plans': TestPlanRecord,
+    'TestopiaProduct.get_builds': BuildRecord,
+    'Environment.list': EnvironmentRecord,
+    'TestopiaProduct.get_environments': EnvironmentRecord,
+    }
+
+
+def _factorize(column):
+    """Returns the distinct values of a NumPy column, and the index in them of each item."""
+    low, high = column.min(), column.max()
+    if low >= 0 and high - low < max(len(column), 1 << 16):
+        # Small values: number them by their offset, without sorting
+        present = numpy.zeros(high - low + 1, dtype=bool)
+        present[column - low] = True
+        numbers = numpy.cumsum(present) - 1
+        return numpy.flatnonzero(present) + low, numbers[column - low]
+    return numpy.unique(column, return_inverse=True)
+
+class ResultFrame(object):
+    '''Integer columns of a list of results, for counting and filtering in bulk.
+
+    Each field is held in a typed array: a NumPy array when NumPy is
+    installed, else an array.array of C longs. A missing or None value is
+    held as 0. With NumPy, filters, counts and joins work on whole columns
+    and take milliseconds for a million rows; without it, they take about
+    as long as a loop in Python, but the columns still take 8 bytes a value.
+
+      frame = ResultFrame.from_rows(t.iter_testcaserun_list(run_id=10))
+      failed = frame.filter(case_run_status_id=3)
+      print failed.count_by('build_id', 'environment_id')
+    '''
+    CASE_RUN_FIELDS = ('case_run_id', 'case_id', 'build_id', 'environment_id',
+                       'case_run_status_id', 'assignee', 'testedby')
+
+    def __init__(self, columns, fields=None):
+        """'columns' -- dictionary, an array of integers for each field name
+        'fields' -- list, the order of the fields, optional
+        """
+        self.fields = tuple(fields or sorted(columns.keys()))
+        self._columns = {}
+        for field in self.fields:
+            column = columns[field]
+            if numpy is not None and not isinstance(column, numpy.ndarray):
+                if not isinstance(column, array):
+                    column = array('l', column)
+                column = numpy.frombuffer(column, dtype=numpy.dtype('l'))
+            elif numpy is None and not isinstance(column, array):
+                column = array('l', column)
+            self._columns[field] = column
+        lengths = set([len(column) for column in self._columns.values()])
+        if len(lengths) > 1:
+            raise TestopiaError("The columns of a ResultFrame must be of the same length.")
+
+    @classmethod
+    def from_rows(cls, rows, fields=CASE_RUN_FIELDS):
+        """Makes a frame of some integer fields of result rows.
+
+        'rows' -- iterable of dictionaries or Records, read once
+        'fields' -- list, the names of the integer fields to keep
+        """
+        columns = [array('l') for field in fields]
+        appends = zip(fields, [column.append for column in columns])
+        for row in rows:
+            for field, append in appends:
+                append(row.get(field) or 0)
+        return cls(dict(zip(fields, columns)), fields)
+
+    def __len__(self):
+        if not self.fields:
+            return 0
+        return len(self._columns[self.fields[0]])
+
+    def __getitem__(self, field):
+        """Returns the column of a field."""
+        return self._columns[field]
+
+    def rows(self):
+        """Returns the rows of the frame as dictionaries."""
+        columns = [self._columns[field] for field in self.fields]
+        if numpy is not None:
+            columns = [column.tolist() for column in columns]
+        return [dict(zip(self.fields, values)) for values in izip(*columns)]
+
+    def _select(self, selectors):
+        # Keeps the rows whose selector is true: a NumPy mask, or a list of booleans
+        if numpy is not None:
+            return ResultFrame(dict([(field, column[selectors])
+                                     for field, column in self._columns.items()]),
+                               self.fields)
+        return ResultFrame(dict([(field, array('l', compress(column, selectors)))
+                                 for field, column in self._columns.items()]),
+                           self.fields)
+
+    def filter(self, **conditions):
+        """Returns a frame of the rows whose fields have the given values.
+
+        Each keyword names a field, with a value it must equal or a list,
+        tuple or set of values it must be one of.
+
+        Example: frame.filter(build_id=12, case_run_status_id=[2, 3])
+        """
+        selectors = None
+        for field, value in conditions.items():
+            column = self._columns[field]
+            if type(value) in (ListType, TupleType, set, frozenset):
+                if numpy is not None and len(value) <= 8:
+                    selected = numpy.zeros(len(column), dtype=bool)
+                    for item in value:
+                        selected |= column == item
+                elif numpy is not None:
+                    selected = numpy.in1d(column, list(value))
+                else:
+                    selected = map(frozenset(value).__contains__, column)
+            else:
+                if numpy is not None:
+                    selected = column == value
+                else:
+                    selected = map(partial(operator.eq, value), column)
+            if selectors is None:
+                selectors = selected
+            elif numpy is not None:
+                selectors = selectors & selected
+            else:
+                selectors = map(operator.and_, selectors, selected)
+        if selectors is None:
+            return self
+        return self._select(selectors)
+
+    def count_by(self, *fields):
+        """Counts the rows for each value of some fields.
+
+        Example: frame.count_by('case_run_status_id') returns {2: 950, 3: 50};
+                 frame.count_by('build_id', 'case_run_status_id') returns
+                 {(12, 2): 900, (12, 3): 40, (13, 2): 50, (13, 3): 10}
+
+        Result: A dictionary of counts, keyed by the value of the field, or by
+        a tuple of the values of the fields
+        """
+        columns = [self._columns[field] for field in fields]
+        if not columns or not len(self):
+            return {}
+        if numpy is not None:
+            # Number the rows by their combination of values, then count
+            # the numbers: with bincount when there are few enough of them
+            uniques, codes, size = [], None, 1
+            for column in columns:
+                unique, inverse = _factorize(column)
+                uniques.append(unique)
+                size *= len(unique)
+                if codes is None:
+                    codes = inverse
+                else:
+                    codes = codes * len(unique) + inverse
+            if size <= max(len(codes), 1 << 16):
+                counts = numpy.bincount(codes, minlength=size)
+                codes = numpy.flatnonzero(counts)
+                counts = counts[codes]
+            else:
+                codes, counts = numpy.unique(codes, return_counts=True)
+            indexes = numpy.unravel_index(codes, [len(unique) for unique in uniques])
+            keys = zip(*[unique[index].tolist() for unique, index in zip(uniques, indexes)])
+            counts = counts.tolist()
+        elif len(columns) == 1 and len(set(columns[0])) <= 64:
+            keys = [(key,) for key in set(columns[0])]
+            counts = [columns[0].count(key) for key, in keys]
+        else:
+            tally = {}
+            for key in izip(*columns):
+                tally[key] = tally.get(key, 0) + 1
+            keys, counts = tally.keys(), tally.values()
+        if len(fields) == 1:
+            keys = [key[0] for key in keys]
+        return dict(zip(keys, counts))
+
+    def join(self, other, on, fields=None):
+        """Returns a frame of the rows of this frame that have a match in another
+        frame, with the fields of the matching row of the other frame added.
+
+        'other' -- ResultFrame, whose 'on' field holds each value at most once
+        'on' -- string, the field to match the rows by
+        'fields' -- list, the fields of 'other' to add; all the ones this frame
+                    does not have if None
+
+        Example: caseRuns.join(cases, 'case_id', ['category_id', 'priority_id'])
+        """
+        if fields is None:
+            fields = [field for field in other.fields if field not in self._columns]
+        keys, other_keys = self._columns[on], other[on]
+        if numpy is not None:
+            if len(other_keys) and other_keys.min() >= 0 \
+                   and other_keys.max() < max(len(keys), len(other_keys), 1 << 16):
+                # Small keys: look the rows up in a table indexed by key
+                table = numpy.empty(other_keys.max() + 1, dtype=numpy.intp)
+                table.fill(-1)
+                table[other_keys] = numpy.arange(len(other_keys))
+                inside = (keys >= 0) & (keys < len(table))
+                positions = numpy.where(inside, table[numpy.where(inside, keys, 0)], -1)
+                matched = positions >= 0
+                rows = positions[matched]
+            else:
+                order = numpy.argsort(other_keys, kind='mergesort')
+                sorted_keys = other_keys[order]
+                positions = numpy.searchsorted(sorted_keys, keys)
+                positions[positions == len(sorted_keys)] = 0
+                if len(sorted_keys):
+                    matched = sorted_keys[positions] == keys
+                else:
+                    matched = numpy.zeros(len(keys), dtype=bool)
+                rows = order[positions[matched]]
+            columns = dict([(field, column[matched])
+                            for field, column in self._columns.items()])
+            for field in fields:
+                columns[field] = other[field][rows]
+        else:
+            index = dict(izip(other_keys, xrange(len(other_keys))))
+            positions = map(index.get, keys)
+            matched = map(operator.is_not, positions, repeat(None, len(positions)))
+            rows = list(compress(positions, matched))
+            columns = dict([(field, array('l', compress(column, matched)))
+                            for field, column in self._columns.items()])
+            for field in fields:
+                columns[field] = array('l', map(other[field].__getitem__, rows))
+        return ResultFrame(columns, self.fields + tuple(fields))
+
+
+def _utf8(value):
+    """Returns value with its unicode strings, also inside lists and dictionaries, encoded as UTF-8."""
+    if type(value) is UnicodeType:
+        return value.encode('utf-8')
+    if type(value) is ListType:
+        return [_utf8(item) for item in value]
+    if type(value) is DictType:
+        return dict([(_utf8(key), _utf8(item)) for key, item in value.items()])
+    return value
+
+def _testcase_rows(source, format=None):
+    """Yields the test cases of a CSV or NDJSON file as dictionaries, reading one row at a time.
+
+    'source' -- string, the name of the file, or a file object
+    'format' -- string, 'csv' or 'ndjson'; taken from the file name if None,
+                '.csv' meaning CSV and anything else NDJSON
+
+    A CSV file has a header row naming the columns; empty cells are left out.
+    An NDJSON file has one JSON object per line.
+    """
+    import csv, json
+    if isinstance(source, basestring):
+        f = open(source, 'rb')
+    else:
+        f = source
+    if format is None:
+        if getattr(f, 'name', '').lower().endswith('.csv'):
+            format = 'csv'
+        else:
+            format = 'ndjson'
+    try:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield dict([(key, value) for key, value in row.items() if value])
+        else:
+            for line in f:
+                if line.strip():
+                    yield _utf8(json.loads(line))
+    finally:
+        if f is not source:
+            f.close()
+
+
+def _junit_testcases(source, max_notes=4000):
+    """Yields the test cases of a JUnit XML report as (classname, name, outcome,
+    message) tuples, reading the file a piece at a time.
+
+    'source' -- string, the name of the file, or a file object
+    'max_notes' -- integer, the most characters of a failure message to keep
+
+    'outcome' is 'passed', 'failure', 'error' or 'skipped', and 'message' the
+    message (or else the text) of the failure, error or skipped element, if any.
+    Each testcase element is dropped from the tree once read, so reports of
+    any size take little memory.
+    """
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+    path = [] # The elements from the root to the current one
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(element)
+            continue
+        path.pop()
+        if element.tag.rsplit('}', 1)[-1] != 'testcase':
+            continue
+        outcome, message = 'passed', None
+        for child in element:
+            tag = child.tag.rsplit('}', 1)[-1]
+            if tag in ('failure', 'error', 'skipped'):
+                outcome = tag
+                message = (child.get('message') or child.text or '').strip()[:max_notes] or None
+                break
+        yield (_utf8(element.get('classname', '')), _utf8(element.get('name', '')),
+               outcome, _utf8(message))
+        element.clear()
+        if path:
+            path[-1].remove(element)
+
+
 class Testopia(object):
 
     view_all=True # By default, a list returns at most 25 elements. We force here to see all.
+    _recording=False # True on the stand-ins that queue commands for a batch
+    _multicall_supported=True # Cleared once the server turns system.multicall down
+    _session_generation=0 # Bumped on every login, so that threads log in again only once
+    cache=None # The LookupCache of the lookup methods
+    identities=None # The IdentityMap of the *_get methods, if there is one
+    disk_cache=None # The DiskCache of the read-only verbs, if there is one
+    _in_flight=None # The _InFlightCall of each read-only command being sent
+    compact_results=False # Return the rows of list verbs as Records instead of dictionaries
+    text_hashes=None # The TextHashes of testcase_store_texts()
 
     # (this decorator will require python 2.4 or later)
     @classmethod
@@ -276,77 +1836,172 @@ class Testopia(object):
           password: jdoepassword'
           url: https://myhost.mycompany.com/bugzilla/tr_xmlrpc.cgi
 
+        The stanza may also hold optional 'pool_size', 'compress_threshold',
+        'session_cache', 'cache_ttl', 'cache_size', 'identity_map',
+        'disk_cache', 'disk_cache_ttl', 'disk_cache_size',
+        'compact_results' and 'text_hashes' fields, see __init__().
+
         we can write scripts that avoid embedding user credentials in the
         source code:
           t = Testopia.from_config('config.txt')
           print t.environment_list()
         """
-        from ConfigParser import SafeConfigParser
-        cp = SafeConfigParser()
-        cp.read([filename])
-        kwargs = dict([(key, cp.get('testopia', key)) \
-                       for key in ['username', 'password', 'url']])
-        return Testopia(**kwargs)
+        return Testopia(**_read_config(filename))
     
-    def __init__(self, username, password, url):
+    def __init__(self, username, password, url, pool_size=1, compress_threshold=None,
+                 session_cache=None, cache_ttl=300, cache_size=1024, identity_map=False,
+                 disk_cache=None, disk_cache_ttl=3600, disk_cache_size=100000,
+                 compact_results=False, text_hashes=None):
         """Initialize the Testopia driver.
 
         'username' -- string, the account to log into Testopia such as jdoe@mycompany.com,
         'password' -- string, the password for the username,
         'url' -- string, the URL of the XML-RPC interface 
+        'pool_size' -- integer, how many idle connections to keep open, optional
+        'compress_threshold' -- integer, gzip request bodies longer than this, optional
+        'session_cache' -- string, a directory to keep the login session in between
+                           runs, or True for ~/.testopia/sessions, optional
+        'cache_ttl' -- integer, how many seconds lookup results are kept, optional
+        'cache_size' -- integer, how many lookup results are kept; 0 turns the
+                        lookup cache off, optional
+        'identity_map' -- boolean, keep the results of the *_get methods, optional
+        'disk_cache' -- string, an SQLite file to keep the results of read-only
+                        verbs in, optional
+        'disk_cache_ttl' -- integer, how many seconds they are kept, optional
+        'disk_cache_size' -- integer, how many of them are kept, optional
+        'compact_results' -- boolean, return the rows of lists as Records, optional
+        'text_hashes' -- string, a file to keep the hashes of the test case
+                         texts stored in, optional
+
+        The instance may be shared between threads; set 'pool_size' to the
+        number of threads so that each can keep its own connection alive.
+
+        With a 'session_cache', the Bugzilla cookies and user ID are saved in a
+        file only the owner can read, and later instances for the same url and
+        username reuse them instead of logging in. Whenever the server turns
+        the session down, the driver logs in again and retries the command.
+
+        The results of the *_lookup_* and *_check_by_name methods are kept in
+        the LookupCache 't.cache' (see t.cache.stats() and t.cache.clear()). A
+        name to ID lookup also fills in the ID to name entry, and the other
+        way around.
+
+        With an 'identity_map', each *_get method asks the server for an ID
+        only once, and then returns the same dictionary for it: do not change
+        it. The methods that change an entity, such as testcase_update() or
+        testrun_add_tag(), drop it from 't.identities', so that the next
+        *_get fetches it again.
+
+        With a 'disk_cache', the results of the read-only verbs are kept in a
+        DiskCache, 't.disk_cache', which any number of processes can share.
+        Set t.disk_cache.ttls[verb] to keep a verb for a different time.
+
+        With 'compact_results', the rows of the list verbs (*_list(),
+        testrun_get_test_case_runs(), product_get_builds(), ... and their
+        iter_* methods) come back as Records, such as TestCaseRunRecord,
+        which take a fraction of the memory of dictionaries but are used
+        the same way. Calls sent in a batch still return dictionaries.
+
+        The hashes testcase_store_texts() compares to skip the texts that
+        did not change are kept in 't.text_hashes', and with 'text_hashes'
+        in that file as well, so that a later run knows the texts it stored.
 
         Example: t = Testopia('jdoe@mycompany.com', 
                               'jdoepassword'
                               'https://myhost.mycompany.com/bugzilla/tr_xmlrpc.cgi')
         """
         if url.startswith('https://'):
-            self._transport = SafeCookieTransport()
+            self._transport = SafeCookieTransport(pool_size=pool_size)
         elif url.startswith('http://'):
-            self._transport = CookieTransport()
+            self._transport = CookieTransport(pool_size=pool_size)
         else:
             raise "Unrecognized URL scheme"
-        self._transport.cookiejar = CookieJar()
+        self._transport.encode_threshold = compress_threshold
+        if session_cache:
+            self._transport.cookiejar = SessionCookieJar(
+                _session_filename(session_cache, url, username))
+        else:
+            self._transport.cookiejar = CookieJar()
         # print "COOKIES:", self._transport.cookiejar._cookies
         self.server = xmlrpclib.ServerProxy(url,
                                             transport = self._transport,
                                             verbose = VERBOSE)
-
-
+        self._host, self._handler = urllib.splithost(urllib.splittype(url)[1])
+        self._username = username
+        self._password = password
+        self._login_lock = threading.Lock()
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.cache = LookupCache(ttl=cache_ttl, max_size=cache_size)
+        if identity_map:
+            self.identities = IdentityMap()
+        self.compact_results = compact_results
+        self.text_hashes = TextHashes(text_hashes)
+        if disk_cache:
+            self.disk_cache = DiskCache(disk_cache, ttl=disk_cache_ttl,
+                                        max_entries=disk_cache_size,
+                                        namespace="%s\n%s" % (url, username))
+
+        self.userId = None
+        if session_cache:
+            try:
+                self._transport.cookiejar.load()
+                self.userId = self._transport.cookiejar.user_id
+            except (IOError, ValueError):
+                pass # No session yet, or a damaged one
+        if self.userId is None:
+            self._login()
+
+    def _login(self):
         # Login, get a cookie into our cookie jar:
-        loginDict = self.do_command("User.login", [dict(login=username,
-                                                        password=password)])
+        loginDict = self.do_command("User.login", [dict(login=self._username,
+                                                        password=self._password)])
         # Record the user ID in case the script wants this
         self.userId = loginDict['id']
         # print 'Logged in with cookie for user %i' % self.userId
         # print "COOKIES:", self._transport.cookiejar._cookies
+        cookiejar = self._transport.cookiejar
+        if isinstance(cookiejar, SessionCookieJar):
+            cookiejar.user_id = self.userId
+            self._transport.flush_cookies()
+
+    def _relogin(self, generation):
+        """Logs in again, unless another thread did since 'generation'."""
+        self._login_lock.acquire()
+        try:
+            if self._session_generation == generation:
+                self._login()
+                self._session_generation = generation + 1
+        finally:
+            self._login_lock.release()
 
     def _boolean_option(self, option, value):
-        """Returns the boolean option when value is True or False, else ''
+        """Returns the boolean option when value is True or False, else {}
 
-        Example: _boolean_option('isactive', True) returns " 'isactive': 1,"
+        Example: _boolean_option('isactive', True) returns {'isactive': 1}
         """
         if value or str(value) == 'False':
             if type(value) is not BooleanType:
                 raise TestopiaError("The value for the option '%s' is not of boolean type." % option)
             elif value == False:
-                return "\'%s\':0, " % option
+                return {option: 0}
             elif value == True:
-                return "\'%s\':1, " % option
-        return ''
+                return {option: 1}
+        return {}
 
 
     def _datetime_option(self, option, value):
-        """Returns the string 'option': 'value' where value is a date object formatted
-        in string as yyyy-mm-dd hh:mm:ss. If value is None, then we return ''.
+        """Returns the dictionary {'option': 'value'} where value is a date object formatted
+        in string as yyyy-mm-dd hh:mm:ss. If value is None, then we return {}.
 
-        Example: self._time_option('datetime', datetime(2007,12,05,13,01,03))
-        returns "'datetime': '2007-12-05 13:01:03'"
+        Example: self._datetime_option('datetime', datetime(2007,12,05,13,01,03))
+        returns {'datetime': '2007-12-05 13:01:03'}
         """
         if value:
             if type(value) is not type(datetime(2000,01,01,12,00,00)):
                 raise TestopiaError("The option '%s' is not a valid datetime object." % option)
-            return "\'%s\':\'%s\', " % (option, value.strftime("%Y-%m-%d %H:%M:%S"))
-        return ''
+            return {option: value.strftime("%Y-%m-%d %H:%M:%S")}
+        return {}
 
 
     def _list_dictionary_option(self, option, value):
@@ -363,98 +2018,101 @@ class Testopia(object):
                 for item in value:
                     if type(item) is not DictType:
                         raise TestopiaError("The option '%s' is not a valid list of dictionaries." % option)
-            return "\'%s\': %s" % (option, value)
-        return ''
+            return {option: value}
+        return {}
 
     _list_dict_op = _list_dictionary_option
 
 
     def _number_option(self, option, value):
-        """Returns the string " 'option': value," if value is not None, else ''
+        """Returns the dictionary {'option': value} if value is not None, else {}
 
-        Example: self._number_option("isactive", 1) returns " 'isactive': 1,"
+        Example: self._number_option("isactive", 1) returns {'isactive': 1}
         """
         if value:
             if type(value) is not IntType:
                 raise TestopiaError("The option '%s' is not a valid integer." % option)
-            return "\'%s\':%d, " % (option, value)
-        return ''
+            return {option: value}
+        return {}
 
 
     def _number_no_option(self, number):
-        """Returns the number in number. Just a totally useless wrapper :-)
+        """Returns the number in number, after checking that it is an integer.
 
         Example: self._number_no_option(1) returns 1
         """
         if type(number) is not IntType:
             raise TestopiaError("The 'number' parameter is not an integer.")
-        return str(number)
+        return number
 
     _number_noop = _number_no_option
 
 
     def _options_dict(self, *args):
-        """Creates a wrapper around all the options into a dictionary format.
+        """Merges all the options into a single dictionary.
 
-        Example, if args is ['isactive': 1,", 'description', 'Voyage project'], then
-        the return will be {'isactive': 1,", 'description', 'Voyage project'}
+        Example, if args is [{'isactive': 1}, {'description': 'Voyage project'}], then
+        the return will be {'isactive': 1, 'description': 'Voyage project'}
         """
-        return "{%s}" % ''.join(args)
+        options = {}
+        for arg in args:
+            options.update(arg)
+        return options
 
 
     def _options_non_empty_dict(self, *args):
-        """Creates a wrapper around all the options into a dictionary format and
+        """Merges all the options into a single dictionary and
         verifies that the dictionary is not empty.
 
-        Example, if args is ['isactive': 1,", 'description', 'Voyage project'], then
-        the return will be {'isactive': 1,", 'description', 'Voyage project'}.
+        Example, if args is [{'isactive': 1}, {'description': 'Voyage project'}], then
+        the return will be {'isactive': 1, 'description': 'Voyage project'}.
         If args is empty, then we raise an error.
         """
         if not args:
             raise TestopiaError, "At least one variable must be set."
-        return "{%s}" % ''.join(args)
+        return self._options_dict(*args)
 
     _options_ne_dict = _options_non_empty_dict
 
 
     def _string_option(self, option, value):
-        """Returns the string 'option': 'value'. If value is None, then ''
+        """Returns the dictionary {'option': 'value'}. If value is None, then {}
 
         Example: self._string_option('description', 'Voyage project') returns
-        "'description' : 'Voyage project',"
+        {'description': 'Voyage project'}
         """
         if value:
             if type(value) is not StringType:
                 raise TestopiaError("The option '%s' is not a valid string." % option)
-            return "\'%s\':\'%s\', " % (option, value)
-        return ''
+            return {option: value}
+        return {}
 
 
     def _string_no_option(self, option):
-        """Returns the string 'option'.
+        """Returns the string 'option', or '' if it is None.
 
-        Example: self._string_no_option("description") returns "'description'"
+        Example: self._string_no_option("description") returns "description"
         """
         if option:
             if type(option) is not StringType:
                 raise TestopiaError("The option '%s' is not a valid string." % option)
-            return "\'%s\'" % option
+            return option
         return ''
 
     _string_noop = _string_no_option
 
 
     def _time_option(self, option, value):
-        """Returns the string 'option': 'value' where value is a time object formatted in string as hh:mm:ss.
-        If value is None, then we return ''.
+        """Returns the dictionary {'option': 'value'} where value is a time object formatted in string as hh:mm:ss.
+        If value is None, then we return {}.
 
-        Example: self._time_option('time', time(12,00,03)) returns "'time': '12:00:03'"
+        Example: self._time_option('time', time(12,00,03)) returns {'time': '12:00:03'}
         """
         if value:
             if type(value) is not type(time(12,00,00)):
                 raise TestopiaError("The option '%s' is not a valid time object." % option)
-            return "\'%s\':\'%s\', " % (option, value.strftime("%H:%M:%S"))
-        return ''
+            return {option: value.strftime("%H:%M:%S")}
+        return {}
 
 
     def _validate_search_operation_string(self, option, operation):
@@ -475,15 +2133,12 @@ class Testopia(object):
             'allwords',
             'nowords',
         """
-        VALID_SEARCH_OPERATIONS = ['equals', 'notequals', 'isnull',
-                'isnotnull', 'lessthan', 'greaterthan', 'regexp',
-                'notregexp', 'anywords', 'allwords', 'nowords',]
         if operation:
-            if operation not in VALID_SEARCH_OPERATIONS:
+            if operation not in _SEARCH_OPERATIONS:
                 raise TestopiaError("Not a valid search operation.")
             else:
-                return "\'%s\':\'%s\', " % (option, operation)
-        return ''
+                return {option: operation}
+        return {}
 
     _search_op = _validate_search_operation_string
 
@@ -493,23 +2148,441 @@ class Testopia(object):
 
         'verb' -- string, the xmlrpc verb,
         'args' -- list, the argument list,
+
+        The arguments are handed to xmlrpclib as they are, so they are
+        marshalled straight to XML without any intermediate Python source.
+
+        When threads send the same read-only command (such as TestPlan.get
+        or Product.check_product) at the same time, only the first one goes
+        to the server; the others wait for it and share its result, or its
+        error.
         """
-        params = ''
-        for arg in args:
-            params = ("%s" % str(arg), "%s, %s" % (params, str(arg)))[params!='']
-        cmd = "self.server." + verb + "(" + params + ")"
+        if _READ_ONLY_VERB.search(verb):
+            if self._in_flight is None:
+                return self._read_command(verb, args)
+            return self._shared_read_command(verb, args)
+        if self.disk_cache is None:
+            value = self._send_command(verb, args)
+        else:
+            try:
+                value = self._send_command(verb, args)
+            finally:
+                self.disk_cache.invalidate(verb, args)
+        if self.compact_results and verb in _RECORD_TYPES:
+            return _RECORD_TYPES[verb].from_dicts(value)
+        return value
+
+    def _shared_read_command(self, verb, args):
+        return self._single_flight(_command_key(verb, args), self._read_command, verb, args)
+
+    def _single_flight(self, key, function, *args):
+        # Calls function(*args), unless another thread is already calling it
+        # for the same key, in which case this waits for that call's outcome
+        self._in_flight_lock.acquire()
+        try:
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = _InFlightCall()
+                leader = True
+            else:
+                leader = False
+        finally:
+            self._in_flight_lock.release()
+        if not leader:
+            # A copy, as the leader's caller may change its own
+            return _shallow_copy(call.wait())
+        try:
+            try:
+                call.value = function(*args)
+                return call.value
+            except:
+                call.exc_info = sys.exc_info()
+                raise
+        finally:
+            self._in_flight_lock.acquire()
+            try:
+                del self._in_flight[key]
+            finally:
+                self._in_flight_lock.release()
+            call.done()
+
+    def _read_command(self, verb, args):
+        disk_cache = self.disk_cache
+        if disk_cache is None or not disk_cache.caches(verb):
+            return self._send_command(verb, args)
+        value = disk_cache.get(verb, args, _MISSING)
+        if value is _MISSING:
+            value = self._send_command(verb, args)
+            disk_cache.put(verb, args, value)
+        return value
+
+    def _send_command(self, verb, args):
         if DEBUG:
-            print cmd
+            print "%s(%s)" % (verb, ', '.join([repr(arg) for arg in args]))
         #from pprint import pprint
         #pprint(self.server._ServerProxy__transport.cookiejar._cookies)
+        generation = self._session_generation
         try:
-            return eval(cmd)
+            try:
+                return getattr(self.server, verb)(*args)
+            except xmlrpclib.Fault, e:
+                if e.faultCode != LOGIN_REQUIRED_FAULT or verb == "User.login":
+                    raise
+            # The session expired, or came from a stale session cache
+            self._relogin(generation)
+            return getattr(self.server, verb)(*args)
         except xmlrpclib.Error, e:
-            raise TestopiaXmlrpcError(verb, params, e)
-        
+            raise TestopiaXmlrpcError(verb, args, e)
+
+    def do_command_iter(self, verb, args):
+        """Submit a command to the server, and parse the response as it arrives.
+
+        'verb' -- string, the xmlrpc verb,
+        'args' -- list, the argument list,
+
+        Result: A generator of the items of the list the command returns, each
+        yielded as soon as it has been parsed
+        """
+        if DEBUG:
+            print "%s(%s)" % (verb, ', '.join([repr(arg) for arg in args]))
+        request_body = xmlrpclib.dumps(tuple(args), verb)
+        generation = self._session_generation
+        record = None
+        if self.compact_results:
+            record = _RECORD_TYPES.get(verb)
+        try:
+            try:
+                for item in self._transport.iter_request(self._host, self._handler,
+                                                         request_body, VERBOSE):
+                    if record is not None:
+                        item = record(item)
+                    yield item
+                return
+            except xmlrpclib.Fault, e:
+                # A fault comes before any item, so the command can be retried
+                if e.faultCode != LOGIN_REQUIRED_FAULT:
+                    raise
+            self._relogin(generation)
+            for item in self._transport.iter_request(self._host, self._handler,
+                                                     request_body, VERBOSE):
+                if record is not None:
+                    item = record(item)
+                yield item
+        except xmlrpclib.Error, e:
+            raise TestopiaXmlrpcError(verb, args, e)
+
+    def _command_for(self, method_name, *args, **kwargs):
+        """Returns the (verb, args) that a method would send, without sending it."""
+        recorder = _CommandRecorder(self)
+        getattr(recorder, method_name)(*args, **kwargs)
+        command = recorder._queue[0]
+        return command.verb, command.args
+
+    def _iter_list(self, method_name, args, kwargs):
+        """Runs the iter_*_list() methods: 'kwargs' may hold 'page_size' and
+        'prefetch' besides the arguments of the *_list() method."""
+        page_size = kwargs.pop('page_size', None)
+        prefetch = kwargs.pop('prefetch', False)
+        verb, command_args = self._command_for(method_name, *args, **kwargs)
+        if page_size is None:
+            return self.do_command_iter(verb, command_args)
+        return self._iter_pages(verb, command_args[0], page_size, prefetch)
+
+    def _iter_pages(self, verb, query, page_size, prefetch=False):
+        """Yields the rows of a list verb, asking for one page of them at a time.
+
+        Pages count from 0, and the last page is the first one shorter than
+        'page_size'. With 'prefetch', the next page is asked for on another
+        connection while the rows of the current one are consumed.
+        """
+        query = dict(query)
+        query.pop('viewall', None)
+        query['pagesize'] = page_size
+        def fetch(page):
+            return self.do_command(verb, [dict(query, page=page)])
+        if prefetch:
+            pool = self._start_workers(1)
+            start = lambda page: pool.apply_async(fetch, (page,)).get
+        else:
+            pool = None
+            start = lambda page: lambda: fetch(page)
+        try:
+            page = 0
+            next_rows = start(page)
+            while next_rows is not None:
+                rows = next_rows()
+                if len(rows) < page_size:
+                    next_rows = None
+                else:
+                    page += 1
+                    next_rows = start(page)
+                for row in rows:
+                    yield row
+        finally:
+            if pool is not None:
+                self._stop_workers(pool, 1)
+
+    def batch(self, chunk_size=100):
+        """Start a batch of calls, to be sent with system.multicall.
+
+        'chunk_size' -- integer, the most calls to send in a single request
+
+        Example: with t.batch() as b:
+                     results = [b.testcase_get(id) for id in [1, 2, 3]]
+                 print [r.result() for r in results]
+
+        Result: A TestopiaBatch; calling a Testopia method on it returns a BatchResult
+        """
+        return TestopiaBatch(self, chunk_size)
+
+    def transfer_stats(self):
+        """Get the byte counts of the traffic so far.
+
+        Example: transfer_stats()
+
+        Result: A dictionary with the request bytes sent ('bytes_sent'), and the
+        response bytes received on the wire ('bytes_received') and after
+        decompression ('bytes_decoded')
+        """
+        return dict(bytes_sent=self._transport.bytes_sent,
+                    bytes_received=self._transport.bytes_received,
+                    bytes_decoded=self._transport.bytes_decoded)
+
+    def _start_workers(self, workers):
+        """Returns a ThreadPool of 'workers' threads, with the connection pool
+        grown to keep a connection for each until _stop_workers()."""
+        self._transport.reserve(workers)
+        return ThreadPool(workers)
+
+    def _stop_workers(self, pool, workers):
+        """Waits for the threads of a pool from _start_workers(), and shrinks
+        the connection pool back."""
+        pool.close()
+        pool.join()
+        self._transport.release(workers)
+
+    def map(self, method_name, iterable_of_args, workers=4, ordered=True):
+        """Call a method once per item of an iterable, on a pool of worker threads.
+
+        'method_name' -- string, the name of a Testopia method such as 'testcase_get'
+        'iterable_of_args' -- iterable, the arguments for each call: a tuple or
+                              list of positional arguments, a dictionary of
+                              keyword arguments, or else a single argument
+        'workers' -- integer, the number of calls to run at once
+        'ordered' -- boolean, yield results in the order of the arguments;
+                     otherwise they are yielded as soon as they arrive
+
+        Each worker gets its own connection of the same login: the connection
+        pool keeps 'workers' connections while the calls run. The iterable is read
+        lazily, a few items per worker ahead of the results.
+
+        Example: for args, case, error in t.map('testcase_get', caseIds, workers=16):
+                     ...
+
+        Result: A generator of (args, result, error) tuples; 'error' is the exception
+        raised by that call or None, and 'result' is None when it failed.
+        """
+        method = getattr(self, method_name)
+        def call(args):
+            try:
+                if type(args) is DictType:
+                    return args, method(**args), None
+                elif type(args) in (TupleType, ListType):
+                    return args, method(*args), None
+                return args, method(args), None
+            except Exception, e:
+                return args, None, e
+
+        pool = self._start_workers(workers)
+        # The pool reads the iterable as fast as it can, so hold it back to
+        # a few items per worker ahead of what the caller has consumed.
+        slots = threading.Semaphore(workers * 4)
+        stopped = []
+        def feed():
+            for args in iterable_of_args:
+                slots.acquire()
+                if stopped:
+                    return
+                yield args
+        try:
+            if ordered:
+                results = pool.imap(call, feed())
+            else:
+                results = pool.imap_unordered(call, feed())
+            for item in results:
+                slots.release()
+                yield item
+        finally:
+            stopped.append(True)
+            slots.release()
+            self._stop_workers(pool, workers)
+
+    def get_many(self, kind, ids, chunk_size=100):
+        """Get several entities of one kind by ID, in batches.
+
+        'kind' -- string, the prefix of a *_get method, such as 'testcase'
+        'ids' -- list, the IDs to get
+        'chunk_size' -- integer, the most calls to send in a single request
+
+        With an identity map, only the IDs it does not hold are asked for,
+        and the answers are added to it.
+
+        Example: get_many('testcase', [1, 2, 3])
+
+        Result: A list of the dictionaries, in the order of the IDs; if any
+        of them failed, its TestopiaXmlrpcError is raised
+        """
+        found = {}
+        if self.identities is not None:
+            for id in ids:
+                entity = self.identities.get(kind, id)
+                if entity is not None:
+                    found[id] = entity
+        misses = [id for id in OrderedDict.fromkeys(ids) if id not in found]
+        with self.batch(chunk_size) as b:
+            results = [getattr(b, kind + '_get')(id) for id in misses]
+        for id, r in zip(misses, results):
+            if r.error is None:
+                found[id] = r.result()
+                if self.identities is not None:
+                    self.identities.put(kind, id, r.result())
+        for r in results:
+            r.result() # Raises the first error
+        return [found[id] for id in ids]
+
+    def _remember_lookup(self, id_method, name_method, id, name, scope=(), ttl=None):
+        # Fills in a lookup in both directions, as if both methods had been called
+        self.cache.put((name_method, id), name, ttl)
+        self.cache.put((id_method, name) + scope, id, ttl)
+
+    # The lookup methods filled in by _ensure(), for each kind
+    _ENSURE_LOOKUPS = {
+        'build': ('build_lookup_id_by_name', 'build_lookup_name_by_id'),
+        'environment': ('testrun_lookup_environment_id_by_name',
+                        'testrun_lookup_environment_name_by_id'),
+        }
+
+    def _ensure(self, kind, name, product_id, create):
+        """Returns the build or environment of that name, calling create() if there is none."""
+        if self._recording:
+            raise TestopiaError("ensure_%s() cannot be sent in a batch." % kind)
+        check = getattr(self, kind + '_check_by_name')
+        key = (kind + '_check_by_name', name, product_id)
+        def found():
+            try:
+                entity = check(name, product_id)
+            except TestopiaXmlrpcError:
+                return None
+            if not entity:
+                self.cache.discard(key) # An empty answer, not worth keeping
+                return None
+            return entity
+        def resolve():
+            entity = found()
+            if entity is None:
+                try:
+                    entity = create()
+                except TestopiaXmlrpcError:
+                    # Another client may have created it since the check
+                    entity = found()
+                    if entity is None:
+                        raise
+                if type(entity) is not DictType:
+                    entity = getattr(self, kind + '_get')(entity)
+                self.cache.put(key, entity)
+            id_method, name_method = self._ENSURE_LOOKUPS[kind]
+            self._remember_lookup(id_method, name_method, entity[kind + '_id'], name,
+                                  (product_id,), self.cache.ttl)
+            return dict(entity)
+        return self._single_flight(('ensure', kind, name, product_id), resolve)
+
+    def preload(self, product_id=None, max_id=16, ttl=None):
+        """Fetch the reference values that hardly ever change, and cache them.
+
+        'product_id' -- integer, also fetch the builds, environments and
+                        milestones of this product, and the categories of its
+                        test plans
+        'max_id' -- integer, the highest status, priority and plan type ID
+                    to ask for
+        'ttl' -- integer, how many seconds the values stay cached; None
+                 keeps them until the cache is cleared
+
+        Case-run statuses, case statuses, priorities and plan types are
+        fetched in one system.multicall, and the product's values in two
+        more. Afterwards the lookup methods for them, such as
+        testcaserun_lookup_status_id_by_name() and build_lookup_id_by_name(),
+        answer from the cache in both directions.
+
+        Example: preload(product_id=2)
+
+        Result: A dictionary of what was fetched: 'case_run_statuses',
+        'case_statuses', 'priorities' and 'plan_types' map IDs to names;
+        'builds', 'environments' and 'milestones' are lists of dictionaries,
+        and 'categories' maps each plan ID to its list of Category dictionaries
+        """
+        enumerations = [
+            ('case_run_statuses', 'testcaserun_lookup_status_id_by_name',
+                                  'testcaserun_lookup_status_name_by_id'),
+            ('case_statuses', 'testcase_lookup_status_id_by_name',
+                              'testcase_lookup_status_name_by_id'),
+            ('priorities', 'testcase_lookup_priority_id_by_name',
+                           'testcase_lookup_priority_name_by_id'),
+            ('plan_types', 'testplan_lookup_type_id_by_name',
+                           'testplan_lookup_type_name_by_id'),
+            ]
+        ids = range(1, max_id + 1)
+        with self.batch() as b:
+            probes = [[getattr(b, name_method)(id) for id in ids]
+                      for key, id_method, name_method in enumerations]
+        loaded = {}
+        for (key, id_method, name_method), results in zip(enumerations, probes):
+            loaded[key] = {}
+            for id, r in zip(ids, results):
+                # Unknown IDs fault, or come back as an empty name
+                if r.error is None and r.result():
+                    loaded[key][id] = r.result()
+                    self._remember_lookup(id_method, name_method, id, r.result(), ttl=ttl)
+        if product_id is None:
+            return loaded
+
+        with self.batch() as b:
+            builds = b.product_get_builds(product_id)
+            environments = b.product_get_environments(product_id)
+            milestones = b.product_get_milestones(product_id)
+            plans = b.testplan_list(product_id=product_id)
+        loaded['builds'] = builds.result()
+        loaded['environments'] = environments.result()
+        loaded['milestones'] = milestones.result()
+        scope = (product_id,)
+        for build in loaded['builds']:
+            self.cache.put(('build_check_by_name', build['name']) + scope, build, ttl)
+            self._remember_lookup('build_lookup_id_by_name', 'build_lookup_name_by_id',
+                                  build['build_id'], build['name'], scope, ttl)
+        for environment in loaded['environments']:
+            self.cache.put(('environment_check_by_name', environment['name']) + scope,
+                           environment, ttl)
+            self._remember_lookup('testrun_lookup_environment_id_by_name',
+                                  'testrun_lookup_environment_name_by_id',
+                                  environment['environment_id'], environment['name'],
+                                  scope, ttl)
+
+        plan_ids = [plan['plan_id'] for plan in plans.result()]
+        with self.batch() as b:
+            categories = [b.testplan_get_categories(plan_id) for plan_id in plan_ids]
+        loaded['categories'] = {}
+        for plan_id, r in zip(plan_ids, categories):
+            loaded['categories'][plan_id] = r.result()
+            for category in r.result():
+                self._remember_lookup('testcase_lookup_category_id_by_name',
+                                      'testcase_lookup_category_name_by_id',
+                                      category['category_id'], category['name'],
+                                      ttl=ttl)
+        return loaded
+
     ############################## Build #######################################
 
 
+    @_identity_get('build')
     def build_get(self, build_id):
         """Get A Build by ID.
 
@@ -545,6 +2618,32 @@ class Testopia(object):
                    )])
 
 
+    def ensure_build(self, name, product_id, description=None, milestone=None,
+                     isactive=None):
+        """Get A Build By Its Name, Creating It If There Is None.
+
+        'name' -- string, required value
+        'product_id' -- integer, required value
+        'description' -- string, for a new build, optional
+        'milestone' -- string, for a new build, optional
+        'isactive' -- boolean, for a new build, optional
+
+        The build is looked up with build_check_by_name(), from the cache if
+        it is there, and created only if that fails. Threads ensuring the
+        same build wait for the first one instead of asking again; if the
+        create fails because another client created the build meanwhile,
+        that build is looked up and returned instead.
+
+        Example: ensure_build('pipeline-1234', 1)
+
+        Result: A dictionary representing the build
+        """
+        return self._ensure('build', name, product_id,
+                            lambda: self.build_create(name, product_id, description,
+                                                      milestone, isactive))
+
+
+    @_invalidates(('build', 'build_id'))
     def build_update(self, build_id, name=None, description=None, milestone=None,
                      isactive=None):
         """Update An Existing Build.
@@ -573,6 +2672,7 @@ class Testopia(object):
                    )])
 
 
+    @_cached_lookup(reverse='build_lookup_name_by_id')
     def build_lookup_id_by_name(self, name, product_id):
         """Lookup A Build ID By Its Name.
 
@@ -584,10 +2684,12 @@ class Testopia(object):
         """
         return self.build_check_by_name(name, product_id)['build_id']
 
+    @_cached_lookup()
     def build_check_by_name(self, name, product_id):
         return self.do_command("Build.check_build", [self._string_noop(name),
                                                      self._number_noop(product_id)])
 
+    @_cached_lookup()
     def build_lookup_name_by_id(self, id):
         """Lookup A Build Name By Its ID.
 
@@ -603,6 +2705,7 @@ class Testopia(object):
     ############################## Environment ##################################
 
 
+    @_identity_get('environment')
     def environment_get(self, environment_id):
         """Get An Environment by ID
 
@@ -639,6 +2742,7 @@ class Testopia(object):
                    self._boolean_option('viewall', self.view_all),
                    )])
 
+    @_cached_lookup()
     def environment_check_by_name(self, name, product_id):
         return self.do_command("Environment.check_environment", 
                                               [self._string_noop(name),
@@ -662,6 +2766,25 @@ class Testopia(object):
                    )])
 
 
+    def ensure_environment(self, name, product_id, isactive=True):
+        """Get An Environment By Its Name, Creating It If There Is None.
+
+        'name' -- string,
+        'product_id' -- integer,
+        'isactive' -- boolean, for a new environment, optional
+
+        Works as ensure_build() does, with environment_check_by_name() and
+        environment_create().
+
+        Example: ensure_environment('Linux x86_64', 1)
+
+        Result: A dictionary representing the environment
+        """
+        return self._ensure('environment', name, product_id,
+                            lambda: self.environment_create(product_id, isactive, name))
+
+
+    @_invalidates(('environment', 'environment_id'))
     def environment_update(self, environment_id, name, product_id, isactive):
         """Update An Existing Environment.
 
@@ -696,10 +2819,12 @@ class Testopia(object):
 
     ############################## Product ##################################
 
+    @_identity_get('product')
     def product_get(self, product_id):
         return self.do_command("TestopiaProduct.get", [self._number_noop(product_id)])
 
 #TAG: not working
+    @_cached_lookup(reverse='product_lookup_name_by_id')
     def product_lookup_id_by_name(self, name):
         """Lookup A Product ID By Its Name.
 
@@ -713,9 +2838,11 @@ class Testopia(object):
         prodDict = self.do_command('TestopiaProduct.check_product', [self._string_noop(name)])
         return prodDict['id']
 
+    @_cached_lookup()
     def product_check_by_name(self, name):
         return self.do_command("TestopiaProduct.check_product", [self._string_noop(name)])
 
+    @_cached_lookup(reverse='product_lookup_id_by_name')
     def product_lookup_name_by_id(self, product_id):
         """Lookup A Product Name By Its ID.
 
@@ -768,6 +2895,7 @@ class Testopia(object):
 
     ############################## User ##################################
 
+    @_cached_lookup(reverse='user_lookup_login_by_id')
     def user_lookup_id_by_login(self, login):
         """Lookup A User ID By Its Login.
 
@@ -780,6 +2908,7 @@ class Testopia(object):
         return self.do_command("User.lookup_id_by_login", [self._string_noop(login)])
 
 
+    @_cached_lookup(reverse='user_lookup_id_by_login')
     def user_lookup_login_by_id(self, id):
         """Lookup A Login By Its ID.
 
@@ -795,6 +2924,7 @@ class Testopia(object):
     ############################## TestPlan ##################################
 
 
+    @_identity_get('testplan')
     def testplan_get(self, plan_id):
         """Get A TestPlan by ID.
 
@@ -859,6 +2989,24 @@ class Testopia(object):
                    )])
 
 
+    def iter_testplan_list(self, *args, **kwargs):
+        """Iterate Over A List of TestPlans Based on A Query.
+
+        Takes the same arguments as testplan_list(), but parses the response as it
+        arrives, so that only one TestPlan at a time is held in memory.
+
+        'page_size' -- integer, ask for this many TestPlans at a time instead
+                       of all of them at once, optional
+        'prefetch' -- boolean, ask for the next page while the current one is
+                      consumed, optional
+
+        Example: for plan in iter_testplan_list(product_id=2, page_size=500):
+
+        Result: A generator of TestPlan dictionaries
+        """
+        return self._iter_list('testplan_list', args, kwargs)
+
+
     def testplan_create(self, name, product_id, author_id, type_id, default_product_version, isactive=None):
         """Create A New TestPlan.
 
@@ -883,6 +3031,7 @@ class Testopia(object):
                    )])
 
 
+    @_invalidates(('testplan', 'plan_id'))
     def testplan_update(self, plan_id, name, product_id, type_id, product_version, isactive):
         """Update An Existing TestPlan.
 
@@ -958,6 +3107,7 @@ class Testopia(object):
         return self.do_command("TestPlan.get_test_runs", [self._number_noop(plan_id)])
 
 
+    @_invalidates(('testplan', 'plan_id'))
     def testplan_add_tag(self, plan_id, tag_name):
         """Get A List of Test Runs For An Existing Test Plan.
 
@@ -973,6 +3123,7 @@ class Testopia(object):
                    ])
 
 
+    @_invalidates(('testplan', 'plan_id'))
     def testplan_remove_tag(self, plan_id, tag_name):
         """Get A List of Test Runs For An Existing Test Plan.
 
@@ -1000,6 +3151,7 @@ class Testopia(object):
         return self.do_command("TestPlan.get_tags", [self._number_noop(plan_id)])
 
 
+    @_cached_lookup(reverse='testplan_lookup_type_name_by_id')
     def testplan_lookup_type_id_by_name(self, name):
         """Lookup A TestPlan Type ID By Its Name.
 
@@ -1012,6 +3164,7 @@ class Testopia(object):
         return self.do_command("TestPlan.lookup_type_id_by_name", [self._string_noop(name)])
 
 
+    @_cached_lookup(reverse='testplan_lookup_type_id_by_name')
     def testplan_lookup_type_name_by_id(self, id):
         """Lookup A TestPlan Type Name By Its ID.
 
@@ -1027,6 +3180,7 @@ class Testopia(object):
     ############################## TestCase ##################################
 
 
+    @_identity_get('testcase')
     def testcase_get(self, case_id):
         """Get A TestCase by ID.
 
@@ -1139,6 +3293,24 @@ class Testopia(object):
                    )])
 
 
+    def iter_testcase_list(self, *args, **kwargs):
+        """Iterate Over A List of TestCases Based on A Query.
+
+        Takes the same arguments as testcase_list(), but parses the response as it
+        arrives, so that only one TestCase at a time is held in memory.
+
+        'page_size' -- integer, ask for this many TestCases at a time instead
+                       of all of them at once, optional
+        'prefetch' -- boolean, ask for the next page while the current one is
+                      consumed, optional
+
+        Example: for case in iter_testcase_list(plans=[{'plan_id': 10}], page_size=500):
+
+        Result: A generator of TestCase dictionaries
+        """
+        return self._iter_list('testcase_list', args, kwargs)
+
+
     def testcase_create(self, summary, plan_id, author_id, isautomated, category_id, case_status_id,
                         alias=None, arguments=None, default_tester_id=None, priority_id=None,
                         requirement=None, script=None, sortkey=None, estimated_time=None):
@@ -1181,6 +3353,153 @@ class Testopia(object):
                    )])
 
 
+    # The fields of an imported test case that hold numbers, and those that
+    # may be given by name instead, with the lookup method for the name
+    _IMPORT_NUMBER_FIELDS = ['plan_id', 'author_id', 'category_id', 'case_status_id',
+                             'default_tester_id', 'priority_id', 'sortkey']
+    _IMPORT_NAME_FIELDS = [('category', 'category_id', 'testcase_lookup_category_id_by_name'),
+                           ('case_status', 'case_status_id', 'testcase_lookup_status_id_by_name'),
+                           ('priority', 'priority_id', 'testcase_lookup_priority_id_by_name')]
+    _IMPORT_TEXT_FIELDS = ['setup', 'breakdown', 'action', 'expected_results']
+
+    def _import_arguments(self, row):
+        """Returns the testcase_create() keyword arguments, testcase_store_text()
+        keyword arguments, tag names and component IDs of an imported row."""
+        row = dict(row)
+        for name, field, method in self._IMPORT_NAME_FIELDS:
+            if name in row:
+                row[field] = getattr(self, method)(row.pop(name))
+        for field in self._IMPORT_NUMBER_FIELDS:
+            if field in row:
+                row[field] = int(row[field])
+        row.setdefault('author_id', self.userId)
+        isautomated = row.get('isautomated', False)
+        if type(isautomated) is not BooleanType:
+            isautomated = str(isautomated).lower() in ('1', 'true', 'yes')
+        row['isautomated'] = isautomated
+        text = dict([(field, row.pop(field)) for field in self._IMPORT_TEXT_FIELDS
+                     if field in row])
+        tags = row.pop('tags', [])
+        if type(tags) is StringType:
+            tags = [tag.strip() for tag in tags.split(',') if tag.strip()]
+        components = row.pop('components', [])
+        if type(components) is StringType:
+            components = [component for component in components.split(',')
+                          if component.strip()]
+        components = [int(component) for component in components]
+        return row, text, tags, components
+
+    def import_testcases(self, source, checkpoint=None, format=None, defaults=None,
+                         workers=8):
+        """Create the test cases listed in a CSV or NDJSON file.
+
+        'source' -- string, the name of the file, or a file object
+        'checkpoint' -- string, a file recording the progress, to resume from, optional
+        'format' -- string, 'csv' or 'ndjson'; by default '.csv' files are
+                    CSV and others NDJSON, optional
+        'defaults' -- dictionary, values for the fields a row leaves out, optional
+        'workers' -- integer, the number of test cases to import at once
+
+        Each row holds the testcase_create() arguments by name ('summary',
+        'plan_id', 'category_id', ...), where 'category', 'case_status' and
+        'priority' may be given by name instead of ID. It may also hold the
+        testcase_store_text() fields ('setup', 'breakdown', 'action' and
+        'expected_results'), 'tags' and 'components' (component IDs); in a
+        CSV file, these two are comma-separated. 'author_id' defaults to the
+        logged-in user.
+
+        The file is read as the import goes. Each test case is created, and
+        then its text, tags and components are added in one
+        system.multicall; 'workers' test cases go through this at once.
+
+        With a 'checkpoint', every created and every finished test case is
+        appended to that file. Run again with the same file and checkpoint,
+        the import skips the rows it finished, and finishes the rows whose
+        test case it created, without creating them again.
+
+        Example: for row, case_id, error in t.import_testcases('cases.csv',
+                                                               checkpoint='cases.done'):
+                     if error:
+                         print row, error
+
+        Result: A generator of (row, case_id, error) tuples in the order of the
+        file, with 'row' counting the rows from 1; 'error' is the exception
+        raised for that row or None, and 'case_id' is None if the test case
+        was not created.
+        """
+        created = {}
+        finished = set()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            for line in open(checkpoint):
+                fields = line.split()
+                if len(fields) != 3:
+                    continue # Cut short when the last run stopped
+                if fields[2] == 'done':
+                    finished.add(int(fields[0]))
+                else:
+                    created[int(fields[0])] = int(fields[1])
+        lock = threading.Lock()
+        if checkpoint is not None:
+            log = open(checkpoint, 'a')
+        else:
+            log = None
+        def note(number, case_id, state):
+            if log is None:
+                return
+            lock.acquire()
+            try:
+                log.write("%d\t%d\t%s\n" % (number, case_id, state))
+                log.flush()
+            finally:
+                lock.release()
+
+        def import_row(number, row):
+            case_id = created.get(number)
+            try:
+                arguments, text, tags, components = self._import_arguments(row)
+                if case_id is None:
+                    case = self.testcase_create(**arguments)
+                    if type(case) is DictType:
+                        case_id = case['case_id']
+                    else:
+                        case_id = case
+                    note(number, case_id, 'created')
+                with self.batch() as b:
+                    results = []
+                    if text:
+                        results.append(b.testcase_store_text(case_id, arguments['author_id'],
+                                                             **text))
+                    results.extend([b.testcase_add_tag(case_id, tag) for tag in tags])
+                    results.extend([b.testcase_add_component(case_id, component)
+                                    for component in components])
+                for r in results:
+                    r.result() # Raises the first error
+                note(number, case_id, 'done')
+                return number, case_id, None
+            except (TestopiaError, TestopiaXmlrpcError, TypeError, ValueError), e:
+                return number, case_id, e
+
+        pool = self._start_workers(workers)
+        try:
+            pending = []
+            for number, row in enumerate(_testcase_rows(source, format)):
+                number += 1
+                if number in finished:
+                    continue
+                if defaults:
+                    row = dict(defaults, **row)
+                pending.append(pool.apply_async(import_row, (number, row)))
+                if len(pending) > workers * 2:
+                    yield pending.pop(0).get()
+            for result in pending:
+                yield result.get()
+        finally:
+            self._stop_workers(pool, workers)
+            if log is not None:
+                log.close()
+
+
+    @_invalidates(('testcase', 'case_id'))
     def testcase_update(self, case_id, summary=None, isautomated=None,
                    category_id=None, case_status_id=None,
                    alias=None, arguments=None, priority_id=None,
@@ -1234,8 +3553,9 @@ class Testopia(object):
         return self.do_command("TestCase.get_text", [self._number_noop(case_id)])
 
 
+    @_invalidates(('testcase', 'case_id'))
     def testcase_store_text(self, case_id, author_id, setup=None, breakdown=None,
-                   action=None, expected_results=None):
+                   action=None, expected_results=None, if_changed=False):
         """Add A New TestCase Action/Effect Document.
 
         setup, breakdown, action, expected
@@ -1245,12 +3565,21 @@ class Testopia(object):
         'breakdown' -- string, optional
         'action' -- string, optional
         'expected_results' -- string, optional
+        'if_changed' -- boolean, store the document only if it differs from
+                        the current one, see testcase_store_texts(), optional
 
         Example: testcase_store_text(1, 1, 'New Setup', 'New Breakdown', 'New Action', '
         New Expected results')
 
-        Result: The new document version on success
+        Result: The new document version on success; with 'if_changed', the
+        current version if the document did not change
         """
+        if if_changed:
+            if self._recording:
+                raise TestopiaError("testcase_store_text(if_changed=True) cannot be sent in a batch.")
+            return self.testcase_store_texts(author_id, [dict(
+                case_id=case_id, setup=setup, breakdown=breakdown,
+                action=action, expected_results=expected_results)])[case_id]
         return self.do_command("TestCase.store_text", [self._number_noop(case_id), # This is the proper order
                    self._number_noop(author_id),
                    self._string_noop(action),
@@ -1260,6 +3589,65 @@ class Testopia(object):
                    ])
 
 
+    def testcase_store_texts(self, author_id, texts, chunk_size=100):
+        """Store the TestCase Action/Effect Documents that changed.
+
+        'author_id' -- integer,
+        'texts' -- iterable of dictionaries, each holding a 'case_id' and the
+                   'setup', 'breakdown', 'action' and 'expected_results' of
+                   that TestCase, as testcase_store_text() takes them
+        'chunk_size' -- integer, the most calls per system.multicall
+
+        The current documents are fetched with system.multicall, and a text
+        is stored only if the hash of its four fields differs from the hash
+        of the current version. The hash of each version stored is kept in
+        't.text_hashes', so that a text the server reformats is not taken as
+        changed the next time.
+
+        Example: testcase_store_texts(1, [{'case_id': 1, 'action': 'Boot', 'expected_results': 'Up'}])
+
+        Result: A dictionary of the current document version of each TestCase,
+        by case_id
+        """
+        hashes = self.text_hashes
+        versions = {}
+        texts = iter(texts)
+        while True:
+            chunk = list(islice(texts, chunk_size * 10))
+            if not chunk:
+                return versions
+            with self.batch(chunk_size) as b:
+                documents = [b.testcase_get_text(text['case_id']) for text in chunk]
+            changed = []
+            for text, document in zip(chunk, documents):
+                document = document.result()
+                if type(document) is not DictType:
+                    document = {} # No text stored yet: version 0
+                case_id, version = text['case_id'], int(document.get('version') or 0)
+                digest = TextHashes.digest(text.get('setup'), text.get('breakdown'),
+                                           text.get('action'), text.get('expected_results'))
+                current = hashes.get(case_id, version) or TextHashes.digest(
+                    document.get('setup'), document.get('breakdown'),
+                    document.get('action'), document.get('effect'))
+                if digest == current:
+                    versions[case_id] = version
+                    hashes.put(case_id, version, digest)
+                else:
+                    changed.append((text, digest))
+            if not changed:
+                continue
+            with self.batch(chunk_size) as b:
+                stored = [(text['case_id'], digest, b.testcase_store_text(
+                               text['case_id'], author_id, text.get('setup'),
+                               text.get('breakdown'), text.get('action'),
+                               text.get('expected_results')))
+                          for text, digest in changed]
+            for case_id, digest, version in stored:
+                version = int(version.result())
+                versions[case_id] = version
+                hashes.put(case_id, version, digest)
+
+
     def testcase_get_bugs(self, case_id):
         """Get a list of bugs for the given TestCase.
 
@@ -1272,6 +3660,7 @@ class Testopia(object):
         return self.do_command("TestCase.get_bugs", [self._number_noop(case_id)])
 
 
+    @_invalidates(('testcase', 'case_id'))
     def testcase_add_component(self, case_id, component_id):
         """Add a component to the given TestCase.
 
@@ -1286,6 +3675,7 @@ class Testopia(object):
                    self._number_noop(component_id)])
 
 
+    @_invalidates(('testcase', 'case_id'))
     def testcase_remove_component(self, case_id, component_id):
         """Remove a component from the given TestCase.
 
@@ -1312,6 +3702,7 @@ class Testopia(object):
         return self.do_command("TestCase.get_components", [self._number_noop(case_id)])
 
 
+    @_invalidates(('testcase', 'case_id'))
     def testcase_add_tag(self, case_id, tag_name):
         """Add a tag to the given TestCase.
 
@@ -1326,6 +3717,7 @@ class Testopia(object):
                    self._string_noop(tag_name)])
 
 
+    @_invalidates(('testcase', 'case_id'))
     def testcase_remove_tag(self, case_id, tag_name):
         """Remove a tag from the given TestCase.
 
@@ -1364,6 +3756,7 @@ class Testopia(object):
         return self.do_command("TestCase.get_plans", [self._number_noop(case_id)])
 
 #TAG: not working
+    @_cached_lookup(reverse='testcase_lookup_category_name_by_id')
     def testcase_lookup_category_id_by_name(self, name):
         """Lookup A TestCase Category ID By Its Name.
 
@@ -1376,6 +3769,7 @@ class Testopia(object):
         return self.do_command("TestopiaProduct.check_category", [self._string_noop(name)])
 
 
+    @_cached_lookup(reverse='testcase_lookup_category_id_by_name')
     def testcase_lookup_category_name_by_id(self, id):
         """Lookup A TestCase Category Name By Its ID.
 
@@ -1389,6 +3783,7 @@ class Testopia(object):
         return self.do_command("TestopiaProduct.get_category", [self._number_noop(id)])['name']
 
 
+    @_cached_lookup(reverse='testcase_lookup_priority_name_by_id')
     def testcase_lookup_priority_id_by_name(self, name):
         """Lookup A TestCase Priority ID By Its Name.
 
@@ -1401,6 +3796,7 @@ class Testopia(object):
         return self.do_command("TestCase.lookup_priority_id_by_name", [self._string_noop(name)])
 
 
+    @_cached_lookup(reverse='testcase_lookup_priority_id_by_name')
     def testcase_lookup_priority_name_by_id(self, id):
         """Lookup A TestCase Category Name By Its ID.
 
@@ -1414,6 +3810,7 @@ class Testopia(object):
         return self.do_command("TestCase.lookup_priority_name_by_id", [self._number_noop(id)])
 
 
+    @_cached_lookup(reverse='testcase_lookup_status_name_by_id')
     def testcase_lookup_status_id_by_name(self, name):
         """Lookup A TestCase Status ID By Its Name.
 
@@ -1426,6 +3823,7 @@ class Testopia(object):
         return self.do_command("TestCase.lookup_status_id_by_name", [self._string_noop(name)])
 
 
+    @_cached_lookup(reverse='testcase_lookup_status_id_by_name')
     def testcase_lookup_status_name_by_id(self, id):
         """Lookup A TestCase Category Name By Its ID.
 
@@ -1439,6 +3837,7 @@ class Testopia(object):
         return self.do_command("TestCase.lookup_status_name_by_id", [self._number_noop(id)])
 
 
+    @_invalidates(('testcase', 'case_id'), ('testplan', 'plan_id'))
     def testcase_link_plan(self, case_id, plan_id):
         """Link A TestPlan To An Existing TestCase.
 
@@ -1454,6 +3853,7 @@ class Testopia(object):
                    ])
 
 
+    @_invalidates(('testcase', 'case_id'), ('testplan', 'plan_id'))
     def testcase_unlink_plan(self, case_id, plan_id):
         """Unlink A TestPlan From An Existing TestCase.
 
@@ -1471,6 +3871,7 @@ class Testopia(object):
     ############################## TestRun ##################################
 
 
+    @_identity_get('testrun')
     def testrun_get(self, run_id):
         """Get A TestRun by ID.
 
@@ -1525,7 +3926,7 @@ class Testopia(object):
 
         Result: A list of TestCase dictionaries
         """
-        return self.do_command("TestCase.list", [self._options_ne_dict(
+        return self.do_command("TestRun.list", [self._options_ne_dict(
                    self._number_option('run_id', run_id),
                    self._search_op('runid_type', run_id_type),
                    self._number_option('build_id', build_id),
@@ -1553,6 +3954,24 @@ class Testopia(object):
                    )])
 
 
+    def iter_testrun_list(self, *args, **kwargs):
+        """Iterate Over A List of TestRuns Based on A Query.
+
+        Takes the same arguments as testrun_list(), but parses the response as it
+        arrives, so that only one TestRun at a time is held in memory.
+
+        'page_size' -- integer, ask for this many TestRuns at a time instead
+                       of all of them at once, optional
+        'prefetch' -- boolean, ask for the next page while the current one is
+                      consumed, optional
+
+        Example: for run in iter_testrun_list(plan_id=10, page_size=500):
+
+        Result: A generator of TestRun dictionaries
+        """
+        return self._iter_list('testrun_list', args, kwargs)
+
+
     def testrun_create(self, build_id, environment_id,
                    plan_id, summary, manager_id, plan_text_version=0,
                    notes=None, product_version='unspecified'):
@@ -1583,6 +4002,7 @@ class Testopia(object):
                    )])
 
 
+    @_invalidates(('testrun', 'run_id'))
     def testrun_update(self, run_id, status_id,build_id=None, 
                    environment_id=None,
                    manager_id=None, plan_text_version=None, summary=None,
@@ -1638,6 +4058,96 @@ class Testopia(object):
         return self.do_command("TestRun.get_test_case_runs", [self._number_noop(run_id)])
 
 
+    # What testrun_snapshot() can fetch along with the test case runs
+    SNAPSHOT_INCLUDES = ('cases', 'text', 'bugs', 'tags')
+
+    def testrun_snapshot(self, run_id, include=SNAPSHOT_INCLUDES, chunk_size=100,
+                         workers=4):
+        """Get A Test Run With Its TestCase Runs And Their Related Data.
+
+        'run_id' -- integer,
+        'include' -- list, what to fetch besides the run and its case runs:
+                     'cases' (the TestCases), 'text' (their current
+                     documents), 'tags' (their tags) and 'bugs' (the bugs
+                     of each case run), optional
+        'chunk_size' -- integer, the most calls to send in a single request
+        'workers' -- integer, the number of requests to send at once
+
+        The run, its case runs and its test cases come in one
+        system.multicall. Then the documents and tags of each distinct test
+        case and the bugs of each case run are fetched in system.multicall
+        requests of 'chunk_size' calls, 'workers' at once, instead of one
+        call each.
+
+        Example: testrun_snapshot(10, include=['cases', 'bugs'])
+
+        Result: A dictionary holding the 'run', its 'case_runs' and their
+        'cases' by case_id. Each case run has its 'case' (the same
+        dictionary for all the case runs of a test case) and its 'bugs'; each
+        test case has its 'text' and 'tags', as included. Without 'cases',
+        the test cases hold only their case_id and what else is included.
+        """
+        for name in include:
+            if name not in self.SNAPSHOT_INCLUDES:
+                raise TestopiaError("'%s' cannot be included in a snapshot." % name)
+        with self.batch() as b:
+            run = b.testrun_get(run_id)
+            case_runs = b.testrun_get_test_case_runs(run_id)
+            if 'cases' in include:
+                cases = b.testrun_get_test_cases(run_id)
+        snapshot = dict(run=run.result(), case_runs=case_runs.result(), cases={})
+        cases_by_id = snapshot['cases']
+        if 'cases' in include:
+            for case in cases.result():
+                cases_by_id[case['case_id']] = case
+        for case_run in snapshot['case_runs']:
+            case_run['case'] = cases_by_id.setdefault(case_run['case_id'],
+                                                      {'case_id': case_run['case_id']})
+
+        calls = [] # (dictionary, key, method name, argument)
+        for case_id, case in sorted(cases_by_id.items()):
+            if 'text' in include:
+                calls.append((case, 'text', 'testcase_get_text', case_id))
+            if 'tags' in include:
+                calls.append((case, 'tags', 'testcase_get_tags', case_id))
+        if 'bugs' in include:
+            for case_run in snapshot['case_runs']:
+                calls.append((case_run, 'bugs', 'testcaserun_get_bugs', case_run['case_run_id']))
+        if not calls:
+            return snapshot
+
+        def send(chunk):
+            with self.batch(chunk_size) as b:
+                results = [getattr(b, method_name)(argument)
+                           for target, key, method_name, argument in chunk]
+            return [(target, key, r) for (target, key, method_name, argument), r
+                    in zip(chunk, results)]
+
+        pool = self._start_workers(workers)
+        try:
+            chunks = [pool.apply_async(send, (calls[start:start + chunk_size],))
+                      for start in range(0, len(calls), chunk_size)]
+            for chunk in chunks:
+                for target, key, r in chunk.get():
+                    target[key] = r.result()
+        finally:
+            self._stop_workers(pool, workers)
+        return snapshot
+
+
+    def iter_testrun_get_test_case_runs(self, *args, **kwargs):
+        """Iterate Over The TestCase Runs Of An Existing Test Run.
+
+        Takes the same arguments as testrun_get_test_case_runs(), but parses the response as it
+        arrives, so that only one TestCaseRun at a time is held in memory.
+
+        Example: for caseRun in iter_testrun_get_test_case_runs(10):
+
+        Result: A generator of TestCaseRun dictionaries
+        """
+        return self.do_command_iter(*self._command_for('testrun_get_test_case_runs', *args, **kwargs))
+
+
     def testrun_get_test_plan(self, run_id):
         """Get A TestPlan For An Existing Test Run.
 
@@ -1650,6 +4160,7 @@ class Testopia(object):
         return self.do_command("TestRun.get_test_plan", [self._number_noop(run_id)])
 
 
+    @_invalidates(('testrun', 'run_id'))
     def testrun_add_tag(self, run_id, tag_name):
         """Add a tag to the given TestRun.
 
@@ -1665,6 +4176,7 @@ class Testopia(object):
                    ])
 
 
+    @_invalidates(('testrun', 'run_id'))
     def testrun_remove_tag(self, run_id, tag_name):
         """Remove a tag from the given TestRun.
 
@@ -1692,6 +4204,7 @@ class Testopia(object):
         return self.do_command("TestRun.get_tags", [self._number_noop(run_id)])
 
 #TODO: should make it work with product_id=None as well
+    @_cached_lookup(reverse='testrun_lookup_environment_name_by_id')
     def testrun_lookup_environment_id_by_name(self, name, product_id):
         """Lookup A TestRun Environment ID By Its Name.
 
@@ -1704,6 +4217,7 @@ class Testopia(object):
         return self.do_command("Environment.check_environment", [self._string_noop(name), self._number_noop(product_id)])['environment_id']
 
 
+    @_cached_lookup()
     def testrun_lookup_environment_name_by_id(self, id):
         """Lookup A TestRun Environment Name By Its ID.
 
@@ -1719,6 +4233,7 @@ class Testopia(object):
     ############################## TestCaseRun ##################################
 
 
+    @_identity_get('testcaserun')
     def testcaserun_get(self, case_run_id):
         """Get A TestCaseRun by ID.
 
@@ -1815,6 +4330,24 @@ class Testopia(object):
                    )])
 
 
+    def iter_testcaserun_list(self, *args, **kwargs):
+        """Iterate Over A List of TestCaseRuns Based on A Query.
+
+        Takes the same arguments as testcaserun_list(), but parses the response as it
+        arrives, so that only one TestCaseRun at a time is held in memory.
+
+        'page_size' -- integer, ask for this many TestCaseRuns at a time instead
+                       of all of them at once, optional
+        'prefetch' -- boolean, ask for the next page while the current one is
+                      consumed, optional
+
+        Example: for caseRun in iter_testcaserun_list(run_id=10, page_size=1000, prefetch=True):
+
+        Result: A generator of TestCaseRun dictionaries
+        """
+        return self._iter_list('testcaserun_list', args, kwargs)
+
+
     def testcaserun_create(self, assignee, build_id, case_id,
                            environment_id, run_id, case_text_version=None, notes=None):
         """Create A New TestCaseRun.
@@ -1843,13 +4376,15 @@ class Testopia(object):
                    )])
 
 
+    @_invalidates(('testcaserun', ('run_id', 'case_id', 'build_id', 'environment_id')))
     def testcaserun_update(self, run_id, case_id, build_id, environment_id,
                     new_build_id=None,
                     new_environment_id=None,
                     case_run_status_id=None,
                     update_bugs=False,
                     assignee=None,
-                    notes=None):
+                    notes=None,
+                    bugs=None):
         """Create A New TestCaseRun.
 
         'run_id', integer,
@@ -1862,6 +4397,7 @@ class Testopia(object):
         'update_bugs' -- boolean, optional
         'assignee' -- integer, the id of the user, optional
         'notes' -- string, optional,
+        'bugs' -- string, comma-separated IDs of bugs to attach, optional
 
         Example: testcaserun_update(1, 1, 1, 1, 1)
 
@@ -1882,8 +4418,171 @@ class Testopia(object):
                    self._boolean_option('update_bugs', update_bugs),
                    self._number_option('assignee', assignee),
                    self._string_option('notes', notes),
+                   self._string_option('bugs', bugs),
                    )])
 
+    def record_results(self, run_id, build_id, environment_id, results,
+                       chunk_size=100, workers=4):
+        """Record the results of many test cases in a test run.
+
+        'run_id' -- integer,
+        'build_id' -- integer,
+        'environment_id' -- integer,
+        'results' -- iterable of (case_id, status, notes, bugs) tuples, where
+                     'status' is a case-run status name such as 'PASSED' or
+                     its ID, 'notes' is a string and 'bugs' a list of bug IDs;
+                     notes and bugs may be None or left out
+        'chunk_size' -- integer, the most updates to send in a single request
+        'workers' -- integer, the number of requests to send at once
+
+        The updates are sent with TestCaseRun.update, in system.multicall
+        requests of 'chunk_size' updates on 'workers' connections at once.
+        Status names are looked up through the lookup cache, so each name
+        costs at most one call (none after preload()).
+
+        Example: record_results(1, 2, 3, [(10, 'PASSED'), (11, 'FAILED', 'Crashed', [4567])])
+
+        Result: A list of (case_id, result, error) tuples in the order of
+        'results'; 'error' is the exception of that update or None, and
+        'result' is None when it failed.
+        """
+        return list(self._record_results(run_id, build_id, environment_id, results,
+                                         chunk_size, workers))
+
+    def _record_results(self, run_id, build_id, environment_id, results,
+                        chunk_size, workers):
+        # Yields the reports of record_results() as the chunks are sent; a
+        # status that is an exception is reported as that case's error.
+        def updates():
+            chunk = []
+            for result in results:
+                case_id, status, notes, bugs = (tuple(result) + (None, None))[:4]
+                if type(status) is not IntType and not isinstance(status, Exception):
+                    try:
+                        status = self.testcaserun_lookup_status_id_by_name(status)
+                    except TestopiaXmlrpcError, e:
+                        status = e # Reported as this case's error
+                if bugs is not None and type(bugs) is not StringType:
+                    bugs = ','.join([str(bug) for bug in bugs])
+                chunk.append((case_id, status, notes, bugs))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        def send(chunk):
+            b = self.batch(chunk_size)
+            slots = []
+            for case_id, status, notes, bugs in chunk:
+                if isinstance(status, Exception):
+                    slots.append(status)
+                    continue
+                try:
+                    slots.append(b.testcaserun_update(run_id, case_id, build_id,
+                                                      environment_id,
+                                                      case_run_status_id=status,
+                                                      notes=notes, bugs=bugs))
+                except TestopiaError, e: # Bad arguments for this case
+                    slots.append(e)
+            b.send()
+            report = []
+            for (case_id, status, notes, bugs), slot in zip(chunk, slots):
+                if isinstance(slot, Exception):
+                    report.append((case_id, None, slot))
+                elif slot.error is not None:
+                    report.append((case_id, None, slot.error))
+                else:
+                    report.append((case_id, slot.result(), None))
+            return report
+
+        pool = self._start_workers(workers)
+        try:
+            # Chunks are made here rather than in the pool, so that a bad
+            # item in 'results' raises here; a few wait ahead of each worker,
+            # and reading 'results' waits for the oldest once there are more.
+            pending = []
+            for chunk in updates():
+                pending.append(pool.apply_async(send, (chunk,)))
+                if len(pending) > workers * 2:
+                    for report in pending.pop(0).get():
+                        yield report
+            for chunk_report in pending:
+                for report in chunk_report.get():
+                    yield report
+        finally:
+            self._stop_workers(pool, workers)
+
+
+    # The case-run status of each JUnit outcome; None leaves the case run as it is
+    JUNIT_STATUSES = {'passed': 'PASSED', 'failure': 'FAILED', 'error': 'ERROR',
+                      'skipped': None}
+
+    def _testcase_names(self, run_id):
+        """Returns the case_id of each alias and summary of the test cases of a run."""
+        key = ('_testcase_names', run_id)
+        names = self.cache.get(key)
+        if names is None:
+            names, aliases = {}, {}
+            for case in self.testcase_list(run_id=run_id):
+                names.setdefault(case.get('summary'), case['case_id'])
+                if case.get('alias'):
+                    aliases[case['alias']] = case['case_id']
+            names.update(aliases) # An alias wins over a summary
+            self.cache.put(key, names)
+        return names
+
+    def ingest_junit(self, source, run_id, build_id, environment_id, statuses=None,
+                     chunk_size=100, workers=4):
+        """Record the results of a JUnit (or xUnit) XML report in a test run.
+
+        'source' -- string, the name of the report file, or a file object
+        'run_id' -- integer,
+        'build_id' -- integer,
+        'environment_id' -- integer,
+        'statuses' -- dictionary, the case-run status name for each outcome
+                      ('passed', 'failure', 'error' and 'skipped') instead of
+                      those of JUNIT_STATUSES, optional
+        'chunk_size' -- integer, the most updates to send in a single request
+        'workers' -- integer, the number of requests to send at once
+
+        Each testcase element is matched to a test case of the run by alias
+        or summary, trying 'classname.name' and then 'name'; the aliases and
+        summaries of the run's test cases are fetched once and kept in the
+        lookup cache. The report is read as the results are sent, through
+        record_results(), so that parsing waits whenever the writers fall
+        behind, and memory stays bounded whatever the size of the report.
+        Failure messages become the notes of the case run.
+
+        Example: for name, case_id, result, error in t.ingest_junit('TEST-all.xml', 1, 2, 3):
+                     if error:
+                         print name, error
+
+        Result: A generator of (name, case_id, result, error) tuples in the
+        order of the report, leaving out the outcomes mapped to None; 'name'
+        is 'classname.name', and 'error' the exception of that test case or
+        None. A test case not found in the run has a TestopiaError and no case_id.
+        """
+        if statuses is None:
+            statuses = self.JUNIT_STATUSES
+        index = self._testcase_names(run_id)
+        names = deque()
+        def results():
+            for classname, name, outcome, message in _junit_testcases(source):
+                status = statuses.get(outcome)
+                if status is None:
+                    continue
+                fullname = classname and "%s.%s" % (classname, name) or name
+                case_id = index.get(fullname) or index.get(name)
+                if case_id is None:
+                    status = TestopiaError("No test case of run %s is named '%s'."
+                                           % (run_id, fullname))
+                names.append(fullname)
+                yield case_id, status, message
+        for case_id, result, error in self._record_results(
+                run_id, build_id, environment_id, results(), chunk_size, workers):
+            yield names.popleft(), case_id, result, error
+
 
     def testcaserun_get_bugs(self, case_run_id):
         """Get a list of bugs for the given TestCaseRun.
@@ -1898,6 +4597,7 @@ class Testopia(object):
         return self.do_command("TestCaseRun.get_bugs", [self._number_noop(case_run_id)])
 
 
+    @_cached_lookup(reverse='testcaserun_lookup_status_name_by_id')
     def testcaserun_lookup_status_id_by_name(self, name):
         """Lookup A TestCaseRun Status ID By Its Name.
 
@@ -1911,6 +4611,7 @@ class Testopia(object):
         return self.do_command("TestCaseRun.lookup_status_id_by_name", [self._string_noop(name)])
 
 
+    @_cached_lookup(reverse='testcaserun_lookup_status_id_by_name')
     def testcaserun_lookup_status_name_by_id(self, id):
         """Lookup A TestCaseRun Status Name By Its ID.
 
@@ -1923,6 +4624,510 @@ class Testopia(object):
         return self.do_command("TestCaseRun.lookup_status_name_by_id", [self._number_noop(id)])
 
 
+class AsyncTestopia(object):
+    '''Runs Testopia calls concurrently, returning a handle for each call.
+
+    Every Testopia verb (build_*, environment_*, product_*, testplan_*,
+    testcase_*, testrun_*, testcaserun_*, user_*) is available with the same
+    arguments, but returns at once with a multiprocessing AsyncResult; its
+    get() method waits for and returns the result, or raises the error:
+
+      a = AsyncTestopia.from_config('config.cfg', max_in_flight=32)
+      pending = [a.testcase_get(id) for id in caseIds]
+      cases = [p.get() for p in pending]
+
+    At most 'max_in_flight' calls are on the wire at once; the rest wait in
+    line. All the calls share a single login and its pooled connections.
+    '''
+    VERB_PREFIXES = ('build_', 'environment_', 'product_', 'testplan_',
+                     'testcase_', 'testrun_', 'testcaserun_', 'user_')
+
+    @classmethod
+    def from_config(cls, filename, max_in_flight=8):
+        """Make an AsyncTestopia instance from a config file, like Testopia.from_config()."""
+        kwargs = _read_config(filename)
+        kwargs.pop('pool_size', None) # The pool is max_in_flight connections
+        return cls(max_in_flight=max_in_flight, **kwargs)
+
+    def __init__(self, username, password, url, max_in_flight=8, **kwargs):
+        """Log in and start the workers.
+
+        'username', 'password', 'url' -- as for Testopia()
+        'max_in_flight' -- integer, the most calls to have running at once
+
+        Any other keyword arguments, such as 'session_cache' or 'disk_cache',
+        go to Testopia(); the connection pool is 'max_in_flight' connections.
+        """
+        kwargs['pool_size'] = max_in_flight
+        self.testopia = Testopia(username, password, url, **kwargs)
+        self.max_in_flight = max_in_flight
+        self._workers = ThreadPool(max_in_flight)
+
+    def __getattr__(self, name):
+        if not name.startswith(self.VERB_PREFIXES) and name != 'do_command':
+            raise AttributeError(name)
+        method = getattr(self.testopia, name)
+        def submit(*args, **kwargs):
+            return self._workers.apply_async(method, args, kwargs)
+        submit.__name__ = name
+        submit.__doc__ = method.__doc__
+        return submit
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """Waits for the calls in flight, then stops the workers and closes the connections."""
+        self._workers.close()
+        self._workers.join()
+        self.testopia._transport.close()
+
+
+def _words(text):
+    """Returns the lower-case words of a text, as the word search operations see them."""
+    if not text:
+        return []
+    if type(text) is StringType:
+        text = text.decode('utf-8', 'replace')
+    return [word.encode('utf-8') for word in re.findall(r'\w+', text.lower(), re.UNICODE)]
+
+def _sqlite_regexp(pattern, value):
+    if value is None:
+        return False
+    if type(value) is not StringType and type(value) is not UnicodeType:
+        value = str(value)
+    # Case-insensitive, as MySQL's REGEXP is on the server
+    return re.search(pattern, value, re.IGNORECASE) is not None
+
+def _any_viewer(value, operation):
+    # The 'canview' condition of the replica's queries, which always holds
+    return '1', []
+
+def _sqlite_words(value, operation, words):
+    found = set(_words(value if type(value) in (StringType, UnicodeType) else str(value or '')))
+    words = set(_words(words))
+    if operation == 'anywords':
+        return bool(found & words)
+    if operation == 'allwords':
+        return words <= found
+    return not (found & words)
+
+def _replica_value(value):
+    """Returns a result value as SQLite should hold it: dates as 'yyyy-mm-dd hh:mm:ss'."""
+    if isinstance(value, xmlrpclib.DateTime):
+        return datetime.strptime(value.value, "%Y%m%dT%H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+    if type(value) is BooleanType:
+        return int(value)
+    if type(value) in (ListType, DictType):
+        import json
+        return json.dumps(value, default=str)
+    return value
+
+class TestopiaReplica(object):
+    '''A local SQLite copy of the test data of products, kept up to date incrementally.
+
+    Holds the test plans of each product synced, with their test cases (and
+    the cases' text, tags and plans), test runs and test case runs:
+
+      replica = TestopiaReplica(t, 'replica.db')
+      replica.sync(product_id=2)
+      for row in replica.connection.execute("SELECT ... FROM case_runs ..."):
+
+    The tables 'plans', 'cases', 'runs' and 'case_runs' have a column for
+    each field of the matching Record type, and a 'data' column with the
+    other fields as JSON; 'case_texts', 'case_tags' and 'case_plans' go
+    with 'cases'. Dates are held as 'yyyy-mm-dd hh:mm:ss' strings.
+
+    The first sync of a product fetches everything. Later syncs fetch the
+    test plans again (there are few), but only the test cases created since
+    the newest one held, the test runs newer than the newest one held, and
+    the runs held still open. Within those open runs, they fetch the case
+    runs closed since the newest close date held, the case runs newer than
+    the newest one held, and again each case run held as not yet closed,
+    as its status may have changed; an open run is fetched whole while no
+    case run of the product has a close date. The high-water marks are
+    taken from the data and kept in the 'sync_state' table. What this
+    misses, such as edits to older test cases, is picked up by
+    sync(product_id, full=True).
+    '''
+    TABLES = [('plans', 'plan_id', TestPlanRecord._fields),
+              ('cases', 'case_id', TestCaseRecord._fields),
+              ('runs', 'run_id', TestRunRecord._fields),
+              ('case_runs', 'case_run_id', TestCaseRunRecord._fields)]
+    TEXT_FIELDS = ('setup', 'breakdown', 'action', 'effect')
+
+    def __init__(self, testopia, filename, chunk_size=100, list_chunk_size=10):
+        """'testopia' -- Testopia, the server to copy from
+        'filename' -- string, the SQLite file holding the copy
+        'chunk_size' -- integer, the most calls per system.multicall
+        'list_chunk_size' -- integer, the most *_list calls per system.multicall
+        """
+        import sqlite3
+        self.testopia = testopia
+        self.chunk_size = chunk_size
+        self.list_chunk_size = list_chunk_size
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = str
+        self.connection.create_function('REGEXP', 2, _sqlite_regexp)
+        self.connection.create_function('WORDS', 3, _sqlite_words)
+        self._create_tables()
+
+    def _create_tables(self):
+        c = self.connection
+        for table, key, fields in self.TABLES:
+            columns = ["%s INTEGER PRIMARY KEY" % key] + \
+                      [field for field in fields if field != key] + ["data TEXT"]
+            c.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table, ', '.join(columns)))
+        c.execute("CREATE TABLE IF NOT EXISTS case_texts (case_id INTEGER PRIMARY KEY, %s, data TEXT)"
+                  % ', '.join(self.TEXT_FIELDS))
+        c.execute("CREATE TABLE IF NOT EXISTS case_tags (case_id INTEGER, tag TEXT, "
+                  "PRIMARY KEY (case_id, tag))")
+        c.execute("CREATE TABLE IF NOT EXISTS case_plans (case_id INTEGER, plan_id INTEGER, "
+                  "PRIMARY KEY (case_id, plan_id))")
+        c.execute("CREATE TABLE IF NOT EXISTS case_words (case_id INTEGER, word TEXT, "
+                  "PRIMARY KEY (word, case_id))")
+        c.execute("CREATE TABLE IF NOT EXISTS sync_state (product_id INTEGER, name TEXT, value, "
+                  "PRIMARY KEY (product_id, name))")
+        c.execute("CREATE INDEX IF NOT EXISTS plans_product ON plans (product_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS runs_plan ON runs (plan_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS case_runs_run ON case_runs (run_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS case_plans_plan ON case_plans (plan_id)")
+        # Secondary indexes for the fields queries select on most
+        for table, column in [('cases', 'case_status_id'), ('cases', 'category_id'),
+                              ('cases', 'priority_id'), ('cases', 'author_id'),
+                              ('case_runs', 'case_id'), ('case_runs', 'build_id'),
+                              ('case_runs', 'environment_id'),
+                              ('case_runs', 'case_run_status_id'), ('case_runs', 'assignee'),
+                              ('case_tags', 'tag'), ('case_words', 'case_id')]:
+            c.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)"
+                      % (table, column, table, column))
+        c.commit()
+        if c.execute("SELECT COUNT(*) FROM case_words").fetchone()[0] == 0:
+            self.reindex() # Made before the words were indexed
+
+    def _store(self, table, rows, fields=None, key=None):
+        """Inserts or replaces rows of a table; returns how many there were."""
+        import json
+        if fields is None:
+            key, fields = [(k, f) for t, k, f in self.TABLES if t == table][0]
+        columns = (key,) + tuple([field for field in fields if field != key]) + ('data',)
+        sql = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" \
+              % (table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+        values = []
+        for row in rows:
+            extra = dict([(k, v) for k, v in row.items() if k not in columns])
+            values.append([_replica_value(row.get(column)) for column in columns[:-1]]
+                          + [json.dumps(extra, default=str)])
+        self.connection.executemany(sql, values)
+        return len(values)
+
+    def state(self, product_id):
+        """Returns the high-water marks of the last sync of a product, as a dictionary."""
+        return dict(self.connection.execute(
+            "SELECT name, value FROM sync_state WHERE product_id = ?", (product_id,)))
+
+    def _batch(self, calls, chunk_size):
+        """Sends (method name, args, kwargs) calls in batches; returns their results."""
+        results = []
+        for start in range(0, len(calls), chunk_size * 10):
+            with self.testopia.batch(chunk_size) as b:
+                slots = [getattr(b, name)(*args, **kwargs)
+                         for name, args, kwargs in calls[start:start + chunk_size * 10]]
+            results.extend([slot.result() for slot in slots])
+        return results
+
+    def _since(self, value):
+        # A second early, as the server compares to the second; the overlap is stored again
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S") - timedelta(seconds=1)
+
+    def sync(self, product_id, full=False):
+        """Brings the copy of a product up to date.
+
+        'product_id' -- integer,
+        'full' -- boolean, fetch everything again rather than the changes
+
+        Result: A dictionary of how many plans, cases, runs and case runs were stored
+        """
+        c = self.connection
+        state = {}
+        if not full:
+            state = self.state(product_id)
+        counts = {}
+        try:
+            plans = self.testopia.testplan_list(product_id=product_id)
+            counts['plans'] = self._store('plans', plans)
+            plan_ids = [plan['plan_id'] for plan in plans]
+
+            counts['cases'] = self._sync_cases(plan_ids, state)
+            open_runs = [run_id for run_id, in c.execute(
+                "SELECT run_id FROM runs WHERE stop_date IS NULL AND plan_id IN (%s)"
+                % ', '.join(['?'] * len(plan_ids)), plan_ids)]
+            runs = self._sync_runs(plan_ids, open_runs, state)
+            counts['runs'] = len(runs)
+            counts['case_runs'] = self._sync_case_runs(runs, open_runs, state)
+
+            for name, sql in [
+                    ('case_creation_date', "SELECT MAX(creation_date) FROM cases WHERE case_id IN "
+                                           "(SELECT case_id FROM case_plans WHERE plan_id IN (%s))"),
+                    ('run_id', "SELECT MAX(run_id) FROM runs WHERE plan_id IN (%s)"),
+                    ('case_run_id', "SELECT MAX(case_run_id) FROM case_runs WHERE run_id IN "
+                                    "(SELECT run_id FROM runs WHERE plan_id IN (%s))"),
+                    ('case_run_close_date', "SELECT MAX(close_date) FROM case_runs WHERE run_id IN "
+                                            "(SELECT run_id FROM runs WHERE plan_id IN (%s))")]:
+                value = c.execute(sql % ', '.join(['?'] * len(plan_ids)), plan_ids).fetchone()[0]
+                if value is not None:
+                    c.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                              (product_id, name, value))
+            c.execute("INSERT OR REPLACE INTO sync_state VALUES (?, 'synced_at', ?)",
+                      (product_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            c.commit()
+        except:
+            c.rollback()
+            raise
+        return counts
+
+    def _sync_cases(self, plan_ids, state):
+        if not plan_ids:
+            return 0
+        kwargs = dict(plans=[dict(plan_id=plan_id) for plan_id in plan_ids])
+        held = set()
+        if state.get('case_creation_date'):
+            kwargs.update(creation_date=self._since(state['case_creation_date']),
+                          creation_date_type='greaterthan')
+            # The cases of the overlapping second may be held already
+            held = set([case_id for case_id, in self.connection.execute(
+                "SELECT case_id FROM cases WHERE creation_date >= ?",
+                (state['case_creation_date'],))])
+        count = 0
+        chunk = []
+        for case in self.testopia.iter_testcase_list(**kwargs):
+            if case['case_id'] in held:
+                continue
+            chunk.append(case)
+            if len(chunk) == self.chunk_size * 10:
+                count += self._store_cases(chunk)
+                chunk = []
+        return count + self._store_cases(chunk)
+
+    def _store_cases(self, cases):
+        # The text, tags and plans of each case come in the same batches
+        calls = []
+        for case in cases:
+            for name in ('testcase_get_text', 'testcase_get_tags', 'testcase_get_plans'):
+                calls.append((name, (case['case_id'],), {}))
+        results = self._batch(calls, self.chunk_size)
+        c = self.connection
+        for index, case in enumerate(cases):
+            text, tags, plans = results[index * 3:index * 3 + 3]
+            case_id = case['case_id']
+            if type(text) is not DictType:
+                text = {} # No text stored yet
+            self._store('case_texts', [dict(text, case_id=case_id)], self.TEXT_FIELDS, 'case_id')
+            c.execute("DELETE FROM case_tags WHERE case_id = ?", (case_id,))
+            c.executemany("INSERT OR REPLACE INTO case_tags VALUES (?, ?)",
+                          [(case_id, tag.get('tag_name', tag.get('name'))) for tag in tags])
+            c.execute("DELETE FROM case_plans WHERE case_id = ?", (case_id,))
+            c.executemany("INSERT OR REPLACE INTO case_plans VALUES (?, ?)",
+                          [(case_id, plan['plan_id']) for plan in plans])
+        self._index_words(cases)
+        return self._store('cases', cases)
+
+    def _sync_runs(self, plan_ids, open_runs, state):
+        """Stores the new and the open runs; returns the IDs of the new ones."""
+        calls = []
+        for plan_id in plan_ids:
+            kwargs = dict(plan_id=plan_id)
+            if state.get('run_id'):
+                kwargs.update(run_id=state['run_id'], run_id_type='greaterthan')
+            calls.append(('testrun_list', (), kwargs))
+        new_runs = [run for runs in self._batch(calls, self.list_chunk_size) for run in runs]
+        open_runs = self._batch([('testrun_get', (run_id,), {}) for run_id in open_runs],
+                                self.chunk_size)
+        self._store('runs', new_runs + open_runs)
+        return [run['run_id'] for run in new_runs]
+
+    def _sync_case_runs(self, new_runs, open_runs, state):
+        calls = [('testcaserun_list', (), dict(run_id=run_id)) for run_id in new_runs]
+        pending = [] # The case runs held as not yet closed, whose status may have changed
+        for run_id in open_runs:
+            if run_id in new_runs:
+                continue
+            if not state.get('case_run_close_date'):
+                # Nothing to tell the case runs closed since the last sync by
+                calls.append(('testcaserun_list', (), dict(run_id=run_id)))
+                continue
+            calls.append(('testcaserun_list', (),
+                          dict(run_id=run_id,
+                               close_date=self._since(state['case_run_close_date']),
+                               close_date_type='greaterthan')))
+            calls.append(('testcaserun_list', (),
+                          dict(run_id=run_id, case_run_id=state.get('case_run_id'),
+                               case_run_id_type=state.get('case_run_id') and 'greaterthan')))
+            pending.extend([case_run_id for case_run_id, in self.connection.execute(
+                "SELECT case_run_id FROM case_runs WHERE run_id = ? AND close_date IS NULL",
+                (run_id,))])
+        count = 0
+        for start in range(0, len(calls), self.list_chunk_size):
+            for caseRuns in self._batch(calls[start:start + self.list_chunk_size],
+                                        self.list_chunk_size):
+                count += self._store('case_runs', caseRuns)
+        if pending:
+            count += self._store('case_runs', self._batch(
+                [('testcaserun_get', (case_run_id,), {}) for case_run_id in pending],
+                self.chunk_size))
+        return count
+
+    ############################## Queries #################################
+
+    def _index_words(self, cases):
+        """Rebuilds the 'case_words' index of the summaries of some cases."""
+        c = self.connection
+        c.executemany("DELETE FROM case_words WHERE case_id = ?",
+                      [(case['case_id'],) for case in cases])
+        c.executemany("INSERT OR IGNORE INTO case_words VALUES (?, ?)",
+                      [(case['case_id'], word) for case in cases
+                       for word in set(_words(case.get('summary')))])
+
+    def reindex(self):
+        """Rebuilds the secondary indexes from the cases held."""
+        self._index_words([dict(case_id=case_id, summary=summary) for case_id, summary
+                           in self.connection.execute("SELECT case_id, summary FROM cases")])
+        self.connection.commit()
+
+    def _condition(self, column, value, operation):
+        """Returns the SQL condition and parameters of a search operation on a column."""
+        if isinstance(value, datetime):
+            value = value.strftime("%Y-%m-%d %H:%M:%S")
+        if type(value) is BooleanType:
+            value = int(value)
+        if operation == 'equals':
+            return "%s = ?" % column, [value]
+        if operation == 'notequals':
+            return "(%s IS NULL OR %s != ?)" % (column, column), [value]
+        if operation == 'isnull':
+            return "(%s IS NULL OR %s = '')" % (column, column), []
+        if operation == 'isnotnull':
+            return "(%s IS NOT NULL AND %s != '')" % (column, column), []
+        if operation == 'lessthan':
+            return "%s < ?" % column, [value]
+        if operation == 'greaterthan':
+            return "%s > ?" % column, [value]
+        if operation == 'regexp':
+            return "%s REGEXP ?" % column, [value]
+        if operation == 'notregexp':
+            return "NOT (%s REGEXP ?)" % column, [value]
+        if operation in ('anywords', 'allwords', 'nowords'):
+            return "WORDS(%s, ?, ?)" % column, [operation, value]
+        raise TestopiaError("Not a valid search operation.")
+
+    def _word_condition(self, words, operation, table, column):
+        """Returns the condition that a case has any, all or none of some words in 'table'."""
+        if type(words) is StringType:
+            words = _words(words) if table == 'case_words' else \
+                    [word.strip() for word in words.split(',') if word.strip()]
+        words = list(set(words))
+        if not words:
+            return "1", []
+        marks = ', '.join(['?'] * len(words))
+        if operation == 'allwords':
+            return ("case_id IN (SELECT case_id FROM %s WHERE %s IN (%s) "
+                    "GROUP BY case_id HAVING COUNT(*) = %d)" % (table, column, marks, len(words)),
+                    words)
+        condition = "case_id IN (SELECT case_id FROM %s WHERE %s IN (%s))" % (table, column, marks)
+        if operation == 'nowords':
+            condition = "NOT " + condition
+        return condition, words
+
+    def _search(self, table, fields, kwargs, special):
+        """Runs a *_list() style query on a table; returns its rows as dictionaries."""
+        import json
+        names = set([name[:-len('_type')] for name in kwargs if name.endswith('_type')])
+        names.update([name for name in kwargs if not name.endswith('_type')])
+        clauses, params = [], []
+        for name in sorted(names):
+            value = kwargs.get(name)
+            operation = kwargs.get(name + '_type')
+            if operation is not None and operation not in _SEARCH_OPERATIONS:
+                raise TestopiaError("Not a valid search operation.")
+            if value is None and operation not in ('isnull', 'isnotnull'):
+                continue
+            if name in special:
+                clause, values = special[name](value, operation)
+            elif name in fields:
+                clause, values = self._condition(name, value, operation or 'equals')
+            else:
+                raise TestopiaError("'%s' is not a field of %s." % (name, table))
+            clauses.append(clause)
+            params.extend(values)
+        cursor = self.connection.execute("SELECT * FROM %s WHERE %s ORDER BY 1"
+                                         % (table, ' AND '.join(clauses) or '1'), params)
+        columns = [description[0] for description in cursor.description]
+        rows = []
+        for values in cursor:
+            row = dict([(column, value) for column, value in zip(columns, values)
+                        if value is not None])
+            data = row.pop('data', None)
+            if data and data != '{}':
+                row.update(json.loads(data))
+            rows.append(row)
+        return rows
+
+    def testcase_list(self, **kwargs):
+        """Get A List of the TestCases held, Based on A Query.
+
+        Takes the same keyword arguments as Testopia.testcase_list(), that is
+        each field of a TestCase with an optional '<field>_type' search
+        operation, 'plans' and 'run_id'; 'tags' (a list or a comma-separated
+        string) with 'tags_type' 'anywords' (the default), 'allwords' or
+        'nowords' selects by tag. The operations are those of
+        Testopia._validate_search_operation_string(), 'equals' by default.
+
+        Word operations on the summary use the 'case_words' index, and tags
+        and plans their own tables, as do the other fields the query names.
+        'canview' is taken and ignored, as the replica holds only what the
+        user it was synced as can view.
+
+        Example: testcase_list(summary='crash boot', summary_type='anywords',
+                               plans=[{'plan_id': 10}], case_status_id=2)
+
+        Result: A list of TestCase dictionaries
+        """
+        def summary(value, operation):
+            if operation in ('anywords', 'allwords', 'nowords'):
+                return self._word_condition(value, operation, 'case_words', 'word')
+            return self._condition('summary', value, operation or 'equals')
+        def plans(value, operation):
+            plan_ids = [plan['plan_id'] for plan in value]
+            return ("case_id IN (SELECT case_id FROM case_plans WHERE plan_id IN (%s))"
+                    % ', '.join(['?'] * len(plan_ids)), plan_ids)
+        def run_id(value, operation):
+            condition, values = self._condition('run_id', value, operation or 'equals')
+            return "case_id IN (SELECT case_id FROM case_runs WHERE %s)" % condition, values
+        def tags(value, operation):
+            return self._word_condition(value, operation or 'anywords', 'case_tags', 'tag')
+        return self._search('cases', TestCaseRecord._field_set, kwargs,
+                            dict(summary=summary, plans=plans, run_id=run_id, tags=tags,
+                                 canview=_any_viewer))
+
+    def testcaserun_list(self, **kwargs):
+        """Get A List of the TestCaseRuns held, Based on A Query.
+
+        Takes the same keyword arguments as Testopia.testcaserun_list(): each
+        field of a TestCaseRun with an optional '<field>_type' search
+        operation, 'equals' by default; 'canview' is ignored, as in
+        testcase_list().
+
+        Example: testcaserun_list(run_id=10, case_run_status_id=3)
+
+        Result: A list of TestCaseRun dictionaries
+        """
+        return self._search('case_runs', TestCaseRunRecord._field_set, kwargs,
+                            dict(canview=_any_viewer))
+
 
 # A simple pyunit test suite follows:
 import unittest
@@ -1943,6 +5148,89 @@ class TestopiaUnitTest(unittest.TestCase):
     def get_test_product_id(self):
         return self.testopia.product_check_by_name(self.testProductName)['id']
 
+class StandInServer(object):
+    '''A local XML-RPC server, for the tests that need no real Testopia.
+
+    Each verb is answered by the function of that name in 'handlers', and
+    every call, the calls inside a system.multicall included, is appended
+    to 'calls' as a (verb, params) pair; 'multicalls' holds the number of
+    calls in each system.multicall. Logging in sets a cookie, as
+    Bugzilla does; while 'logged_in' is False, every other verb faults
+    with LOGIN_REQUIRED_FAULT. With 'multicall' False, system.multicall is
+    an unknown method.
+    '''
+    def __init__(self):
+        from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+        from SocketServer import ThreadingMixIn
+        stand_in = self
+        class Handler(SimpleXMLRPCRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keeps connections alive
+            rpc_paths = ('/tr_xmlrpc.cgi',)
+            def setup(self):
+                stand_in.connections += 1
+                SimpleXMLRPCRequestHandler.setup(self)
+            def decode_request_content(self, data):
+                stand_in.request_encodings.append(self.headers.get('content-encoding'))
+                self.logging_in = 'User.login' in data
+                return SimpleXMLRPCRequestHandler.decode_request_content(self, data)
+            def end_headers(self):
+                if getattr(self, 'logging_in', False):
+                    self.send_header('Set-Cookie', 'Bugzilla_logincookie=abc; path=/')
+                SimpleXMLRPCRequestHandler.end_headers(self)
+            def log_message(self, format, *args):
+                pass
+        class Server(ThreadingMixIn, SimpleXMLRPCServer):
+            daemon_threads = True
+            def _dispatch(self, method, params):
+                return stand_in._dispatch(method, params)
+        self.handlers = {'User.login': lambda login: {'id': 1}}
+        self.calls = []
+        self.multicalls = []
+        self.connections = 0
+        self.request_encodings = []
+        self.logged_in = True
+        self.multicall = True
+        self._server = Server(('127.0.0.1', 0), Handler, logRequests=False)
+        self.url = 'http://127.0.0.1:%d/tr_xmlrpc.cgi' % self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def _dispatch(self, method, params):
+        if method == 'system.multicall':
+            if not self.multicall:
+                raise xmlrpclib.Fault(METHOD_NOT_FOUND_FAULT,
+                                      'method "system.multicall" is not supported')
+            self.multicalls.append(len(params[0]))
+            return self._server.system_multicall(params[0])
+        self.calls.append((method, params))
+        if method == 'User.login':
+            self.logged_in = True
+        elif not self.logged_in:
+            raise xmlrpclib.Fault(LOGIN_REQUIRED_FAULT, 'You must log in')
+        if method not in self.handlers:
+            raise xmlrpclib.Fault(METHOD_NOT_FOUND_FAULT, 'method "%s" is not supported' % method)
+        return self.handlers[method](*params)
+
+    def verbs(self):
+        """Returns the verbs called so far, in order."""
+        return [verb for verb, params in self.calls]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class StandInUnitTest(unittest.TestCase):
+    '''Runs a test against a StandInServer, 'self.server', with a Testopia
+    instance logged into it, 'self.testopia'.'''
+    def setUp(self):
+        self.server = StandInServer()
+        self.testopia = Testopia('jdoe@mycompany.com', 'jdoepassword', self.server.url)
+
+    def tearDown(self):
+        self.testopia._transport.close()
+        self.server.close()
+
 class LoginUnitTests(TestopiaUnitTest):
     def test_login(self):
         # Ensure that we logged in, and that we have our userId recorded:
@@ -1954,6 +5242,952 @@ class LoginUnitTests(TestopiaUnitTest):
                           self.testopia.do_command,
                           "ThisIsNotAClass.this_is_not_a_method", [])
 
+class BatchUnitTests(TestopiaUnitTest):
+    def test_batch(self):
+        with self.testopia.batch(chunk_size=1) as b:
+            buildResult = b.build_get(1)
+            bogusResult = b.do_command("ThisIsNotAClass.this_is_not_a_method", [])
+        self.assertEquals(buildResult.result()['build_id'], 1)
+        self.assert_(isinstance(bogusResult.error, TestopiaXmlrpcError))
+        self.assertRaises(TestopiaXmlrpcError, bogusResult.result)
+
+class TransportUnitTests(StandInUnitTest):
+    def test_connection_reuse(self):
+        self.server.handlers['Build.get'] = lambda build_id: {'build_id': build_id}
+        for buildId in range(1, 6):
+            self.assertEquals(self.testopia.build_get(buildId)['build_id'], buildId)
+        self.assertEquals(self.server.connections, 1) # The login's, kept alive
+
+    def test_connection_pool(self):
+        started = threading.Event()
+        def build_get(build_id):
+            started.wait(1)
+            return {'build_id': build_id}
+        self.server.handlers['Build.get'] = build_get
+        self.testopia._transport.pool_size = 3
+        threads = [threading.Thread(target=self.testopia.build_get, args=(i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        threading.Event().wait(0.2) # Until all three are waiting on the server
+        started.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(self.server.connections, 3)
+        self.assertEquals(len(self.testopia._transport._idle), 3)
+        for i in range(6):
+            self.testopia.build_get(i)
+        self.assertEquals(self.server.connections, 3)
+
+    def test_workers_grow_the_pool_for_a_while(self):
+        def build_get(build_id):
+            threading.Event().wait(0.02)
+            return {'build_id': build_id}
+        self.server.handlers['Build.get'] = build_get
+        results = list(self.testopia.map('build_get', range(20), workers=4))
+        self.assertEquals([result['build_id'] for args, result, error in results], range(20))
+        self.assert_(self.server.connections <= 5, self.server.connections)
+        self.assertEquals(self.testopia._transport.pool_size, 1)
+        self.assertEquals(len(self.testopia._transport._idle), 1)
+
+class CookieUnitTests(StandInUnitTest):
+    def test_cookie_headers_are_reused(self):
+        transport = self.testopia._transport
+        url = 'http://%s%s' % (self.testopia._host, self.testopia._handler)
+        headers = transport._cookie_headers(url)
+        self.assertEquals(headers, [('Cookie', 'Bugzilla_logincookie=abc')])
+        self.assert_(transport._cookie_headers(url) is headers)
+        self.testopia._login() # Sets the cookie again
+        self.assert_(transport._cookie_headers(url) is not headers)
+
+    def test_saving_does_not_hold_the_pool(self):
+        transport = self.testopia._transport
+        saving, release = threading.Event(), threading.Event()
+        class SlowJar(CookieJar):
+            filename = 'cookies.txt'
+            def save(self, filename):
+                saving.set()
+                release.wait(5)
+        transport.cookiejar = SlowJar()
+        saver = threading.Thread(target=transport.flush_cookies)
+        saver.start()
+        try:
+            self.assert_(saving.wait(5))
+            self.assert_(transport._pool_lock.acquire(False))
+            transport._pool_lock.release()
+        finally:
+            release.set()
+            saver.join()
+
+class SessionCacheUnitTests(StandInUnitTest):
+    def setUp(self):
+        import tempfile
+        StandInUnitTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.filename = _session_filename(self.directory, self.server.url, 'jdoe@mycompany.com')
+        self.clients = []
+
+    def tearDown(self):
+        import shutil
+        for client in self.clients:
+            client._transport.close()
+        StandInUnitTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        client = Testopia('jdoe@mycompany.com', 'jdoepassword', self.server.url,
+                          session_cache=self.directory)
+        self.clients.append(client)
+        return client
+
+    def logins(self):
+        return self.server.verbs().count('User.login')
+
+    def test_session_is_reused(self):
+        before = self.logins()
+        self.connect()
+        self.assertEquals(self.logins(), before + 1)
+        self.assertEquals(os.stat(self.filename).st_mode & 0777, 0600)
+        client = self.connect()
+        self.assertEquals(self.logins(), before + 1)
+        self.assertEquals(client.userId, 1)
+        self.assertEquals([cookie.value for cookie in client._transport.cookiejar], ['abc'])
+
+    def test_damaged_session_logs_in(self):
+        f = open(self.filename, 'w')
+        f.write("Not a cookie file\n")
+        f.close()
+        before = self.logins()
+        self.assertEquals(self.connect().userId, 1)
+        self.assertEquals(self.logins(), before + 1)
+        jar = SessionCookieJar()
+        jar.load(self.filename)
+        self.assertEquals(jar.user_id, 1) # Saved again, whole
+
+    def test_session_without_user_id_logs_in(self):
+        self.connect()
+        lines = [line for line in open(self.filename) if not line.startswith('#user_id:')]
+        open(self.filename, 'w').writelines(lines)
+        before = self.logins()
+        self.assertEquals(self.connect().userId, 1)
+        self.assertEquals(self.logins(), before + 1)
+
+class CompressionUnitTests(StandInUnitTest):
+    def test_gzip_response(self):
+        notes = 'Failed on the nightly build, see the attached log. ' * 200
+        self.server.handlers['TestCaseRun.get'] = lambda case_run_id: {'notes': notes}
+        before = self.testopia.transfer_stats()
+        self.assertEquals(self.testopia.testcaserun_get(1)['notes'], notes)
+        after = self.testopia.transfer_stats()
+        received = after['bytes_received'] - before['bytes_received']
+        decoded = after['bytes_decoded'] - before['bytes_decoded']
+        self.assert_(received < len(notes) / 10 < decoded, (received, decoded))
+
+    def test_gzip_request(self):
+        self.server.handlers['TestCase.update'] = lambda values: values
+        self.testopia._transport.encode_threshold = 1024
+        summary = 'Boot ' * 10
+        self.assertEquals(self.testopia.testcase_update(1, summary=summary)['summary'], summary)
+        notes = 'Boot the nightly build and log in. ' * 100
+        before = self.testopia.transfer_stats()['bytes_sent']
+        self.assertEquals(self.testopia.testcase_update(1, summary=notes)['summary'], notes)
+        self.assert_(self.testopia.transfer_stats()['bytes_sent'] - before < len(notes) / 4)
+        self.assertEquals(self.server.request_encodings[-2:], [None, 'gzip'])
+
+class BatchStandInUnitTests(StandInUnitTest):
+    def test_multicall_fallback(self):
+        self.server.handlers['Build.get'] = lambda build_id: {'build_id': build_id}
+        self.server.multicall = False
+        with self.testopia.batch() as b:
+            results = [b.build_get(1), b.build_get(2)]
+        self.assertEquals([r.result()['build_id'] for r in results], [1, 2])
+        self.assertEquals(self.testopia._multicall_supported, False)
+
+    def test_other_multicall_faults_are_not_remembered(self):
+        self.server.handlers['Build.get'] = lambda build_id: {'build_id': build_id}
+        multicall = self.server._server.system_multicall
+        def failing(calls):
+            self.server._server.system_multicall = multicall # Only once
+            raise xmlrpclib.Fault(500, 'The database is busy')
+        self.server._server.system_multicall = failing
+        with self.testopia.batch() as b:
+            result = b.build_get(1)
+        self.assertEquals(result.result()['build_id'], 1)
+        self.assertEquals(self.testopia._multicall_supported, True)
+
+    def test_relogin(self):
+        self.server.handlers['Build.get'] = lambda build_id: {'build_id': build_id}
+        self.server.logged_in = False # As after the session expired
+        with self.testopia.batch() as b:
+            results = [b.build_get(1), b.build_get(2)]
+        self.assertEquals([r.result()['build_id'] for r in results], [1, 2])
+        self.assertEquals(self.server.verbs()[-5:],
+                          ['Build.get', 'Build.get', 'User.login', 'Build.get', 'Build.get'])
+
+    def test_relogin_on_multicall_fault(self):
+        self.server.handlers['Build.get'] = lambda build_id: {'build_id': build_id}
+        multicall = self.server._server.system_multicall
+        def expired(calls):
+            self.server._server.system_multicall = multicall
+            raise xmlrpclib.Fault(LOGIN_REQUIRED_FAULT, 'You must log in')
+        self.server._server.system_multicall = expired
+        with self.testopia.batch() as b:
+            result = b.build_get(1)
+        self.assertEquals(result.result()['build_id'], 1)
+        self.assertEquals(self.server.verbs()[-2:], ['User.login', 'Build.get'])
+
+    def test_short_multicall_reply(self):
+        self.server.handlers['Build.get'] = lambda build_id: {'build_id': build_id}
+        multicall = self.server._server.system_multicall
+        self.server._server.system_multicall = lambda calls: multicall(calls)[:-1]
+        with self.testopia.batch() as b:
+            results = [b.build_get(1), b.build_get(2)]
+        for r in results:
+            self.assertRaises(TestopiaXmlrpcError, r.result)
+
+class RecordResultsUnitTests(StandInUnitTest):
+    def setUp(self):
+        StandInUnitTest.setUp(self)
+        statuses = {'PASSED': 2, 'FAILED': 3}
+        def lookup(name):
+            if name not in statuses:
+                raise xmlrpclib.Fault(4, 'No such status')
+            return statuses[name]
+        def update(run_id, case_id, build_id, environment_id, values):
+            if case_id == 13:
+                raise xmlrpclib.Fault(3, 'No such case run')
+            return dict(values, case_id=case_id)
+        self.server.handlers['TestCaseRun.lookup_status_id_by_name'] = lookup
+        self.server.handlers['TestCaseRun.update'] = update
+
+    def test_record_results(self):
+        report = self.testopia.record_results(1, 2, 3, [
+            (10, 'PASSED'), (11, 'FAILED', 'Crashed', [4567, 8]), (12, 3, None, '99'),
+            (13, 'PASSED'), (14, 'WEIRD'), (15, 'FAILED')], chunk_size=2, workers=2)
+        self.assertEquals([case_id for case_id, result, error in report], range(10, 16))
+        self.assertEquals(report[1][1]['bugs'], '4567,8')
+        self.assertEquals(report[1][1]['notes'], 'Crashed')
+        self.assertEquals(report[2][1]['case_run_status_id'], 3)
+        self.assertEquals([error is not None for case_id, result, error in report],
+                          [False, False, False, True, True, False])
+        # Each status name is looked up once; the update of 14 is never sent
+        self.assertEquals(sorted(self.server.verbs()).count(
+                          'TestCaseRun.lookup_status_id_by_name'), 3)
+        self.assertEquals(sorted(self.server.multicalls), [1, 2, 2])
+
+    def test_record_results_log_in_again(self):
+        self.testopia.testcaserun_lookup_status_id_by_name('PASSED')
+        self.server.logged_in = False # As after the session expired
+        report = self.testopia.record_results(1, 2, 3, [(10, 'PASSED'), (11, 'PASSED')])
+        self.assertEquals([error for case_id, result, error in report], [None, None])
+        self.assertEquals(self.server.verbs().count('User.login'), 2)
+
+class ImportTestCasesUnitTests(StandInUnitTest):
+    def test_resume_from_checkpoint(self):
+        import tempfile
+        caseIds = {'Boot': 101, 'Login': 102, 'Suspend': 103}
+        locked = ['flaky']
+        def add_tag(case_id, tag_name):
+            if tag_name in locked:
+                raise xmlrpclib.Fault(5, 'The tag is locked')
+            return 0
+        self.server.handlers['TestCase.create'] = lambda values: {'case_id': caseIds[values['summary']]}
+        self.server.handlers['TestCase.store_text'] = lambda *args: 1
+        self.server.handlers['TestCase.add_tag'] = add_tag
+        rows = ('summary,plan_id,category_id,case_status_id,action,tags\n'
+                'Boot,1,2,2,Press power,smoke\n'
+                'Login,1,2,2,Type password,"smoke, flaky"\n'
+                'Suspend,1,2,2,,\n')
+        checkpoint = tempfile.mktemp()
+        try:
+            report = list(self.testopia.import_testcases(StringIO(rows), checkpoint,
+                                                         format='csv', workers=2))
+            self.assertEquals([(row, case_id) for row, case_id, error in report],
+                              [(1, 101), (2, 102), (3, 103)])
+            self.assertEquals([error is None for row, case_id, error in report],
+                              [True, False, True])
+            self.assertEquals(self.server.verbs().count('TestCase.create'), 3)
+            # Run again: only the unfinished row is taken up, without creating it again
+            del locked[:]
+            del self.server.calls[:]
+            report = list(self.testopia.import_testcases(StringIO(rows), checkpoint,
+                                                         format='csv', workers=2))
+            self.assertEquals(report, [(2, 102, None)])
+            self.assertEquals(sorted(self.server.verbs()),
+                              ['TestCase.add_tag', 'TestCase.add_tag', 'TestCase.store_text'])
+        finally:
+            os.remove(checkpoint)
+
+class PagingUnitTests(StandInUnitTest):
+    def test_page_boundaries(self):
+        plans = []
+        def plan_list(query):
+            self.assertFalse('viewall' in query)
+            start = query['page'] * query['pagesize']
+            return plans[start:start + query['pagesize']]
+        self.server.handlers['TestPlan.list'] = plan_list
+        for count, pages in [(0, [0]), (4, [0]), (5, [0, 1]), (10, [0, 1, 2]), (11, [0, 1, 2])]:
+            plans[:] = [{'plan_id': i} for i in range(count)]
+            for prefetch in (False, True):
+                del self.server.calls[:]
+                rows = list(self.testopia.iter_testplan_list(product_id=1, page_size=5,
+                                                             prefetch=prefetch))
+                self.assertEquals(rows, plans)
+                self.assertEquals([params[0]['page'] for verb, params in self.server.calls],
+                                  pages)
+
+class EnsureUnitTests(StandInUnitTest):
+    def setUp(self):
+        StandInUnitTest.setUp(self)
+        self.builds = {}
+        self.racing = 1 # How many callers check for the build before any answer
+        checks = []
+        checked = threading.Event()
+        lock = threading.Lock()
+        def check_build(name, product_id):
+            build = self.builds.get(name)
+            checks.append(name)
+            if len(checks) >= self.racing:
+                checked.set()
+            checked.wait(1)
+            threading.Event().wait(0.05) # Long enough for more callers in this process to wait
+            if build is None:
+                raise xmlrpclib.Fault(6, 'No such build')
+            return build
+        def create(values):
+            lock.acquire()
+            try:
+                if values['name'] in self.builds:
+                    raise xmlrpclib.Fault(7, 'The build already exists')
+                build = dict(values, build_id=len(self.builds) + 1)
+                self.builds[values['name']] = build
+                return build['build_id']
+            finally:
+                lock.release()
+        self.server.handlers['Build.check_build'] = check_build
+        self.server.handlers['Build.create'] = create
+        self.server.handlers['Build.get'] = lambda build_id: \
+            [build for build in self.builds.values() if build['build_id'] == build_id][0]
+
+    def ensure_all(self, clients):
+        results = []
+        threads = [threading.Thread(target=lambda t=t: results.append(
+                       t.ensure_build('pipeline-1', 2)['build_id'])) for t in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_threads_share_one_ensure(self):
+        self.assertEquals(self.ensure_all([self.testopia] * 5), [1] * 5)
+        self.assertEquals(self.server.verbs().count('Build.check_build'), 1)
+        self.assertEquals(self.server.verbs().count('Build.create'), 1)
+        self.assertEquals(self.testopia.build_lookup_id_by_name('pipeline-1', 2), 1)
+        self.assertEquals(len(self.server.calls), 4) # login, check, create, get
+
+    def test_create_conflict_is_retried(self):
+        other = Testopia('jdoe@mycompany.com', 'jdoepassword', self.server.url)
+        self.racing = 2 # Both clients find no build, and both create it
+        try:
+            self.assertEquals(self.ensure_all([self.testopia, other]), [1, 1])
+        finally:
+            other._transport.close()
+        self.assertEquals(len(self.builds), 1)
+        self.assertEquals(self.server.verbs().count('Build.create'), 2)
+
+class IngestJUnitUnitTests(StandInUnitTest):
+    def test_ingest_junit(self):
+        self.server.handlers['TestCase.list'] = lambda query: [
+            {'case_id': 1, 'summary': 'test_boot', 'alias': 'pkg.Suite.test_boot'},
+            {'case_id': 2, 'summary': 'test_login', 'alias': ''},
+            {'case_id': 3, 'summary': 'test_suspend', 'alias': ''}]
+        self.server.handlers['TestCaseRun.lookup_status_id_by_name'] = \
+            lambda name: {'PASSED': 2, 'FAILED': 3, 'ERROR': 7}[name]
+        self.server.handlers['TestCaseRun.update'] = \
+            lambda run_id, case_id, build_id, environment_id, values: dict(values, case_id=case_id)
+        report = ('<testsuites><testsuite name="s">'
+                  '<testcase classname="pkg.Suite" name="test_boot"/>'
+                  '<testcase classname="pkg.Suite" name="test_login">'
+                  '<failure message="Wrong password">trace</failure></testcase>'
+                  '<testcase classname="pkg.Suite" name="test_suspend"><skipped/></testcase>'
+                  '<testcase classname="pkg.Suite" name="test_resume"/>'
+                  '<testcase name="test_suspend"><error>Hung</error></testcase>'
+                  '</testsuite></testsuites>')
+        results = list(self.testopia.ingest_junit(StringIO(report), 1, 2, 3, chunk_size=2))
+        self.assertEquals([(name, case_id) for name, case_id, result, error in results],
+                          [('pkg.Suite.test_boot', 1), ('pkg.Suite.test_login', 2),
+                           ('pkg.Suite.test_resume', None), ('test_suspend', 3)])
+        self.assertEquals([result and (result['case_run_status_id'], result.get('notes'))
+                           for name, case_id, result, error in results],
+                          [(2, None), (3, 'Wrong password'), None, (7, 'Hung')])
+        self.assert_(isinstance(results[2][3], TestopiaError))
+        # The names of the run's test cases are fetched only once
+        list(self.testopia.ingest_junit(StringIO(report), 1, 2, 3))
+        self.assertEquals(self.server.verbs().count('TestCase.list'), 1)
+
+class SnapshotUnitTests(StandInUnitTest):
+    def setUp(self):
+        StandInUnitTest.setUp(self)
+        handlers = self.server.handlers
+        handlers['TestRun.get'] = lambda run_id: {'run_id': run_id}
+        handlers['TestRun.get_test_case_runs'] = lambda run_id: [
+            {'case_run_id': 10, 'case_id': 1},
+            {'case_run_id': 11, 'case_id': 2},
+            {'case_run_id': 12, 'case_id': 1}]
+        handlers['TestRun.get_test_cases'] = lambda run_id: [
+            {'case_id': 1, 'summary': 'test_boot'},
+            {'case_id': 2, 'summary': 'test_login'}]
+        handlers['TestCase.get_text'] = lambda case_id: {'action': 'Step %d' % case_id}
+        handlers['TestCase.get_tags'] = lambda case_id: ['tag%d' % case_id]
+        handlers['TestCaseRun.get_bugs'] = lambda case_run_id: [{'bug_id': case_run_id}]
+
+    def test_snapshot(self):
+        snapshot = self.testopia.testrun_snapshot(5, chunk_size=4, workers=2)
+        self.assertEquals(snapshot['run'], {'run_id': 5})
+        case_runs = snapshot['case_runs']
+        self.assert_(case_runs[0]['case'] is case_runs[2]['case'])
+        self.assert_(case_runs[0]['case'] is snapshot['cases'][1])
+        self.assertEquals(snapshot['cases'][1]['summary'], 'test_boot')
+        self.assertEquals(snapshot['cases'][2]['text'], {'action': 'Step 2'})
+        self.assertEquals(snapshot['cases'][2]['tags'], ['tag2'])
+        self.assertEquals([case_run['bugs'] for case_run in case_runs],
+                          [[{'bug_id': 10}], [{'bug_id': 11}], [{'bug_id': 12}]])
+        # Documents and tags are fetched once per test case, bugs once per case run
+        verbs = self.server.verbs()
+        self.assertEquals(verbs.count('TestCase.get_text'), 2)
+        self.assertEquals(verbs.count('TestCase.get_tags'), 2)
+        self.assertEquals(verbs.count('TestCaseRun.get_bugs'), 3)
+        self.assertEquals(sorted(self.server.multicalls), [3, 3, 4])
+
+    def test_snapshot_without_cases(self):
+        snapshot = self.testopia.testrun_snapshot(5, include=['bugs'])
+        self.assertEquals(snapshot['cases'], {1: {'case_id': 1}, 2: {'case_id': 2}})
+        self.assert_('TestRun.get_test_cases' not in self.server.verbs())
+        self.assertEquals(self.server.multicalls, [2, 3])
+
+    def test_snapshot_include(self):
+        self.assertRaises(TestopiaError, self.testopia.testrun_snapshot, 5,
+                          include=['attachments'])
+
+class MapUnitTests(TestopiaUnitTest):
+    def test_map(self):
+        results = list(self.testopia.map('build_get', [1, 0, 1], workers=2))
+        self.assertEquals([args for args, result, error in results], [1, 0, 1])
+        self.assertEquals(results[0][1]['build_id'], 1)
+        self.assert_(isinstance(results[1][2], TestopiaXmlrpcError))
+
+class StreamingUnmarshallerUnitTests(unittest.TestCase):
+    def test_items_come_out_as_they_complete(self):
+        rows = [{'case_run_id': i, 'bugs': [i, {'bug_id': i}]} for i in range(50)]
+        body = xmlrpclib.dumps((rows,), methodresponse=True)
+        u = _StreamingUnmarshaller()
+        p = xmlrpclib.ExpatParser(u)
+        items = []
+        for start in range(0, len(body), 37):
+            p.feed(body[start:start + 37])
+            items.extend(u.completed_items())
+        p.close()
+        self.assertEquals(u.close(), ([],))
+        self.assertEquals(items, rows)
+
+class LookupCacheUnitTests(unittest.TestCase):
+    def test_least_recently_used_goes_first(self):
+        cache = LookupCache(ttl=None, max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(cache.stats(), dict(hits=2, misses=1, evictions=1, size=2))
+
+    def test_entries_expire(self):
+        cache = LookupCache(ttl=0)
+        cache.put('a', 1)
+        self.assertEquals(cache.get('a', 'gone'), 'gone')
+        cache.put('a', 1, ttl=None)
+        self.assertEquals(cache.get('a', 'gone'), 1)
+
+class PreloadUnitTests(StandInUnitTest):
+    def test_preload(self):
+        def names(table):
+            return lambda id: table[id] # An unknown ID faults
+        handlers = self.server.handlers
+        handlers['TestCaseRun.lookup_status_name_by_id'] = names({1: 'IDLE', 2: 'PASSED'})
+        handlers['TestCase.lookup_status_name_by_id'] = names({1: 'PROPOSED'})
+        handlers['TestCase.lookup_priority_name_by_id'] = lambda id: {1: 'P1'}.get(id, '')
+        handlers['TestPlan.lookup_type_name_by_id'] = names({1: 'Unit'})
+        handlers['TestopiaProduct.get_builds'] = lambda product_id: [
+            {'build_id': 7, 'name': 'nightly'}]
+        handlers['TestopiaProduct.get_environments'] = lambda product_id: [
+            {'environment_id': 8, 'name': 'i386'}]
+        handlers['TestopiaProduct.get_milestones'] = lambda product_id: []
+        handlers['TestPlan.list'] = lambda query: [{'plan_id': 1}]
+        handlers['TestPlan.get_categories'] = lambda plan_id: [
+            {'category_id': 5, 'name': 'Smoke'}]
+        loaded = self.testopia.preload(product_id=2, max_id=4)
+        self.assertEquals(loaded['case_run_statuses'], {1: 'IDLE', 2: 'PASSED'})
+        self.assertEquals(loaded['priorities'], {1: 'P1'})
+        self.assertEquals(loaded['categories'], {1: [{'category_id': 5, 'name': 'Smoke'}]})
+        self.assertEquals(self.server.multicalls, [16, 4, 1])
+        self.assertEquals(sorted(set(self.server.verbs())), [
+            'TestCase.lookup_priority_name_by_id', 'TestCase.lookup_status_name_by_id',
+            'TestCaseRun.lookup_status_name_by_id', 'TestPlan.get_categories',
+            'TestPlan.list', 'TestPlan.lookup_type_name_by_id',
+            'TestopiaProduct.get_builds', 'TestopiaProduct.get_environments',
+            'TestopiaProduct.get_milestones', 'User.login'])
+
+        # The lookups now answer from the cache, in both directions
+        sent = len(self.server.calls)
+        t = self.testopia
+        self.assertEquals(t.testcaserun_lookup_status_id_by_name('PASSED'), 2)
+        self.assertEquals(t.testcaserun_lookup_status_name_by_id(1), 'IDLE')
+        self.assertEquals(t.testcase_lookup_priority_id_by_name('P1'), 1)
+        self.assertEquals(t.testplan_lookup_type_id_by_name('Unit'), 1)
+        self.assertEquals(t.build_lookup_id_by_name('nightly', 2), 7)
+        self.assertEquals(t.build_lookup_name_by_id(7), 'nightly')
+        self.assertEquals(t.build_check_by_name('nightly', 2)['build_id'], 7)
+        self.assertEquals(t.testrun_lookup_environment_id_by_name('i386', 2), 8)
+        self.assertEquals(t.environment_check_by_name('i386', 2)['environment_id'], 8)
+        self.assertEquals(t.testcase_lookup_category_id_by_name('Smoke'), 5)
+        self.assertEquals(len(self.server.calls), sent)
+
+class IdentityMapUnitTests(unittest.TestCase):
+    def test_discard(self):
+        identities = IdentityMap()
+        identities.put('testcaserun', 1, {'run_id': 1, 'case_id': 1})
+        identities.put('testcaserun', 2, {'run_id': 1, 'case_id': 2})
+        identities.put('testcase', 1, {'case_id': 1})
+        identities.discard('testcaserun', run_id=1, case_id=2)
+        self.assertEquals(identities.get('testcaserun', 2), None)
+        identities.discard('testcase', 1)
+        self.assertEquals(identities.get('testcase', 1), None)
+        self.assertEquals(len(identities), 1)
+
+class IdentityMapStandInUnitTests(StandInUnitTest):
+    def setUp(self):
+        StandInUnitTest.setUp(self)
+        self.testopia._transport.close()
+        self.testopia = Testopia('jdoe@mycompany.com', 'jdoepassword', self.server.url,
+                                 identity_map=True)
+        self.cases = dict([(i, {'case_id': i, 'summary': 'Case %d' % i}) for i in range(1, 5)])
+        def update(values):
+            self.cases[values['case_id']] = dict(self.cases[values['case_id']], **values)
+            return self.cases[values['case_id']]
+        self.server.handlers['TestCase.get'] = lambda case_id: self.cases[case_id]
+        self.server.handlers['TestCase.update'] = update
+
+    def test_get_hands_out_one_object(self):
+        case = self.testopia.testcase_get(1)
+        self.assert_(self.testopia.testcase_get(1) is case)
+        self.assertEquals(self.server.verbs().count('TestCase.get'), 1)
+        self.testopia.testcase_update(1, summary='New')
+        self.assertEquals(self.testopia.testcase_get(1)['summary'], 'New')
+
+    def test_testcaserun_update_evicts(self):
+        caseRuns = {10: {'case_run_id': 10, 'run_id': 1, 'case_id': 2, 'build_id': 3,
+                         'environment_id': 4, 'case_run_status_id': 1}}
+        def update(run_id, case_id, build_id, environment_id, values):
+            caseRuns[10] = dict(caseRuns[10], **values)
+            return caseRuns[10]
+        self.server.handlers['TestCaseRun.get'] = lambda case_run_id: caseRuns[case_run_id]
+        self.server.handlers['TestCaseRun.update'] = update
+        self.assertEquals(self.testopia.testcaserun_get(10)['case_run_status_id'], 1)
+        self.testopia.testcaserun_update(1, 2, 3, 4, case_run_status_id=2)
+        self.assertEquals(self.testopia.testcaserun_get(10)['case_run_status_id'], 2)
+
+    def test_get_many(self):
+        first = self.testopia.testcase_get(2)
+        cases = self.testopia.get_many('testcase', [3, 2, 1, 3])
+        self.assertEquals([case['case_id'] for case in cases], [3, 2, 1, 3])
+        self.assert_(cases[1] is first)
+        self.assert_(self.testopia.testcase_get(1) is cases[2])
+        self.assertEquals(self.server.verbs().count('TestCase.get'), 3) # 2, then 3 and 1
+
+    def test_batched_update_evicts_once_sent(self):
+        self.testopia.testcase_get(1)
+        with self.testopia.batch() as b:
+            b.testcase_update(1, summary='New')
+            # Not sent yet, so this still reads, and keeps, the old test case
+            self.assertEquals(self.testopia.testcase_get(1)['summary'], 'Case 1')
+        self.assertEquals(self.testopia.testcase_get(1)['summary'], 'New')
+
+class DiskCacheUnitTests(unittest.TestCase):
+    def test_results_are_shared_and_invalidated(self):
+        import tempfile, shutil
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'cache.db')
+            DiskCache(filename).put('TestCase.get', [10], {'case_id': 10})
+            cache = DiskCache(filename, max_entries=1)
+            self.assertEquals(cache.get('TestCase.get', [10]), {'case_id': 10})
+            other = DiskCache(filename, namespace='https://other/tr_xmlrpc.cgi\njdoe')
+            self.assertEquals(other.get('TestCase.get', [10], 'none'), 'none')
+            self.assert_(cache.caches('TestCase.get_text'))
+            self.failIf(cache.caches('TestCase.list'))
+            cache.invalidate('TestCase.add_tag', [10, 'tag'])
+            self.assertEquals(cache.get('TestCase.get', [10], 'gone'), 'gone')
+            for case_id in [10, 11]:
+                cache.put('TestCase.get', [case_id], {'case_id': case_id})
+            cache.invalidate('TestCase.update', [{'case_id': 10, 'summary': 'new'}])
+            self.assertEquals(cache.get('TestCase.get', [10], 'gone'), 'gone')
+            self.assertEquals(cache.get('TestCase.get', [11]), {'case_id': 11})
+            cache.invalidate('TestCase.update', [{'summary': 'new'}])
+            self.assertEquals(cache.get('TestCase.get', [11], 'gone'), 'gone')
+            for product_id in [1, 2]:
+                cache.put('TestopiaProduct.get', [product_id], {'id': product_id})
+            cache.invalidate('TestopiaProduct.update', [{'id': 1, 'name': 'Rawhide'}])
+            self.assertEquals(cache.get('TestopiaProduct.get', [1], 'gone'), 'gone')
+            self.assertEquals(cache.get('TestopiaProduct.get', [2]), {'id': 2})
+        finally:
+            shutil.rmtree(directory)
+
+class DiskCacheStandInUnitTests(StandInUnitTest):
+    def setUp(self):
+        import tempfile
+        StandInUnitTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.testopia._transport.close()
+        self.testopia = Testopia('jdoe@mycompany.com', 'jdoepassword', self.server.url,
+                                 disk_cache=os.path.join(self.directory, 'cache.db'))
+
+    def tearDown(self):
+        import shutil
+        StandInUnitTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_own_writes_invalidate(self):
+        cases = {10: {'case_id': 10, 'summary': 'old'}}
+        def update(values):
+            cases[values['case_id']].update(values)
+            return cases[values['case_id']]
+        self.server.handlers['TestCase.get'] = lambda case_id: cases[case_id]
+        self.server.handlers['TestCase.update'] = update
+        self.assertEquals(self.testopia.testcase_get(10)['summary'], 'old')
+        self.testopia.testcase_update(10, summary='new')
+        self.assertEquals(self.testopia.testcase_get(10)['summary'], 'new')
+
+    def test_batched_writes_invalidate(self):
+        tags = {10: ['smoke']}
+        texts = {10: {'action': 'Boot', 'version': 1}}
+        def store_text(case_id, author_id, action, expected_results, setup, breakdown):
+            texts[case_id] = {'action': action, 'version': texts[case_id]['version'] + 1}
+            return texts[case_id]['version']
+        self.server.handlers['TestCase.get_tags'] = lambda case_id: tags[case_id]
+        def add_tag(case_id, tag):
+            tags[case_id].append(tag)
+            return 0
+        self.server.handlers['TestCase.add_tag'] = add_tag
+        self.server.handlers['TestCase.get_text'] = lambda case_id: texts[case_id]
+        self.server.handlers['TestCase.store_text'] = store_text
+        self.assertEquals(self.testopia.testcase_get_tags(10), ['smoke'])
+        self.assertEquals(self.testopia.testcase_get_text(10)['version'], 1)
+        with self.testopia.batch() as b:
+            b.testcase_add_tag(10, 'slow')
+            b.testcase_store_text(10, 1, action='Boot twice')
+        self.assertEquals(self.testopia.testcase_get_tags(10), ['smoke', 'slow'])
+        self.assertEquals(self.testopia.testcase_get_text(10)['version'], 2)
+        # Sent one call at a time, the writes invalidate just the same
+        self.testopia._multicall_supported = False
+        with self.testopia.batch() as b:
+            b.testcase_add_tag(10, 'nightly')
+        self.assertEquals(self.testopia.testcase_get_tags(10), ['smoke', 'slow', 'nightly'])
+
+class TextHashesUnitTests(unittest.TestCase):
+    def test_hashes_by_version(self):
+        import tempfile
+        filename = tempfile.mktemp()
+        try:
+            hashes = TextHashes(filename)
+            digest = TextHashes.digest(action=u'Boot \u00e9', expected_results='Up')
+            self.assertEquals(digest, TextHashes.digest(None, '', 'Boot \xc3\xa9', 'Up'))
+            self.assertNotEquals(digest, TextHashes.digest(action='Boot', expected_results='Up'))
+            hashes.put(1, 3, digest)
+            self.assertEquals(hashes.get(1, 3), digest)
+            self.assertEquals(hashes.get(1, 4), None)
+            self.assertEquals(TextHashes(filename).get(1, 3), digest)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class StoreTextsUnitTests(StandInUnitTest):
+    def setUp(self):
+        StandInUnitTest.setUp(self)
+        # Case 1 has no text yet, which the server answers with an empty string
+        self.documents = {1: '', 2: {'version': 3, 'setup': '', 'breakdown': '',
+                                     'action': 'Boot', 'effect': 'Up'}}
+        def store_text(case_id, author_id, action, expected_results, setup, breakdown):
+            document = self.documents[case_id] or {'version': 0}
+            self.documents[case_id] = {'version': document['version'] + 1, 'setup': setup,
+                                       'breakdown': breakdown, 'action': action,
+                                       'effect': expected_results}
+            return self.documents[case_id]['version']
+        self.server.handlers['TestCase.get_text'] = lambda case_id: self.documents[case_id]
+        self.server.handlers['TestCase.store_text'] = store_text
+
+    def test_store_texts(self):
+        versions = self.testopia.testcase_store_texts(1, [
+            {'case_id': 1, 'action': 'Log in', 'expected_results': 'Logged in'},
+            {'case_id': 2, 'action': 'Boot', 'expected_results': 'Up'}])
+        self.assertEquals(versions, {1: 1, 2: 3})
+        self.assertEquals([params[0] for verb, params in self.server.calls
+                           if verb == 'TestCase.store_text'], [1])
+
+    def test_store_text_if_changed(self):
+        self.assertEquals(self.testopia.testcase_store_text(
+            1, 1, action='Log in', expected_results='Logged in', if_changed=True), 1)
+        self.assertEquals(self.testopia.testcase_store_text(
+            2, 1, action='Boot', expected_results='Up', if_changed=True), 3)
+        self.assertEquals(self.server.verbs().count('TestCase.store_text'), 1)
+
+class SharedReadUnitTests(unittest.TestCase):
+    def test_concurrent_reads_are_sent_once(self):
+        t = Testopia.__new__(Testopia)
+        t._in_flight, t._in_flight_lock = {}, threading.Lock()
+        sent = []
+        def send(verb, args):
+            sent.append(verb)
+            threading.Event().wait(0.1) # Long enough for the others to join in
+            return {'plan_id': args[0]}
+        t._send_command = send
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(t.testplan_get(1)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sent, ['TestPlan.get'])
+        self.assertEquals(results, [{'plan_id': 1}] * 5)
+        self.assertEquals(len(set([id(result) for result in results])), 5)
+
+class TestCaseRowsUnitTests(unittest.TestCase):
+    def test_csv_and_ndjson(self):
+        csvFile = StringIO('summary,plan_id,tags\nFirst,1,"a, b"\nSecond,,\n')
+        self.assertEquals(list(_testcase_rows(csvFile, 'csv')),
+                          [{'summary': 'First', 'plan_id': '1', 'tags': 'a, b'},
+                           {'summary': 'Second'}])
+        ndjsonFile = StringIO('{"summary": "First", "tags": ["a"]}\n\n')
+        self.assertEquals(list(_testcase_rows(ndjsonFile)),
+                          [{'summary': 'First', 'tags': ['a']}])
+
+class JUnitUnitTests(unittest.TestCase):
+    def test_junit_testcases(self):
+        from StringIO import StringIO
+        report = StringIO('<testsuites><testsuite name="s">'
+                          '<testcase classname="a.B" name="test_one"/>'
+                          '<testcase classname="a.B" name="test_two">'
+                          '<failure message="expected 1">trace</failure></testcase>'
+                          '<testcase name="test_three"><error>boom</error></testcase>'
+                          '<testcase name="test_four"><skipped/></testcase>'
+                          '</testsuite></testsuites>')
+        self.assertEquals(list(_junit_testcases(report)),
+                          [('a.B', 'test_one', 'passed', None),
+                           ('a.B', 'test_two', 'failure', 'expected 1'),
+                           ('', 'test_three', 'error', 'boom'),
+                           ('', 'test_four', 'skipped', None)])
+
+class RecordUnitTests(unittest.TestCase):
+    def test_record_reads_like_its_dictionary(self):
+        row = {'case_run_id': 1, 'case_run_status_id': 2, 'status': 'PASSED'}
+        record = TestCaseRunRecord(dict(row))
+        self.assertEquals(record, row)
+        self.assertEquals(record['status'], 'PASSED')
+        self.assertEquals(record.get('notes', ''), '')
+        self.assertRaises(KeyError, lambda: record['notes'])
+        self.assertEquals(sorted(record.keys()), sorted(row.keys()))
+        self.assert_(TestCaseRunRecord(dict(row))['status'] is record['status'])
+
+    def test_interned_unicode_is_bounded(self):
+        first = _intern(u'P\u00c4SSED')
+        self.assert_(_intern(u'P\u00c4SSED') is first)
+        for i in range(_INTERN_UNICODE_MAX * 2):
+            _intern(u'note \u00e9 %d' % i)
+        self.assert_(len(_interned_unicode) <= _INTERN_UNICODE_MAX)
+
+class ResultFrameUnitTests(unittest.TestCase):
+    '''Runs ResultFrame on the array module; NumpyResultFrameUnitTests runs
+    the same tests with NumPy.'''
+    use_numpy = False
+
+    def setUp(self):
+        global numpy
+        self._numpy = numpy
+        if not self.use_numpy:
+            numpy = None
+        else:
+            try:
+                import numpy
+            except ImportError:
+                self.skipTest("NumPy is not installed")
+
+    def tearDown(self):
+        global numpy
+        numpy = self._numpy
+
+    def summarize(self, rows):
+        """Returns the filters, counts and joins of a frame of rows, as plain values."""
+        frame = ResultFrame.from_rows(rows, ['case_run_id', 'case_id', 'build_id',
+                                             'case_run_status_id'])
+        caseIds = sorted(set([row['case_id'] for row in rows[::2]]))
+        cases = ResultFrame({'case_id': caseIds, 'category_id': caseIds[::-1]})
+        return (frame.count_by('case_run_status_id'),
+                frame.count_by('build_id', 'case_run_status_id'),
+                frame.filter(build_id=[1, 3], case_run_status_id=2).rows(),
+                frame.filter(case_id=range(0, 2000000, 3)).rows(),
+                frame.join(cases, 'case_id').rows())
+
+    def test_large_keys(self):
+        # Keys too far apart for the tables indexed by value
+        rows = [{'case_run_id': i, 'case_id': i * 1000003, 'build_id': i % 3,
+                 'case_run_status_id': 1 << 40 if i % 2 else 2} for i in range(1, 7)]
+        statuses, pairs, filtered, thirds, joined = self.summarize(rows)
+        self.assertEquals(statuses, {2: 3, 1 << 40: 3})
+        self.assertEquals(len(pairs), 6)
+        self.assertEquals([row['case_run_id'] for row in joined], [1, 3, 5])
+        self.assertEquals([row['category_id'] for row in joined],
+                          [5 * 1000003, 3 * 1000003, 1000003])
+
+    def test_filter_count_and_join(self):
+        caseRuns = ResultFrame.from_rows([
+            {'case_run_id': 1, 'case_id': 10, 'build_id': 1, 'case_run_status_id': 2},
+            {'case_run_id': 2, 'case_id': 11, 'build_id': 1, 'case_run_status_id': 3},
+            {'case_run_id': 3, 'case_id': 10, 'build_id': 2, 'case_run_status_id': 2},
+            {'case_run_id': 4, 'case_id': 12, 'build_id': 2, 'case_run_status_id': None}],
+            ['case_run_id', 'case_id', 'build_id', 'case_run_status_id'])
+        self.assertEquals(caseRuns.count_by('case_run_status_id'), {0: 1, 2: 2, 3: 1})
+        self.assertEquals(caseRuns.filter(case_run_status_id=[2, 3]).count_by('build_id', 'case_run_status_id'),
+                          {(1, 2): 1, (1, 3): 1, (2, 2): 1})
+        cases = ResultFrame({'case_id': [10, 11], 'category_id': [5, 6]})
+        joined = caseRuns.join(cases, 'case_id')
+        self.assertEquals(list(joined['case_run_id']), [1, 2, 3])
+        self.assertEquals(list(joined['category_id']), [5, 6, 5])
+
+class NumpyResultFrameUnitTests(ResultFrameUnitTests):
+    use_numpy = True
+
+    def test_same_as_array_module(self):
+        import random
+        generator = random.Random(19)
+        rows = [{'case_run_id': i, 'case_id': generator.randrange(1, 2000),
+                 'build_id': generator.randrange(1, 5),
+                 'case_run_status_id': generator.choice([None, 1, 2, 3, 4, 5, 6, 7, 8])}
+                for i in range(1, 5000)]
+        withNumpy = self.summarize(rows)
+        global numpy
+        numpy = None
+        self.assertEquals(self.summarize(rows), withNumpy)
+
+class ReplicaQueryUnitTests(unittest.TestCase):
+    def test_testcase_list(self):
+        replica = TestopiaReplica(None, ':memory:')
+        cases = [{'case_id': 1, 'summary': 'Boot crash', 'alias': 'boot', 'category_id': 5},
+                 {'case_id': 2, 'summary': 'Login fails after boot', 'category_id': 5},
+                 {'case_id': 3, 'summary': 'Suspend', 'category_id': 6}]
+        replica._index_words(cases)
+        replica._store('cases', cases)
+        replica.connection.executemany("INSERT INTO case_tags VALUES (?, ?)",
+                                       [(1, 'smoke'), (2, 'smoke'), (2, 'slow')])
+        ids = lambda **kwargs: [case['case_id'] for case in replica.testcase_list(**kwargs)]
+        self.assertEquals(ids(category_id=5), [1, 2])
+        self.assertEquals(ids(summary='boot', summary_type='anywords'), [1, 2])
+        self.assertEquals(ids(summary='crash boot', summary_type='allwords'), [1])
+        self.assertEquals(ids(summary='boot', summary_type='nowords'), [3])
+        self.assertEquals(ids(alias_type='isnull'), [2, 3])
+        self.assertEquals(ids(summary='^S', summary_type='regexp'), [3])
+        self.assertEquals(ids(summary='^s', summary_type='regexp'), [3]) # As MySQL does
+        self.assertEquals(ids(category_id=5, canview=1), [1, 2])
+        self.assertEquals(ids(category_id=6, category_id_type='lessthan'), [1, 2])
+        self.assertEquals(ids(tags='smoke, slow', tags_type='allwords'), [2])
+        self.assertRaises(TestopiaError, ids, category_id=5, category_id_type='fuzzy')
+        self.assertRaises(TestopiaError, ids, build_id=1)
+
+class AsyncUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.handlers['Build.get'] = lambda build_id: {'build_id': build_id}
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_from_config(self):
+        import tempfile
+        config = tempfile.NamedTemporaryFile(suffix='.cfg')
+        config.write("[testopia]\nusername: jdoe@mycompany.com\npassword: jdoepassword\n"
+                     "url: %s\npool_size: 1\ncompress_threshold: 1024\ncache_ttl: 60\n"
+                     "identity_map: yes\ncompact_results: yes\n" % self.server.url)
+        config.flush()
+        a = AsyncTestopia.from_config(config.name, max_in_flight=3)
+        try:
+            self.assertEquals(a.testopia._transport.pool_size, 3)
+            self.assertEquals(a.testopia._transport.encode_threshold, 1024)
+            self.assert_(a.testopia.identities is not None)
+            self.assertEquals(a.build_get(1).get()['build_id'], 1)
+        finally:
+            a.close()
+
+    def test_async_build_get(self):
+        a = AsyncTestopia('jdoe@mycompany.com', 'jdoepassword', self.server.url,
+                          max_in_flight=2)
+        try:
+            pending = [a.build_get(1), a.build_get(2), a.build_get(0)]
+            self.assertEquals([p.get()['build_id'] for p in pending], [1, 2, 0])
+            self.assertRaises(TestopiaXmlrpcError, a.do_command("Build.nonsense", []).get)
+        finally:
+            a.close()
+
+class ReplicaStandInUnitTests(StandInUnitTest):
+    def test_sync_refreshes_open_runs(self):
+        caseRuns = dict([(i, {'case_run_id': i, 'run_id': 5, 'case_id': i, 'build_id': 1,
+                              'environment_id': 1, 'case_run_status_id': 1})
+                         for i in (100, 101)])
+        def list_case_runs(query):
+            rows = [row for row in caseRuns.values() if row['run_id'] == query['run_id']]
+            if 'case_run_id' in query:
+                rows = [row for row in rows if row['case_run_id'] > query['case_run_id']]
+            if 'close_date' in query:
+                rows = [row for row in rows if row.get('close_date') > query['close_date']]
+            return rows
+        handlers = self.server.handlers
+        handlers['TestPlan.list'] = lambda query: [{'plan_id': 1, 'product_id': 2}]
+        handlers['TestCase.list'] = lambda query: []
+        run = {'run_id': 5, 'plan_id': 1} # No stop_date: still open
+        handlers['TestRun.list'] = lambda query: [run][:query.get('run_id', 0) < 5]
+        handlers['TestRun.get'] = lambda run_id: run
+        handlers['TestCaseRun.list'] = list_case_runs
+        handlers['TestCaseRun.get'] = lambda case_run_id: caseRuns[case_run_id]
+        replica = TestopiaReplica(self.testopia, ':memory:')
+        statuses = lambda: list(replica.connection.execute(
+            "SELECT case_run_id, case_run_status_id, close_date FROM case_runs "
+            "ORDER BY case_run_id"))
+        replica.sync(2)
+        self.assertEquals(statuses(), [(100, 1, None), (101, 1, None)])
+
+        # Nothing was closed at the last sync: the open run is fetched whole
+        caseRuns[100].update(case_run_status_id=2, close_date='2026-10-18 12:00:00')
+        replica.sync(2)
+        self.assertEquals(statuses(), [(100, 2, '2026-10-18 12:00:00'), (101, 1, None)])
+
+        # With a close date held, a case run still open is fetched again by its ID
+        caseRuns[101].update(case_run_status_id=4)
+        caseRuns[102] = dict(caseRuns[101], case_run_id=102, case_run_status_id=1)
+        replica.sync(2)
+        self.assertEquals(statuses(), [(100, 2, '2026-10-18 12:00:00'), (101, 4, None),
+                                       (102, 1, None)])
+        self.assertEquals(self.server.verbs().count('TestCaseRun.get'), 1)
+
+class ReplicaUnitTests(TestopiaUnitTest):
+    def test_sync(self):
+        productId = self.get_test_product_id()
+        replica = TestopiaReplica(self.testopia, ':memory:')
+        counts = replica.sync(productId)
+        self.assertEquals(replica.connection.execute(
+            "SELECT COUNT(*) FROM plans WHERE product_id = ?", (productId,)).fetchone()[0],
+            counts['plans'])
+        self.assert_('synced_at' in replica.state(productId))
+        self.assertEquals(replica.sync(productId)['cases'], 0)
+
 class BuildUnitTests(TestopiaUnitTest):
     def test_build_get(self):
         buildId = 1
@@ -1973,6 +6207,13 @@ class BuildUnitTests(TestopiaUnitTest):
         buildDict = self.testopia.build_check_by_name(self.testBuildName, productId)
         self.assertEquals(buildDict['product_id'], productId)
 
+    def test_ensure_build(self):
+        productId = self.get_test_product_id()
+        buildDict = self.testopia.ensure_build(self.testBuildName, productId)
+        self.assertEquals(buildDict['product_id'], productId)
+        self.assertEquals(self.testopia.ensure_build(self.testBuildName, productId)['build_id'],
+                          buildDict['build_id'])
+
     """
     def build_lookup_name_by_id(self, id)
     """
@@ -2054,6 +6295,15 @@ class ProductUnitTests(TestopiaUnitTest):
     def product_get_milestones(self, product_id)
     """
 
+    def test_preload(self):
+        productId = self.testopia.product_lookup_id_by_name(self.testProductName)
+        loaded = self.testopia.preload(product_id=productId)
+        for statusId, name in loaded['case_run_statuses'].items():
+            self.assertEquals(self.testopia.testcaserun_lookup_status_id_by_name(name), statusId)
+        for buildDict in loaded['builds']:
+            self.assertEquals(self.testopia.build_lookup_id_by_name(buildDict['name'], productId),
+                              buildDict['build_id'])
+
 class TagUnitTests(TestopiaUnitTest):
     """API entry points that aren't yet covered:
     (none yet)
@@ -2166,6 +6416,8 @@ class TestRunUnitTests(TestopiaUnitTest):
                    notes=None, product_version=None):
     def testrun_get_test_cases(self, run_id):
     def testrun_get_test_case_runs(self, run_id):
+    def testrun_snapshot(self, run_id, include=SNAPSHOT_INCLUDES, chunk_size=100,
+                         workers=4):
     def testrun_get_test_plan(self, run_id):
     def testrun_add_tag(self, run_id, tag_name):
     def testrun_remove_tag(self, run_id, tag_name):
@@ -2199,7 +6451,10 @@ class TestCaseRunUnitTests(TestopiaUnitTest):
                     case_run_status_id=None,
                     update_bugs=False,
                     assignee=None,
-                    notes=None)
+                    notes=None,
+                    bugs=None)
+    def record_results(self, run_id, build_id, environment_id, results,
+                       chunk_size=100, workers=4)
     def testcaserun_get_bugs(self, case_run_id):
     def testcaserun_lookup_status_id_by_name(self, name)
     def testcaserun_lookup_status_name_by_id(self, id)